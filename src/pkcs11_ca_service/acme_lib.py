@@ -65,6 +65,7 @@ from .nonce import generate_nonce, verify_nonce
 from .pkcs11_key import Pkcs11Key, Pkcs11KeyInput
 from .public_key import PublicKey
 from .route_functions import ca_request
+from .sign_scheduler import SIGN_LANE_LIBRARY, SIGN_PRIORITY_ISSUANCE, SignScheduler
 
 DATE_STRING = "%Y-%m-%dT%H:%M:%SZ"
 ERROR_NON_VALID_CSR = "Non valid CSR"
@@ -267,12 +268,16 @@ async def sign_cert(csr: asn1_csr.CertificationRequest, order: AcmeOrder) -> Non
     csr_obj = Csr({"pem": csr_pem, "authorized_by": 1, "public_key": public_key_obj.serial})
     await csr_obj.save()
 
-    cert_pem = await pkcs11_sign_csr(
+    cert_pem = await SignScheduler.call(
+        SIGN_PRIORITY_ISSUANCE,
+        "sign_csr",
+        pkcs11_sign_csr,
         ACME_SIGNER_KEY_LABEL,
         ACME_SIGNER_NAME_DICT,
         csr_pem,
         key_type=ACME_SIGNER_KEY_TYPE,
         extra_extensions=extra_extensions,
+        lane=SIGN_LANE_LIBRARY,
     )
 
     # Save cert
@@ -34,7 +34,7 @@ from cryptography.hazmat.primitives.hashes import SHA256, SHA384, SHA512
 from cryptography.hazmat.primitives.serialization import load_der_public_key
 from python_x509_pkcs11.crypto import convert_rs_ec_signature
 
-from .config import ROOT_URL
+from .config import CRL_PARTITION_PERIOD, DELTA_CRL_LIFETIME, ROOT_URL
 from .error import UnsupportedJWTAlgorithm
 
 
@@ -260,6 +260,25 @@ def pem_cert_to_key_hash(pem: str) -> bytes:
     raise ValueError("No SKI extension in cert")
 
 
+def pem_cert_to_name_hash(pem: str) -> bytes:
+    """Get the SHA1 hash of the subject name from pem data, as in an OCSP CertID for certs issued by it.
+
+    Parameters:
+    pem (str): PEM input data.
+
+    Returns:
+    bytes
+    """
+
+    data = pem.encode("utf-8")
+    if asn1_pem.detect(data):
+        _, _, data = asn1_pem.unarmor(data)
+
+    cert = asn1_x509.Certificate().load(data)
+    ret: bytes = cert["tbs_certificate"]["subject"].sha1
+    return ret
+
+
 def public_key_pem_to_sha1_fingerprint(pem: str) -> str:
     """Get the sha1 fingerprint for the public key in pem data.
 
@@ -648,6 +667,54 @@ def cert_revoked(serial_number: int, crl_pem: str) -> bool:
     return False
 
 
+def current_crl_partition() -> Union[int, None]:
+    """The CRL partition for certificates issued now, None if CRLs are not partitioned.
+
+    Returns:
+    Union[int, None]
+    """
+
+    if CRL_PARTITION_PERIOD <= 0:
+        return None
+    return int(datetime.datetime.now(datetime.timezone.utc).timestamp()) // CRL_PARTITION_PERIOD
+
+
+def cert_crl_partition(pem: str) -> Union[int, None]:
+    """The CRL partition of the certificate's not_before, None if CRLs are not partitioned.
+
+    Parameters:
+    pem (str): PEM certificate input data.
+
+    Returns:
+    Union[int, None]
+    """
+
+    if CRL_PARTITION_PERIOD <= 0:
+        return None
+
+    data = pem.encode("utf-8")
+    if asn1_pem.detect(data):
+        _, _, data = asn1_pem.unarmor(data)
+    cert = asn1_x509.Certificate().load(data)
+    return int(cert["tbs_certificate"]["validity"]["not_before"].native.timestamp()) // CRL_PARTITION_PERIOD
+
+
+def crl_partition_path(issuer_path: str, partition: Union[int, None]) -> str:
+    """The CRL path for the CA's CRL partition, the CA's path for its complete CRL.
+
+    Parameters:
+    issuer_path (str): Path to issuer CA.
+    partition (Union[int, None]): The CRL partition, None for the complete CRL.
+
+    Returns:
+    str
+    """
+
+    if partition is None:
+        return issuer_path
+    return issuer_path + "/" + str(partition)
+
+
 def aia_and_cdp_exts(issuer_path: str) -> asn1_x509.Extensions:
     """Create AIA and CDP extensions.
 
@@ -679,8 +746,9 @@ def aia_and_cdp_exts(issuer_path: str) -> asn1_x509.Extensions:
     aia_ext["extn_id"] = asn1_x509.ExtensionId("1.3.6.1.5.5.7.1.1")
     aia_ext["extn_value"] = aia
 
-    # CDP
-    g_n = asn1_x509.GeneralName(name="uniform_resource_identifier", value=ROOT_URL + "/crl/" + issuer_path)
+    # CDP, the CRL partition for certificates issued now
+    crl_path = crl_partition_path(issuer_path, current_crl_partition())
+    g_n = asn1_x509.GeneralName(name="uniform_resource_identifier", value=ROOT_URL + "/crl/" + crl_path)
     g_ns = asn1_x509.GeneralNames()
     g_ns.append(g_n)
     dist_point = asn1_x509.DistributionPoint()
@@ -694,6 +762,20 @@ def aia_and_cdp_exts(issuer_path: str) -> asn1_x509.Extensions:
     exts = asn1_x509.Extensions()
     exts.append(aia_ext)
     exts.append(cdp_ext)
+
+    # Freshest CRL, where to find the issuer's delta CRL
+    if DELTA_CRL_LIFETIME > 0:
+        g_n = asn1_x509.GeneralName(name="uniform_resource_identifier", value=ROOT_URL + "/delta_crl/" + crl_path)
+        g_ns = asn1_x509.GeneralNames()
+        g_ns.append(g_n)
+        dist_point = asn1_x509.DistributionPoint()
+        dist_point["distribution_point"] = asn1_x509.DistributionPointName(name="full_name", value=g_ns)
+        freshest_crl = asn1_x509.CRLDistributionPoints()
+        freshest_crl.append(dist_point)
+        freshest_crl_ext = asn1_x509.Extension()
+        freshest_crl_ext["extn_id"] = asn1_x509.ExtensionId("2.5.29.46")
+        freshest_crl_ext["extn_value"] = freshest_crl
+        exts.append(freshest_crl_ext)
     return exts
 
 
@@ -4,7 +4,7 @@ from __future__ import annotations
 
 import datetime
 from abc import ABC, abstractmethod
-from typing import Dict, List, Type, Union
+from typing import Dict, List, Tuple, Type, Union
 
 from pydantic import BaseModel
 from python_x509_pkcs11.pkcs11_handle import PKCS11Session
@@ -91,6 +91,24 @@ class DataBaseObject(ABC):
         List[Dict[str, Union[str, int]]]
         """
 
+    @classmethod
+    @abstractmethod
+    async def load_any(
+        cls, table_name: str, field: str, values: List[str], fields: List[str]
+    ) -> List[Dict[str, Union[str, int]]]:
+        """Load data objects from DB whose field is any of the values in one query, returns a list of dict
+        with fields as keys
+
+        Parameters:
+        table_name (str): Name of the DB table.
+        field (str): Field to search, 'pem' or 'serial_number'.
+        values (List[str]): Values to search for.
+        fields (List[str]): Fields to retrieve.
+
+        Returns:
+        List[Dict[str, Union[str, int]]]
+        """
+
     @classmethod
     @abstractmethod
     async def revoke_data_for_ca(cls, ca_serial: int) -> Dict[str, str]:
@@ -103,6 +121,126 @@ class DataBaseObject(ABC):
         Dict[str, str]
         """
 
+    @classmethod
+    @abstractmethod
+    async def unexpired_certificates(cls) -> Dict[str, List[int]]:
+        """Get the serial numbers of all unexpired certificates and CAs by the PEM of their issuer CA
+
+        Returns:
+        Dict[str, List[int]]
+        """
+
+    @classmethod
+    @abstractmethod
+    async def issued_pems(cls, issuer: int, serial_numbers: List[int]) -> List[str]:
+        """Get the PEMs of the certificates and CAs issued by the CA with the serial numbers
+
+        Parameters:
+        issuer (int): The database row serial for the issuer CA
+        serial_numbers (List[int]): Certificate serial numbers
+
+        Returns:
+        List[str]
+        """
+
+    @classmethod
+    @abstractmethod
+    async def save_revocations(
+        cls,
+        issuer: int,
+        revocations: List[Tuple[int, Union[int, None]]],
+        revoked_at: datetime.datetime,
+        crl_fields: Dict[str, Union[str, int]],
+    ) -> None:
+        """Save revocations, the source of truth for the CA's CRLs, and the CA's new CRL in one transaction.
+        Certificates already revoked keep their revocation time and get the new reason.
+
+        Parameters:
+        issuer (int): The database row serial for the issuer CA
+        revocations (List[Tuple[int, Union[int, None]]]): Certificate serial number and CRL reason code or None
+        revoked_at (datetime.datetime): Revocation time
+        crl_fields (Dict[str, Union[str, int]]): Data for the fields of the new CRL rendered with the revocations
+
+        Returns:
+        None
+        """
+
+    @classmethod
+    @abstractmethod
+    async def revocation(
+        cls, issuer: int, serial_number: int
+    ) -> Union[Tuple[datetime.datetime, Union[int, None]], None]:
+        """Get the revocation time and reason if the certificate is revoked, else None
+
+        Parameters:
+        issuer (int): The database row serial for the issuer CA
+        serial_number (int): Certificate serial number
+
+        Returns:
+        Union[Tuple[datetime.datetime, Union[int, None]], None]
+        """
+
+    @classmethod
+    @abstractmethod
+    async def revocations(cls, issuer: int) -> Dict[int, Tuple[datetime.datetime, Union[int, None]]]:
+        """Get all revocations by the CA, serial number -> revocation time and reason
+
+        Parameters:
+        issuer (int): The database row serial for the issuer CA
+
+        Returns:
+        Dict[int, Tuple[datetime.datetime, Union[int, None]]]
+        """
+
+    @classmethod
+    @abstractmethod
+    async def save_ocsp_response(
+        cls, cert_id: Tuple[bytes, bytes, bytes, int], response: bytes, expires: datetime.datetime
+    ) -> None:
+        """Store a pre-signed OCSP response, replaces any stored response for the CertID
+
+        Parameters:
+        cert_id (Tuple[bytes, bytes, bytes, int]): DER hash algorithm, issuer name hash, issuer key hash, serial number.
+        response (bytes): The DER encoded OCSP response.
+        expires (datetime.datetime): When the response must no longer be served.
+
+        Returns:
+        None
+        """
+
+    @classmethod
+    @abstractmethod
+    async def load_ocsp_response(cls, cert_id: Tuple[bytes, bytes, bytes, int]) -> Union[bytes, None]:
+        """Load the stored OCSP response for the CertID if it has not expired
+
+        Parameters:
+        cert_id (Tuple[bytes, bytes, bytes, int]): DER hash algorithm, issuer name hash, issuer key hash, serial number.
+
+        Returns:
+        Union[bytes, None]
+        """
+
+    @classmethod
+    @abstractmethod
+    async def delete_ocsp_responses(cls, serial_numbers: Union[List[int], None] = None) -> None:
+        """Delete the stored OCSP responses for the serial numbers, or all expired responses if None
+
+        Parameters:
+        serial_numbers (Union[List[int], None] = None): Certificate serial numbers.
+
+        Returns:
+        None
+        """
+
+    @classmethod
+    @abstractmethod
+    async def connect(cls) -> bool:
+        """Connect to the database without creating anything, return true if connected ok
+
+        Returns:
+        bool
+        """
+
     @classmethod
     @abstractmethod
     async def startup(
@@ -248,7 +386,35 @@ async def db_load_data_class(db_data_class: Type[DataClassObject], input_object:
         ["serial"] + list(db_data_class.db_fields.keys()),
         db_data_class.db_unique_fields,
     )
+    return _data_class_objects(db_data_class, value_dict_list)
+
+
+async def db_load_data_class_any(
+    db_data_class: Type[DataClassObject], field: str, values: List[str]
+) -> List[DataClassObject]:
+    """Load data objects whose field is any of the values in one DB query.
+
+    Parameters:
+    db_data_class (Type[DataClassObject]): Which class the objects will be.
+    field (str): Field to search, 'pem' or 'serial_number'.
+    values (List[str]): Values to search for.
+
+    Returns:
+    List[DataClassObject]
+    """
+
+    if len(values) == 0:
+        return []
+
+    value_dict_list = await DataClassObject.db.load_any(
+        db_data_class.db_table_name, field, values, ["serial"] + list(db_data_class.db_fields.keys())
+    )
+    return _data_class_objects(db_data_class, value_dict_list)
+
 
+def _data_class_objects(
+    db_data_class: Type[DataClassObject], value_dict_list: List[Dict[str, Union[str, int]]]
+) -> List[DataClassObject]:
     ret: List[DataClassObject] = []
     for value_dict in value_dict_list:
         class_obj = db_data_class(value_dict)
@@ -5,18 +5,17 @@ from typing import Dict, List, Union
 
 from fastapi import HTTPException
 from fastapi.responses import JSONResponse
-from python_x509_pkcs11.crl import create as create_crl
 
 from .asn1 import (
     cert_pem_serial_number,
-    cert_revoked,
     not_before_not_after_from_cert,
-    pem_cert_to_name_dict,
     pem_to_sha256_fingerprint,
 )
 from .base import DataBaseObject, DataClassObject, InputObject, db_load_data_class
-from .crl import Crl
 from .error import WrongDataType
+from .ocsp_cache import OCSPResponseCache
+from .ocsp_issuers import OCSPIssuerCache
+from .revocation import revoke_certificate
 
 
 class CaInput(InputObject):
@@ -36,6 +35,7 @@ class Ca(DataClassObject):
     """Class to represent a certificate authority"""
 
     db: DataBaseObject
+    issuer: int
 
     db_table_name = "ca"
     db_fields = {
@@ -93,28 +93,13 @@ class Ca(DataClassObject):
         if issuer is None or issuer < 1:
             raise HTTPException(status_code=400, detail="Cannot revoke a non existing ca.")
 
-        revoke_data = await self.db.revoke_data_for_ca(issuer)
-        curr_crl = revoke_data["crl"]
-        ca_pem = revoke_data["ca"]
-        key_label = revoke_data["key_label"]
-        key_type = revoke_data["key_type"]
-
-        crl_pem: str = await create_crl(
-            key_label,
-            pem_cert_to_name_dict(ca_pem),
-            old_crl_pem=curr_crl,
-            serial_number=cert_pem_serial_number(self.pem),
-            reason=reason,
-            key_type=key_type,
-        )
-        crl_obj = Crl(
-            {
-                "pem": crl_pem,
-                "issuer": issuer,
-                "authorized_by": auth_by,
-            }
-        )
-        await crl_obj.save()
+        await revoke_certificate(self.db, issuer, cert_pem_serial_number(self.pem), reason, auth_by)
+
+        # The new CRL is saved, drop any cached or stored OCSP response saying the CA is good
+        # and the resolved OCSP issuers
+        OCSPResponseCache.evict_serial(cert_pem_serial_number(self.pem))
+        await self.db.delete_ocsp_responses([cert_pem_serial_number(self.pem)])
+        OCSPIssuerCache.clear()
 
         print("Revoked CA, serial " + str(self.serial))
 
@@ -152,10 +137,9 @@ class Ca(DataClassObject):
 
         while True:
             ca_issuer = int(revoke_data["ca_issuer"])
-            crl_pem = revoke_data["crl"]
             ca_serial = int(revoke_data["ca_serial"])
 
-            if cert_revoked(cert_pem_serial_number(ca_pem), crl_pem):
+            if await self.db.revocation(ca_serial, cert_pem_serial_number(ca_pem)) is not None:
                 return True
 
             if ca_issuer == ca_serial:
@@ -3,18 +3,16 @@ from typing import Dict, List, Union
 
 from fastapi import HTTPException
 from fastapi.responses import JSONResponse
-from python_x509_pkcs11.crl import create as create_crl
 
 from .asn1 import (
     cert_pem_serial_number,
-    cert_revoked,
     not_before_not_after_from_cert,
-    pem_cert_to_name_dict,
     pem_to_sha256_fingerprint,
 )
 from .base import DataBaseObject, DataClassObject, InputObject, db_load_data_class
-from .crl import Crl
 from .error import WrongDataType
+from .ocsp_cache import OCSPResponseCache
+from .revocation import revoke_certificate
 
 
 class CertificateInput(InputObject):
@@ -29,6 +27,7 @@ class Certificate(DataClassObject):
     """Class to represent a certificate"""
 
     db: DataBaseObject
+    issuer: int
 
     db_table_name = "certificate"
     db_fields = {
@@ -79,28 +78,11 @@ class Certificate(DataClassObject):
         if issuer is None or issuer < 1:
             raise HTTPException(status_code=400, detail="Cannot revoke a non existing cert.")
 
-        revoke_data = await self.db.revoke_data_for_ca(issuer)
-        crl = revoke_data["crl"]
-        key_label = revoke_data["key_label"]
-        key_type = revoke_data["key_type"]
-        ca_pem = revoke_data["ca"]
-
-        crl_pem: str = await create_crl(
-            key_label,
-            pem_cert_to_name_dict(ca_pem),
-            serial_number=cert_pem_serial_number(self.pem),
-            reason=reason,
-            old_crl_pem=crl,
-            key_type=key_type,
-        )
-        crl_obj = Crl(
-            {
-                "pem": crl_pem,
-                "authorized_by": auth_by,
-                "issuer": issuer,
-            }
-        )
-        await crl_obj.save()
+        await revoke_certificate(self.db, issuer, cert_pem_serial_number(self.pem), reason, auth_by)
+
+        # The new CRL is saved, drop any cached or stored OCSP response saying the cert is good
+        OCSPResponseCache.evict_serial(cert_pem_serial_number(self.pem))
+        await self.db.delete_ocsp_responses([cert_pem_serial_number(self.pem)])
         print("Revoked cert, serial " + str(self.serial))
 
     async def issuer_pem(self) -> str:
@@ -135,9 +117,8 @@ class Certificate(DataClassObject):
         while True:
             ca_issuer = int(revoke_data["ca_issuer"])
             ca_serial = int(revoke_data["ca_serial"])
-            crl_pem = revoke_data["crl"]
 
-            if cert_revoked(cert_pem_serial_number(ca_pem), crl_pem):
+            if await self.db.revocation(ca_serial, cert_pem_serial_number(ca_pem)) is not None:
                 return True
 
             if ca_serial == ca_issuer:
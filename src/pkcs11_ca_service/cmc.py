@@ -2,7 +2,7 @@
 import datetime
 import hashlib
 from random import randint
-from typing import Dict, List, Union
+from typing import Dict, List, Tuple, Union
 
 from asn1crypto import algos as asn1_algos
 from asn1crypto import cms as asn1_cms
@@ -15,7 +15,6 @@ from fastapi import HTTPException
 from python_cmc import cmc as asn1_cmc
 from python_x509_pkcs11.csr import sign_csr
 from python_x509_pkcs11.lib import signed_digest_algo
-from python_x509_pkcs11.pkcs11_handle import PKCS11Session
 
 from .asn1 import (
     aia_and_cdp_exts,
@@ -26,9 +25,9 @@ from .asn1 import (
     pem_cert_verify_signature,
     public_key_pem_from_csr,
 )
-from .base import db_load_data_class
+from .base import db_load_data_class_any
 from .ca import Ca, CaInput
-from .certificate import Certificate, CertificateInput
+from .certificate import Certificate
 from .config import (
     CMC_CERT_ISSUING_KEY_LABEL,
     CMC_CERT_ISSUING_NAME_DICT,
@@ -38,40 +37,47 @@ from .config import (
 )
 from .csr import Csr
 from .pkcs11_key import Pkcs11KeyInput
+from .pkcs11_pool import PKCS11SessionPool
 from .public_key import PublicKey
-from .route_functions import ca_request, pkcs11_key_request
+from .route_functions import ca_request, pkcs11_key_request, revoke_bulk
+from .sign_scheduler import (
+    SIGN_LANE_LIBRARY,
+    SIGN_LANE_POOL,
+    SIGN_PRIORITY_ISSUANCE,
+    SignScheduler,
+)
 
 
 async def cmc_revoke(revoke_data: bytes) -> None:
-    """Revoke a certificate based on the CMC RevokeRequest"""
+    """Revoke the certificates based on the CMC RevokeRequests, each issuer's CRL is signed once"""
     set_of_revoke_request = asn1_cmc.SetOfRevokeRequest.load(revoke_data)
-    revoked_certs = 0
-
+    targets: List[Tuple[Union[Certificate, Ca], Union[int, None]]] = []
+
+    # All certs and Ca's with the serial numbers, one DB query each
+    serial_numbers = list({str(revoke_request["serial_number"].native) for revoke_request in set_of_revoke_request})
+    db_objs = await db_load_data_class_any(Certificate, "serial_number", serial_numbers)
+    db_objs += await db_load_data_class_any(Ca, "serial_number", serial_numbers)
+    objs: Dict[int, List[Union[Certificate, Ca]]] = {}
+    for obj in db_objs:
+        if isinstance(obj, (Certificate, Ca)):
+            objs.setdefault(cert_pem_serial_number(obj.pem), []).append(obj)
+
+    # Issuer DB serial -> issuer name
+    issuer_names: Dict[int, Dict[str, str]] = {}
     for _, revoke_request in enumerate(set_of_revoke_request):
-        # Try certs
-        db_certificate_objs = await db_load_data_class(
-            Certificate, CertificateInput(serial_number=str(revoke_request["serial_number"].native))
-        )
-        for obj in db_certificate_objs:
-            if isinstance(obj, Certificate):
-                if pem_cert_to_name_dict(await obj.issuer_pem()) == revoke_request["issuerName"].native:
-                    await obj.revoke(1, int(revoke_request["reason"]))  # Change to cmc request signer
-                    revoked_certs += 1
-                    print("Revoked cert due to CMC request")
-
-        # Try Ca's
-        db_ca_objs = await db_load_data_class(Ca, CaInput(serial_number=str(revoke_request["serial_number"].native)))
-        for obj in db_ca_objs:
-            if isinstance(obj, Ca):
-                if pem_cert_to_name_dict(await obj.issuer_pem()) == revoke_request["issuerName"].native:
-                    await obj.revoke(1, int(revoke_request["reason"]))  # Change to cmc request signer
-                    revoked_certs += 1
-                    print("Revoked cert due to CMC request")
-
-    if revoked_certs == 0:
+        for obj in objs.get(revoke_request["serial_number"].native, []):
+            if obj.issuer not in issuer_names:
+                issuer_names[obj.issuer] = pem_cert_to_name_dict(await obj.issuer_pem())
+            if issuer_names[obj.issuer] == revoke_request["issuerName"].native:
+                targets.append((obj, int(revoke_request["reason"])))
+
+    if len(targets) == 0:
         print("Could not find the certificate to revoke from CMC RevokeRequest")
         raise ValueError
 
+    await revoke_bulk(1, targets)  # Change to cmc request signer
+    print("Revoked " + str(len(targets)) + " certs due to CMC request")
+
 
 async def create_cert_from_csr(csr_data: asn1_csr.CertificationRequest) -> asn1_x509.Certificate:
     """Create cert from a csr"""
@@ -82,13 +88,17 @@ async def create_cert_from_csr(csr_data: asn1_csr.CertificationRequest) -> asn1_
 
     extra_extensions = aia_and_cdp_exts(issuer.path)
 
-    signed_cert = await sign_csr(
+    signed_cert = await SignScheduler.call(
+        SIGN_PRIORITY_ISSUANCE,
+        "sign_csr",
+        sign_csr,
         CMC_CERT_ISSUING_KEY_LABEL,
         CMC_CERT_ISSUING_NAME_DICT,
         csr_pem.decode("utf-8"),
         extra_extensions=extra_extensions,
         ignore_auth_exts=True,
         key_type="secp256r1",
+        lane=SIGN_LANE_LIBRARY,
     )
 
     # Get public key from csr
@@ -295,8 +305,14 @@ async def create_cmc_response(  # pylint: disable-msg=too-many-locals
         {"algorithm": asn1_algos.DigestAlgorithmId("2.16.840.1.101.3.4.2.1")}
     )
     signer_info["signature_algorithm"] = signed_digest_algo(CMC_KEYS_TYPE)
-    signer_info["signature"] = await PKCS11Session().sign(
-        "cmc_signer_test3", signer_info["signed_attrs"].retag(17).dump(), key_type=CMC_KEYS_TYPE
+    signer_info["signature"] = await SignScheduler.call(
+        SIGN_PRIORITY_ISSUANCE,
+        "sign",
+        PKCS11SessionPool.sign,
+        CMC_SIGNING_KEY_LABEL,
+        signer_info["signed_attrs"].retag(17).dump(),
+        key_type=CMC_KEYS_TYPE,
+        lane=SIGN_LANE_POOL,
     )
 
     signed_data["signer_infos"] = asn1_cms.SignerInfos({signer_info})
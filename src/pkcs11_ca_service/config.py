@@ -1,9 +1,25 @@
 """Config module"""
 import os
+from typing import Dict
 
 # The PKCS11 backend, must be one of ["LUNAHSM", "SOFTHSM"]
 PKCS11_BACKEND = "SOFTHSM"
 
+# Number of logged-in PKCS11 sessions kept open for signing.
+# Override the default per token label in PKCS11_SESSION_POOL_SIZES, for example {"my_test_token_1": 8}
+PKCS11_SESSION_POOL_SIZE = 4
+PKCS11_SESSION_POOL_SIZES: Dict[str, int] = {}
+
+# With several tokens in the PKCS11_TOKENS env variable, a token is taken out of use for
+# PKCS11_SLOT_RETRY_SECONDS after PKCS11_SLOT_MAX_FAILURES failed operations in a row.
+# A key not found in a token is not looked for there again for PKCS11_SLOT_RETRY_SECONDS.
+PKCS11_SLOT_MAX_FAILURES = 3
+PKCS11_SLOT_RETRY_SECONDS = 30
+
+# Seconds the signing scheduler waits after the first job when idle to dispatch concurrent jobs together.
+# OCSP jobs are never held back, set to 0 to disable.
+SIGN_SCHEDULER_COALESCE_WINDOW = 0.001
+
 # LUNAHSM does not support EdDSA yet.
 if PKCS11_BACKEND == "LUNAHSM":
     KEY_TYPES = ["secp256r1", "secp384r1", "secp521r1", "rsa_2048", "rsa_4096"]
@@ -101,6 +117,81 @@ zIqw8k4ytIY=
 -----END CERTIFICATE-----""",
 ]
 
+# Validate our own /pkcs11_sign responses against the response schema, can be disabled in production.
+PKCS11_SIGN_VALIDATE_RESPONSE = True
+
+# Upper bounds in seconds of the HSM operation latency histogram buckets on /metrics
+HSM_LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# Streaming (application/x-ndjson) /pkcs11_sign, max documents being signed at the same time
+# and max length in bytes of one NDJSON line.
+PKCS11_SIGN_STREAM_WINDOW = 64
+PKCS11_SIGN_STREAM_MAX_LINE = 1024 * 1024
+
+# Cache signed OCSP responses to requests without a nonce, an entry lives for this fraction
+# of the time until the response's next_update. Revocation evicts the entry at once.
+OCSP_RESPONSE_CACHE_LIFETIME = 0.5
+OCSP_RESPONSE_CACHE_SIZE = 100000
+
+# Background pre-generation of nonce-less OCSP responses for all unexpired certificates, as RFC 6960
+# pre-produced responses. Every OCSP_PREGEN_INTERVAL seconds all certificates are walked and responses
+# not cached or expiring from the cache within OCSP_PREGEN_REFRESH_BEFORE seconds are signed at the lowest
+# signing priority. The signing rate is set so a walk is done in half of OCSP_PREGEN_REFRESH_BEFORE,
+# but never below OCSP_PREGEN_MIN_RATE per second.
+# At most OCSP_PREGEN_CACHE_SHARE of OCSP_RESPONSE_CACHE_SIZE certificates are pre-generated, the rest of
+# the cache is left for other requests. Certificates beyond that are signed when requested.
+# Set OCSP_PREGEN_INTERVAL to 0 to disable.
+OCSP_PREGEN_INTERVAL = 600
+OCSP_PREGEN_REFRESH_BEFORE = 3600 * 2
+OCSP_PREGEN_MIN_RATE = 20
+OCSP_PREGEN_CACHE_SHARE = 0.9
+
+# Max age in seconds of nonce-less GET /ocsp responses in HTTP caches and CDNs, RFC 5019.
+# Responses are never cached past their next_update, a revocation can take this long to show through a cache.
+OCSP_HTTP_MAX_AGE = 600
+
+# Also store the cached OCSP responses in the DB, for the standalone OCSP responder (ocsp_responder.py)
+# which serves them without a PKCS11 session. Revocation deletes the stored responses at once.
+# Every signed nonce-less response is then also written to the DB, so only set this to True
+# together with deploying ocsp_responder.py, without it the responder answers every request unauthorized.
+OCSP_RESPONSE_STORE = False
+
+# Delegated OCSP responders, RFC 6960 section 4.2.2.2. CA key label -> "hsm" or "software", for example
+# {"my_ROOT_CA_key_label_103": "software"}. The CA issues a responder certificate with the id-kp-OCSPSigning EKU,
+# valid for OCSP_RESPONDER_CERT_VALIDITY seconds and renewed OCSP_RESPONDER_CERT_RENEW_BEFORE seconds before it expires,
+# and the responder key signs the CA's OCSP responses. "hsm" keeps the responder key in the PKCS11 device,
+# "software" keeps it in memory only so OCSP signing does not use the HSM. Other CAs sign their OCSP responses.
+# OCSP_RESPONDER_CERT_RENEW_BEFORE must be longer than the OCSP responses' next_update, one day.
+# The two test key labels below are used by tests/test_ocsp_delegation.py.
+OCSP_DELEGATED_RESPONDERS: Dict[str, str] = {
+    "ocsp_delegated_software_test3": "software",
+    "ocsp_delegated_hsm_test3": "hsm",
+}
+OCSP_RESPONDER_KEY_TYPE = "secp256r1"  # Must be in KEY_TYPES above
+OCSP_RESPONDER_CERT_VALIDITY = 3600 * 24 * 4
+OCSP_RESPONDER_CERT_RENEW_BEFORE = 3600 * 24 * 2
+
+# Partitioned CRLs, RFC 5280 section 5.2.5. Certificates issued in the same CRL_PARTITION_PERIOD seconds share the
+# CRL at /crl/<CA path>/<partition> which their CDP points to and which has an Issuing Distribution Point extension,
+# so each CRL only grows with the revocations of certificates from its period.
+# The CA's complete CRL at /crl/<CA path> still lists all revocations. Set to 0 to not partition CRLs.
+CRL_PARTITION_PERIOD = 3600 * 24 * 30
+
+# Max partition CRLs and max delta CRLs kept signed in memory, the oldest is dropped when full.
+CRL_PARTITION_CACHE_SIZE = 1000
+
+# Delta CRLs, RFC 5280 section 5.2.4. Issued certificates get a Freshest CRL extension pointing to
+# /delta_crl/ which serves the revocations since the base CRL, signed on demand and valid for DELTA_CRL_LIFETIME
+# seconds.
+# Every DELTA_CRL_BASE_INTERVAL seconds the CA's complete CRL at /crl/ becomes the new base.
+# Set DELTA_CRL_LIFETIME to 0 to disable delta CRLs.
+DELTA_CRL_LIFETIME = 3600
+DELTA_CRL_BASE_INTERVAL = 3600 * 24
+
+# Max certificates and CAs in one POST /bulk_revoke request. All are validated before any is revoked
+# and each issuer's CRL is signed once for the whole request.
+BULK_REVOKE_MAX = 10000
+
 # Default CSR expire date.
 CSR_EXPIRE_DATE = 365 * 1
 
@@ -0,0 +1,108 @@
+"""Module which caches each CA's current CRL
+
+Relying parties fetch CRLs all the time. Loading the CRL from the DB and parsing it on every fetch is
+wasted work, so the current CRL is kept per CA as PEM and DER together with its next_update.
+An entry is used until its next_update and replaced whenever a new CRL is saved, see CRLCache.put.
+
+Exposes the class:
+- CRLCache
+"""
+import datetime
+from typing import Dict, Tuple, Union
+
+from asn1crypto import crl as asn1_crl
+from asn1crypto import pem as asn1_pem
+
+
+class CRLCache:
+    """Current CRL per CA"""
+
+    # CA DB serial -> (CRL PEM, CRL DER, next_update)
+    _crls: Dict[int, Tuple[str, bytes, datetime.datetime]] = {}
+
+    # CA path -> CA DB serial, for GET /crl and GET /delta_crl
+    _paths: Dict[str, int] = {}
+
+    @classmethod
+    def put(cls, ca_serial: int, crl_pem: str) -> None:
+        """Cache the CA's new CRL. Must be called when a new CRL for the CA is saved.
+
+        Parameters:
+        ca_serial (int): The CA's DB serial.
+        crl_pem (str): The CRL in PEM form.
+
+        Returns:
+        None
+        """
+
+        data = crl_pem.encode("utf-8")
+        if asn1_pem.detect(data):
+            _, _, data = asn1_pem.unarmor(data)
+        next_update: Union[datetime.datetime, None] = asn1_crl.CertificateList.load(data)["tbs_cert_list"][
+            "next_update"
+        ].native
+
+        # A CRL without next_update is checked against the DB every time
+        if next_update is None:
+            cls._crls.pop(ca_serial, None)
+            return
+        cls._crls[ca_serial] = (crl_pem, data, next_update)
+
+    @classmethod
+    def get(cls, ca_serial: int) -> Union[Tuple[str, bytes], None]:
+        """The CA's current CRL in PEM and DER form, None if not cached or past its next_update.
+
+        Parameters:
+        ca_serial (int): The CA's DB serial.
+
+        Returns:
+        Union[Tuple[str, bytes], None]
+        """
+
+        entry = cls._crls.get(ca_serial)
+        if entry is None or entry[2] < datetime.datetime.now(datetime.timezone.utc):
+            return None
+        return entry[0], entry[1]
+
+    @classmethod
+    def add_path(cls, path: str, ca_serial: int) -> None:
+        """Remember the CA's path so GET /crl finds the cached CRL without the DB.
+
+        Parameters:
+        path (str): The CA's path.
+        ca_serial (int): The CA's DB serial.
+
+        Returns:
+        None
+        """
+
+        cls._paths[path] = ca_serial
+
+    @classmethod
+    def get_by_path(cls, path: str) -> Union[Tuple[str, bytes], None]:
+        """The current CRL for the CA with the path, see CRLCache.get.
+
+        Parameters:
+        path (str): The CA's path.
+
+        Returns:
+        Union[Tuple[str, bytes], None]
+        """
+
+        ca_serial = cls._paths.get(path)
+        if ca_serial is None:
+            return None
+        return cls.get(ca_serial)
+
+    @classmethod
+    def ca_serial_by_path(cls, path: str) -> Union[int, None]:
+        """The DB serial of the CA with the path, None if unknown, see CRLCache.add_path.
+
+        Parameters:
+        path (str): The CA's path.
+
+        Returns:
+        Union[int, None]
+        """
+
+        return cls._paths.get(path)
@@ -0,0 +1,278 @@
+"""Module which creates and caches each CA's partitioned CRLs, RFC 5280 section 5.2.5
+
+A CA's complete CRL lists every certificate it has revoked and keeps growing. Certificates issued
+in the same CRL_PARTITION_PERIOD get a CDP pointing to their own partition CRL, see asn1.aia_and_cdp_exts,
+so a partition CRL only lists the revoked certificates from one period.
+
+The complete CRL is still re-signed on every revocation and a partition CRL is rendered from it when
+requested: the entries whose certificate's CDP points to the partition, an Issuing Distribution Point
+extension naming the partition and the complete CRL's CRL number. Each partition is signed and cached
+on its own and reused until it expires or the complete CRL changes.
+Partitions from before the CA's not_before have no certificates and are not served, and at most
+CRL_PARTITION_CACHE_SIZE partition CRLs are cached.
+
+Certificates issued before partitioning, or with partitioning disabled, are only on the complete CRL.
+
+Exposes the class:
+- CRLPartitions
+"""
+import asyncio
+import datetime
+from typing import Dict, List, Tuple, Union
+
+from asn1crypto import crl as asn1_crl
+from asn1crypto import pem as asn1_pem
+from asn1crypto import x509 as asn1_x509
+from cryptography.x509 import (
+    CRLDistributionPoints,
+    ExtensionNotFound,
+    UniformResourceIdentifier,
+    load_pem_x509_certificate,
+)
+from fastapi import HTTPException
+
+from .asn1 import cert_crl_partition, cert_pem_serial_number, crl_partition_path
+from .ca import Ca
+from .config import CRL_PARTITION_CACHE_SIZE, ROOT_URL
+from .crl_cache import CRLCache
+from .pkcs11_key import Pkcs11KeyInput
+from .revocation import sign_crl
+from .revoked_index import RevokedEntry, RevokedSerialIndex
+from .route_functions import crl_request, pkcs11_key_request
+
+
+async def complete_crl(issuer_obj: Ca) -> Tuple[str, asn1_crl.CertificateList]:
+    """The CA's current complete CRL in PEM and parsed form.
+
+    Parameters:
+    issuer_obj (Ca): The CA.
+
+    Returns:
+    Tuple[str, asn1crypto.crl.CertificateList]
+    """
+
+    # Set author as id 1 (first root ca) as in GET /crl if the complete CRL had expired
+    crl_pem = await crl_request(1, issuer_obj)
+    _, _, data = asn1_pem.unarmor(crl_pem.encode("utf-8"))
+    return crl_pem, asn1_crl.CertificateList.load(data)
+
+
+def issuing_distribution_point(url: str) -> asn1_crl.TBSCertListExtension:
+    """Create a critical Issuing Distribution Point extension with the URL as distribution point.
+
+    Parameters:
+    url (str): The CRL's URL.
+
+    Returns:
+    asn1crypto.crl.TBSCertListExtension
+    """
+
+    g_ns = asn1_x509.GeneralNames()
+    g_ns.append(asn1_x509.GeneralName(name="uniform_resource_identifier", value=url))
+    idp = asn1_crl.IssuingDistributionPoint()
+    idp["distribution_point"] = asn1_x509.DistributionPointName(name="full_name", value=g_ns)
+
+    idp_ext = asn1_crl.TBSCertListExtension()
+    idp_ext["extn_id"] = asn1_crl.TBSCertListExtensionId("2.5.29.28")
+    idp_ext["critical"] = True
+    idp_ext["extn_value"] = idp
+    return idp_ext
+
+
+def check_partition(issuer_obj: Ca, partition: int) -> None:
+    """Raise HTTPException 404 if the partition is from before the CA's not_before, it has no certificates.
+
+    Parameters:
+    issuer_obj (Ca): The CA.
+    partition (int): The CRL partition.
+
+    Returns:
+    None
+    """
+
+    first_partition = cert_crl_partition(issuer_obj.pem)
+    if first_partition is None or partition < first_partition:
+        raise HTTPException(status_code=404, detail="No such CRL partition")
+
+
+async def sign_crl_from_complete(  # pylint: disable=too-many-arguments
+    issuer_obj: Ca,
+    complete_crl_obj: asn1_crl.CertificateList,
+    revoked: Dict[int, RevokedEntry],
+    *,
+    next_update: datetime.datetime,
+    extra_extensions: List[asn1_crl.TBSCertListExtension],
+    operation: str,
+) -> bytes:
+    """Sign a CRL with the entries, the complete CRL's issuer, authority key identifier and CRL number
+    and the extra extensions, for partition and delta CRLs.
+
+    Parameters:
+    issuer_obj (Ca): The CA.
+    complete_crl_obj (asn1crypto.crl.CertificateList): The CA's current complete CRL.
+    revoked (Dict[int, RevokedEntry]): Serial number -> revocation time and reason.
+    next_update (datetime.datetime): The CRL's next_update.
+    extra_extensions (List[asn1crypto.crl.TBSCertListExtension]): Extensions to add.
+    operation (str): Operation name for the sign scheduler metrics.
+
+    Returns:
+    bytes
+    """
+
+    complete_tbs = complete_crl_obj["tbs_cert_list"]
+    issuer_pkcs11_key_obj = await pkcs11_key_request(Pkcs11KeyInput(serial=issuer_obj.pkcs11_key))
+
+    # Same authority key identifier and CRL number as the complete CRL
+    crl_exts = asn1_crl.TBSCertListExtensions()
+    for crl_ext in complete_tbs["crl_extensions"]:
+        if crl_ext["extn_id"].dotted in ("2.5.29.35", "2.5.29.20"):
+            crl_exts.append(crl_ext)
+    for crl_ext in extra_extensions:
+        crl_exts.append(crl_ext)
+
+    return await sign_crl(
+        issuer_pkcs11_key_obj.key_label,
+        issuer_pkcs11_key_obj.key_type,
+        complete_tbs["issuer"],
+        revoked,
+        next_update=next_update,
+        crl_extensions=crl_exts,
+        operation=operation,
+    )
+
+
+class CRLPartitions:
+    """Current partition CRLs per CA"""
+
+    # CA DB serial -> revoked serial number -> the partition in the certificate's CDP, None if not partitioned
+    _partitions: Dict[int, Dict[int, Union[int, None]]] = {}
+
+    # (CA DB serial, partition) -> (the complete CRL PEM the partition was created from, partition CRL DER, next_update)
+    _crls: Dict[Tuple[int, int], Tuple[str, bytes, datetime.datetime]] = {}
+
+    # One partition signing at a time per CA and partition
+    _locks: Dict[Tuple[int, int], asyncio.Lock] = {}
+
+    @classmethod
+    def _put(cls, key: Tuple[int, int], entry: Tuple[str, bytes, datetime.datetime]) -> None:
+        # Drop the oldest entry and its lock if full
+        if key not in cls._crls and len(cls._crls) >= CRL_PARTITION_CACHE_SIZE:
+            oldest = next(iter(cls._crls))
+            del cls._crls[oldest]
+            if oldest in cls._locks and not cls._locks[oldest].locked():
+                del cls._locks[oldest]
+        cls._crls[key] = entry
+
+    @classmethod
+    def _cdp_partition(cls, issuer_path: str, pem: str) -> Union[int, None]:
+        try:
+            cdp = load_pem_x509_certificate(pem.encode("utf-8")).extensions.get_extension_for_class(
+                CRLDistributionPoints
+            )
+        except ExtensionNotFound:
+            return None
+
+        prefix = ROOT_URL + "/crl/" + issuer_path + "/"
+        for dist_point in cdp.value:
+            for name in dist_point.full_name or []:
+                if isinstance(name, UniformResourceIdentifier) and name.value.startswith(prefix):
+                    try:
+                        return int(name.value[len(prefix) :])
+                    except ValueError:
+                        return None
+        return None
+
+    @classmethod
+    async def revoked(
+        cls,
+        issuer_obj: Ca,
+        crl_pem: str,
+        partition: int,
+        since: datetime.datetime = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc),
+    ) -> Dict[int, RevokedEntry]:
+        """The entries in the CA's CRL for certificates in the partition revoked at or after since.
+
+        Parameters:
+        issuer_obj (Ca): The CA.
+        crl_pem (str): The CA's current complete CRL in PEM form.
+        partition (int): The CRL partition.
+        since (datetime.datetime): Earliest revocation time, default all.
+
+        Returns:
+        Dict[int, RevokedEntry]
+        """
+
+        revoked = RevokedSerialIndex.revoked_since(issuer_obj.serial, crl_pem, since)
+
+        # Read the partition from the certificate of each new revoked serial number, once
+        partitions = cls._partitions.setdefault(issuer_obj.serial, {})
+        unknown = [serial_number for serial_number in revoked if serial_number not in partitions]
+        if len(unknown) > 0:
+            for pem in await issuer_obj.db.issued_pems(issuer_obj.serial, unknown):
+                partitions[cert_pem_serial_number(pem)] = cls._cdp_partition(issuer_obj.path, pem)
+            for serial_number in unknown:
+                partitions.setdefault(serial_number, None)
+
+        return {
+            serial_number: entry for serial_number, entry in revoked.items() if partitions[serial_number] == partition
+        }
+
+    @classmethod
+    def get(cls, ca_serial: int, partition: int) -> Union[bytes, None]:
+        """The CA's cached partition CRL in DER form, None if not cached, expired or the complete CRL changed.
+
+        Parameters:
+        ca_serial (int): The CA's DB serial.
+        partition (int): The CRL partition.
+
+        Returns:
+        Union[bytes, None]
+        """
+
+        entry = cls._crls.get((ca_serial, partition))
+        if entry is None or entry[2] < datetime.datetime.now(datetime.timezone.utc):
+            return None
+
+        complete_crl_data = CRLCache.get(ca_serial)
+        if complete_crl_data is None or complete_crl_data[0] != entry[0]:
+            return None
+        return entry[1]
+
+    @classmethod
+    async def create(cls, issuer_obj: Ca, partition: int) -> bytes:
+        """The CA's current partition CRL in DER form, signed if the cached one can not be used.
+
+        Parameters:
+        issuer_obj (Ca): The CA.
+        partition (int): The CRL partition.
+
+        Returns:
+        bytes
+        """
+
+        check_partition(issuer_obj, partition)
+
+        key = (issuer_obj.serial, partition)
+        if key not in cls._locks:
+            cls._locks[key] = asyncio.Lock()
+
+        async with cls._locks[key]:
+            # Created while we waited for the lock
+            cached = cls.get(issuer_obj.serial, partition)
+            if cached is not None:
+                return cached
+
+            complete_crl_pem, complete_crl_obj = await complete_crl(issuer_obj)
+            partition_url = ROOT_URL + "/crl/" + crl_partition_path(issuer_obj.path, partition)
+            next_update: datetime.datetime = complete_crl_obj["tbs_cert_list"]["next_update"].native
+
+            crl_der = await sign_crl_from_complete(
+                issuer_obj,
+                complete_crl_obj,
+                await cls.revoked(issuer_obj, complete_crl_pem, partition),
+                next_update=next_update,
+                extra_extensions=[issuing_distribution_point(partition_url)],
+                operation="create_partition_crl",
+            )
+            cls._put(key, (complete_crl_pem, crl_der, next_update))
+            return crl_der
@@ -0,0 +1,151 @@
+"""Module which creates and caches each CA's delta CRLs, RFC 5280 section 5.2.4
+
+The complete CRL, at /crl/, is still re-signed on every revocation since OCSP and is_revoked use it.
+A delta CRL lists only the entries revoked since the base CRL so clients holding the base
+download a few entries instead of the whole list.
+
+The CA's complete CRL becomes the base every DELTA_CRL_BASE_INTERVAL seconds. The delta has the
+same CRL number as the complete CRL it is created from, RFC 5280 section 5.2.3 allows this since both
+have the same revocation information, and the base's CRL number in its Delta CRL Indicator extension.
+A delta is created when requested and reused until it expires or the complete CRL changes,
+at most CRL_PARTITION_CACHE_SIZE deltas are cached.
+
+A delta CRL must have the same scope as its base, so each CRL partition has its own delta CRL
+with the partition's entries and Issuing Distribution Point, see crl_partitions.
+
+Exposes the class:
+- DeltaCRLs
+"""
+import asyncio
+import datetime
+import time
+from typing import Dict, Tuple, Union
+
+from asn1crypto import crl as asn1_crl
+
+from .asn1 import crl_partition_path
+from .ca import Ca
+from .config import (
+    CRL_PARTITION_CACHE_SIZE,
+    DELTA_CRL_BASE_INTERVAL,
+    DELTA_CRL_LIFETIME,
+    ROOT_URL,
+)
+from .crl_cache import CRLCache
+from .crl_partitions import (
+    CRLPartitions,
+    check_partition,
+    complete_crl,
+    issuing_distribution_point,
+    sign_crl_from_complete,
+)
+from .revoked_index import RevokedSerialIndex
+
+
+class DeltaCRLs:
+    """Current delta CRLs per CA"""
+
+    # CA DB serial -> (base CRL number, base this_update, time.monotonic() when it became the base)
+    _bases: Dict[int, Tuple[int, datetime.datetime, float]] = {}
+
+    # (CA DB serial, partition) -> (the complete CRL PEM the delta was created from, delta CRL DER, next_update)
+    _deltas: Dict[Tuple[int, Union[int, None]], Tuple[str, bytes, datetime.datetime]] = {}
+
+    # One delta signing at a time per CA and partition
+    _locks: Dict[Tuple[int, Union[int, None]], asyncio.Lock] = {}
+
+    @classmethod
+    def _put(cls, key: Tuple[int, Union[int, None]], entry: Tuple[str, bytes, datetime.datetime]) -> None:
+        # Drop the oldest entry and its lock if full
+        if key not in cls._deltas and len(cls._deltas) >= CRL_PARTITION_CACHE_SIZE:
+            oldest = next(iter(cls._deltas))
+            del cls._deltas[oldest]
+            if oldest in cls._locks and not cls._locks[oldest].locked():
+                del cls._locks[oldest]
+        cls._deltas[key] = entry
+
+    @classmethod
+    def get(cls, ca_serial: int, partition: Union[int, None] = None) -> Union[bytes, None]:
+        """The CA's cached delta CRL in DER form, None if not cached, expired or the complete CRL changed.
+
+        Parameters:
+        ca_serial (int): The CA's DB serial.
+        partition (Union[int, None] = None): The CRL partition, None for the complete CRL's delta.
+
+        Returns:
+        Union[bytes, None]
+        """
+
+        entry = cls._deltas.get((ca_serial, partition))
+        if entry is None or entry[2] < datetime.datetime.now(datetime.timezone.utc):
+            return None
+
+        complete_crl_data = CRLCache.get(ca_serial)
+        if complete_crl_data is None or complete_crl_data[0] != entry[0]:
+            return None
+
+        base = cls._bases.get(ca_serial)
+        if base is None or base[2] + DELTA_CRL_BASE_INTERVAL <= time.monotonic():
+            return None
+        return entry[1]
+
+    @classmethod
+    async def create(cls, issuer_obj: Ca, partition: Union[int, None] = None) -> bytes:
+        """The CA's current delta CRL in DER form, signed if the cached one can not be used.
+
+        Parameters:
+        issuer_obj (Ca): The CA.
+        partition (Union[int, None] = None): The CRL partition, None for the complete CRL's delta.
+
+        Returns:
+        bytes
+        """
+
+        if partition is not None:
+            check_partition(issuer_obj, partition)
+
+        key = (issuer_obj.serial, partition)
+        if key not in cls._locks:
+            cls._locks[key] = asyncio.Lock()
+
+        async with cls._locks[key]:
+            # Created while we waited for the lock
+            cached = cls.get(issuer_obj.serial, partition)
+            if cached is not None:
+                return cached
+
+            complete_crl_pem, complete_crl_obj = await complete_crl(issuer_obj)
+
+            base = cls._bases.get(issuer_obj.serial)
+            if base is None or base[2] + DELTA_CRL_BASE_INTERVAL <= time.monotonic():
+                base = (
+                    complete_crl_obj.crl_number_value.native,
+                    complete_crl_obj["tbs_cert_list"]["this_update"].native,
+                    time.monotonic(),
+                )
+                cls._bases[issuer_obj.serial] = base
+
+            delta_crl_indicator = asn1_crl.TBSCertListExtension()
+            delta_crl_indicator["extn_id"] = asn1_crl.TBSCertListExtensionId("2.5.29.27")
+            delta_crl_indicator["critical"] = True
+            delta_crl_indicator["extn_value"] = base[0]
+            extra_extensions = [delta_crl_indicator]
+
+            if partition is None:
+                revoked = RevokedSerialIndex.revoked_since(issuer_obj.serial, complete_crl_pem, base[1])
+            else:
+                revoked = await CRLPartitions.revoked(issuer_obj, complete_crl_pem, partition, base[1])
+                partition_url = ROOT_URL + "/crl/" + crl_partition_path(issuer_obj.path, partition)
+                extra_extensions.append(issuing_distribution_point(partition_url))
+
+            next_update = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=DELTA_CRL_LIFETIME)
+            delta_crl_der = await sign_crl_from_complete(
+                issuer_obj,
+                complete_crl_obj,
+                revoked,
+                next_update=next_update,
+                extra_extensions=extra_extensions,
+                operation="create_delta_crl",
+            )
+            cls._put(key, (complete_crl_pem, delta_crl_der, next_update))
+            return delta_crl_der
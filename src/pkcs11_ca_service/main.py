@@ -4,7 +4,7 @@ import base64
 import hashlib
 import os
 from secrets import token_bytes
-from typing import Dict, Union
+from typing import Dict, List, Tuple, Union
 
 from asn1crypto import x509 as asn1_x509
 from cryptography.exceptions import InvalidSignature
@@ -14,7 +14,6 @@ from fastapi.responses import JSONResponse
 from pkcs11.exceptions import MultipleObjectsReturned
 from python_x509_pkcs11.ca import create as create_ca
 from python_x509_pkcs11.crl import create as create_crl
-from python_x509_pkcs11.pkcs11_handle import PKCS11Session
 
 from .acme_lib import NoSuchKID, handle_acme_routes
 from .asn1 import (
@@ -22,34 +21,52 @@ from .asn1 import (
     cert_as_der,
     cert_pem_serial_number,
     crl_as_der,
+    current_crl_partition,
     pem_cert_to_name_dict,
     public_key_pem_from_csr,
 )
 from .auth import authorized_by
-from .base import InputObject, db_load_data_class
+from .base import InputObject, db_load_data_class, db_load_data_class_any
 from .ca import Ca, CaInput
 from .ca import search as ca_search
 from .certificate import Certificate, CertificateInput
 from .certificate import search as certificate_search
 from .cmc import cmc_handle_request
-from .config import ACME_ROOT, KEY_TYPES, PKCS11_SIGN_API_TOKEN, ROOT_URL
+from .config import (
+    ACME_ROOT,
+    BULK_REVOKE_MAX,
+    DELTA_CRL_LIFETIME,
+    KEY_TYPES,
+    PKCS11_SIGN_API_TOKEN,
+    ROOT_URL,
+)
 from .crl import Crl, CrlInput
 from .crl import search as crl_search
+from .crl_cache import CRLCache
+from .crl_partitions import CRLPartitions
 from .csr import Csr, CsrInput
 from .csr import search as csr_search
+from .delta_crl import DeltaCRLs
+from .metrics import hsm_timer
 from .nonce import nonce_response
-from .ocsp import ocsp_response
+from .ocsp import ocsp_not_modified, ocsp_response, ocsp_response_http_headers
+from .ocsp_issuers import OCSPIssuerCache
 from .pkcs11_key import Pkcs11Key, Pkcs11KeyInput
-from .pkcs11_sign import pkcs11_sign
+from .pkcs11_pool import PKCS11SessionPool
+from .pkcs11_sign import pkcs11_sign, pkcs11_sign_stream
 from .public_key import PublicKey, PublicKeyInput
 from .public_key import search as public_key_search
+from .revocation import CRL_REASONS
 from .route_functions import (
     ca_request,
     crl_request,
     healthcheck,
+    metrics,
     pkcs11_key_request,
+    revoke_bulk,
     sign_csr,
 )
+from .sign_scheduler import SIGN_LANE_LIBRARY, SIGN_PRIORITY_ISSUANCE, SignScheduler
 from .startup import startup
 
 if "_" in os.environ and "sphinx-build" in os.environ["_"]:
@@ -102,6 +119,29 @@ async def get_healthcheck(request: Request) -> JSONResponse:
     return await healthcheck()
 
 
+@app.get("/metrics")
+async def get_metrics(request: Request) -> Response:
+    """/metrics, GET method.
+
+    HSM and signing metrics in the Prometheus text format.
+    Uses the same bearer token as /pkcs11_sign.
+
+    Parameters:
+    request (fastapi.Request): The entire HTTP request.
+
+    Returns:
+    fastapi.Response
+    """
+
+    if not _pkcs11_sign_api_token_ok(request):
+        return JSONResponse(
+            status_code=401,
+            content={"message": "Missing valid authorization token"},
+        )
+
+    return await metrics()
+
+
 @app.get("/search/public_key")
 async def get_public_key_search(request: Request) -> JSONResponse:
     """/search/public_key, GET method.
@@ -365,12 +405,14 @@ async def post_ocsp(request: Request) -> Response:
 
 
 @app.get("/ocsp/{ocsp_path:path}")
-async def get_ocsp(ocsp_path: str) -> Response:
+async def get_ocsp(request: Request, ocsp_path: str) -> Response:
     """/ocsp, GET method.
 
     Return an OCSP response.
+    Responses without a nonce have RFC 5019 caching headers and support conditional requests.
 
     Parameters:
+    request (fastapi.Request): The entire HTTP request.
     ocsp_path (str): OCSP path.
 
     Returns:
@@ -381,7 +423,10 @@ async def get_ocsp(ocsp_path: str) -> Response:
     path = ocsp_path.replace("/ocsp/", "").encode("utf-8")
     try:
         ocsp_data = await ocsp_response(path, encoded=True)
-        return Response(status_code=200, content=ocsp_data, media_type="application/ocsp-response")
+        headers = ocsp_response_http_headers(ocsp_data)
+        if ocsp_not_modified(request.headers.get("If-None-Match"), request.headers.get("If-Modified-Since"), headers):
+            return Response(status_code=304, headers=headers)
+        return Response(status_code=200, content=ocsp_data, media_type="application/ocsp-response", headers=headers)
     except HTTPException:
         return Response(status_code=404, content='{"detail":"Not Found"}', media_type="application/json")
 
@@ -400,17 +445,116 @@ async def get_crl(crl_path: str) -> Response:
     """
 
     path = crl_path.replace("/crl/", "")
+
+    # No DB work or parsing while the CA's cached CRL is current
+    cached = CRLCache.get_by_path(path)
+    if cached is not None:
+        return Response(status_code=200, content=cached[1], media_type="application/pkix-crl")
+
     try:
         issuer_obj = await ca_request(CaInput(path=path))
         # Set author as id 1 (first root ca) if the CRL is created due to the old crl expired
         # author is unknow due to no authentication so lets set the system as author.
         # Perhaps rethink this in the future
         crl_pem = await crl_request(1, issuer_obj)
+        CRLCache.add_path(path, issuer_obj.serial)
         return Response(status_code=200, content=crl_as_der(crl_pem), media_type="application/pkix-crl")
     except HTTPException:
         return Response(status_code=404, content='{"detail":"Not Found"}', media_type="application/json")
 
 
+@app.get("/crl/{crl_path}/{partition}")
+async def get_crl_partition(crl_path: str, partition: int) -> Response:
+    """/crl partition, GET method.
+
+    Get a partition CRL, the revocations of the CA's certificates in the partition.
+
+    Parameters:
+    crl_path (str): The unique CRL path.
+    partition (int): The CRL partition.
+
+    Returns:
+    fastapi.Response
+    """
+
+    current_partition = current_crl_partition()
+    if current_partition is None or partition < 0 or partition > current_partition:
+        return Response(status_code=404, content='{"detail":"Not Found"}', media_type="application/json")
+
+    # No DB work or signing while the CA's cached partition CRL is current
+    ca_serial = CRLCache.ca_serial_by_path(crl_path)
+    if ca_serial is not None:
+        cached = CRLPartitions.get(ca_serial, partition)
+        if cached is not None:
+            return Response(status_code=200, content=cached, media_type="application/pkix-crl")
+
+    try:
+        issuer_obj = await ca_request(CaInput(path=crl_path))
+        partition_crl = await CRLPartitions.create(issuer_obj, partition)
+        CRLCache.add_path(crl_path, issuer_obj.serial)
+        return Response(status_code=200, content=partition_crl, media_type="application/pkix-crl")
+    except HTTPException:
+        return Response(status_code=404, content='{"detail":"Not Found"}', media_type="application/json")
+
+
+async def _delta_crl_response(path: str, partition: Union[int, None]) -> Response:
+    if DELTA_CRL_LIFETIME <= 0:
+        return Response(status_code=404, content='{"detail":"Not Found"}', media_type="application/json")
+
+    if partition is not None:
+        current_partition = current_crl_partition()
+        if current_partition is None or partition < 0 or partition > current_partition:
+            return Response(status_code=404, content='{"detail":"Not Found"}', media_type="application/json")
+
+    # No DB work or signing while the CA's cached delta CRL is current
+    ca_serial = CRLCache.ca_serial_by_path(path)
+    if ca_serial is not None:
+        cached = DeltaCRLs.get(ca_serial, partition)
+        if cached is not None:
+            return Response(status_code=200, content=cached, media_type="application/pkix-crl")
+
+    try:
+        issuer_obj = await ca_request(CaInput(path=path))
+        delta_crl = await DeltaCRLs.create(issuer_obj, partition)
+        CRLCache.add_path(path, issuer_obj.serial)
+        return Response(status_code=200, content=delta_crl, media_type="application/pkix-crl")
+    except HTTPException:
+        return Response(status_code=404, content='{"detail":"Not Found"}', media_type="application/json")
+
+
+@app.get("/delta_crl/{crl_path}")
+async def get_delta_crl(crl_path: str) -> Response:
+    """/delta_crl, GET method.
+
+    Get a delta CRL, the revocations since the CA's base CRL.
+
+    Parameters:
+    crl_path (str): The unique CRL path.
+
+    Returns:
+    fastapi.Response
+    """
+
+    return await _delta_crl_response(crl_path.replace("/delta_crl/", ""), None)
+
+
+@app.get("/delta_crl/{crl_path}/{partition}")
+async def get_delta_crl_partition(crl_path: str, partition: int) -> Response:
+    """/delta_crl partition, GET method.
+
+    Get a partition's delta CRL, the revocations in the partition since the CA's base CRL.
+
+    Parameters:
+    crl_path (str): The unique CRL path.
+    partition (int): The CRL partition.
+
+    Returns:
+    fastapi.Response
+    """
+
+    return await _delta_crl_response(crl_path, partition)
+
+
 @app.get("/ca/{ca_path}")
 async def get_ca(ca_path: str) -> Response:
     """/ca, GET method.
@@ -482,25 +626,31 @@ async def post_ca(request: Request, ca_input: CaInput) -> JSONResponse:  # pylin
         extra_extensions = aia_and_cdp_exts(issuer_obj.path)
 
     try:
-        ca_csr_pem, ca_pem = await create_ca(
-            ca_input.key_label,
-            ca_input.name_dict,
-            signer_key_label=issuer_key_label,
-            signer_key_type=issuer_key_type,
-            signer_subject_name=issuer_pem,
-            extra_extensions=extra_extensions,
-            key_type=key_type,
-        )
+        with hsm_timer("create_ca", ca_input.key_label, key_type):
+            ca_csr_pem, ca_pem = await create_ca(
+                ca_input.key_label,
+                ca_input.name_dict,
+                signer_key_label=issuer_key_label,
+                signer_key_type=issuer_key_type,
+                signer_subject_name=issuer_pem,
+                extra_extensions=extra_extensions,
+                key_type=key_type,
+            )
     except MultipleObjectsReturned:
         return JSONResponse(
             status_code=400,
             content={"message": f"key_label '{ca_input.key_label}' already exists"},
         )
+    finally:
+        # create_ca creates a new key with this label, drop any stale cached handles for it
+        PKCS11SessionPool.forget_key(ca_input.key_label, key_type)
 
     # Save Public key for new CA
+    with hsm_timer("public_key_data", ca_input.key_label, key_type):
+        ca_public_key_pem, _ = await PKCS11SessionPool.public_key_data(ca_input.key_label, key_type=key_type)
     public_key_obj = PublicKey(
         {
-            "pem": (await PKCS11Session.public_key_data(ca_input.key_label, key_type=key_type))[0],
+            "pem": ca_public_key_pem,
             "authorized_by": auth_by,
         }
     )
@@ -553,14 +703,23 @@ async def post_ca(request: Request, ca_input: CaInput) -> JSONResponse:  # pylin
     # Create an empty CRL for the CA
     await Crl(
         {
-            "pem": await create_crl(
-                ca_input.key_label, pem_cert_to_name_dict(ca_pem), key_type=pkcs11_key_obj.key_type
+            "pem": await SignScheduler.call(
+                SIGN_PRIORITY_ISSUANCE,
+                "create_crl",
+                create_crl,
+                ca_input.key_label,
+                pem_cert_to_name_dict(ca_pem),
+                key_type=pkcs11_key_obj.key_type,
+                lane=SIGN_LANE_LIBRARY,
             ),
             "authorized_by": auth_by,
             "issuer": ca_obj.serial,
         }
     ).save()
 
+    # A new CA may reuse the key of an already resolved OCSP issuer
+    OCSPIssuerCache.clear()
+
     return JSONResponse(status_code=200, content={"certificate": ca_pem})
 
 
@@ -688,21 +847,95 @@ async def post_revoke(request: Request, revoke_input: RevokeInput) -> JSONRespon
     )
 
 
-@app.post("/pkcs11_sign")
-async def post_pkcs11_sign(request: Request) -> JSONResponse:
-    """/pkcs11_sign, POST method."""
+class BulkRevokeInput(InputObject):
+    """Class to represent bulk revoke specification matching from HTTP post data"""
+
+    revocations: List[RevokeInput]
+
+
+async def _revoke_targets(pems: List[str]) -> Dict[str, Union[Certificate, Ca]]:
+    # PEM -> certificate or CA, one DB query for the certificates and one for the CAs
+    targets: Dict[str, Union[Certificate, Ca]] = {}
+    for obj in await db_load_data_class_any(Certificate, "pem", list(set(pems))):
+        if isinstance(obj, Certificate):
+            targets[obj.pem] = obj
+    for obj in await db_load_data_class_any(Ca, "pem", list({pem for pem in pems if pem not in targets})):
+        if isinstance(obj, Ca):
+            targets[obj.pem] = obj
+    return targets
+
+
+@app.post("/bulk_revoke")
+async def post_bulk_revoke(request: Request, bulk_revoke_input: BulkRevokeInput) -> JSONResponse:
+    """/bulk_revoke, POST method.
+
+    Revoke many certificates/CAs, each issuer's CRL is signed once.
+    All are validated first, if one is unknown or has an invalid reason nothing is revoked.
+
+    Parameters:
+    request (fastapi.Request): The entire HTTP request.
+    bulk_revoke_input (BulkRevokeInput): The revoke specifications
+
+    Returns:
+    fastapi.responses.JSONResponse
+    """
+
+    auth_by = await authorized_by(request)
+
+    if len(bulk_revoke_input.revocations) > BULK_REVOKE_MAX:
+        return JSONResponse(
+            status_code=400,
+            content={"message": f"At most {BULK_REVOKE_MAX} revocations per request"},
+        )
+
+    revoke_targets = await _revoke_targets([revoke_input.pem for revoke_input in bulk_revoke_input.revocations])
+    targets: List[Tuple[Union[Certificate, Ca], Union[int, None]]] = []
+    for revoke_input in bulk_revoke_input.revocations:
+        if revoke_input.reason is not None and revoke_input.reason not in CRL_REASONS:
+            return JSONResponse(
+                status_code=400,
+                content={"message": f"CRL reason must be in {CRL_REASONS}", "pem": revoke_input.pem},
+            )
 
-    if (
+        obj = revoke_targets.get(revoke_input.pem)
+        if obj is None:
+            return JSONResponse(
+                status_code=400,
+                content={"message": "No such certificate or CA", "pem": revoke_input.pem},
+            )
+        targets.append((obj, revoke_input.reason))
+
+    await revoke_bulk(auth_by, targets)
+    return JSONResponse(
+        status_code=200,
+        content={"revoked": [revoke_input.pem for revoke_input in bulk_revoke_input.revocations]},
+    )
+
+
+def _pkcs11_sign_api_token_ok(request: Request) -> bool:
+    return not (
         "Authorization" not in request.headers
         or "Bearer " not in request.headers["Authorization"]
         or base64.b64decode(request.headers["Authorization"].split("Bearer ", maxsplit=1)[1])
         != PKCS11_SIGN_API_TOKEN.encode("utf-8")
-    ):
+    )
+
+
+@app.post("/pkcs11_sign")
+async def post_pkcs11_sign(request: Request) -> Response:
+    """/pkcs11_sign, POST method.
+    Send 'Content-Type: application/x-ndjson' to stream the documents and signatures as NDJSON.
+    """
+
+    if not _pkcs11_sign_api_token_ok(request):
         return JSONResponse(
             status_code=401,
             content={"message": "Missing valid authorization token"},
         )
 
+    if request.headers.get("Content-Type", "").startswith("application/x-ndjson"):
+        return await pkcs11_sign_stream(request.stream())
+
     data = await request.json()
     return await pkcs11_sign(data)
 
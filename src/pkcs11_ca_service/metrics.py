@@ -0,0 +1,140 @@
+"""Module which records HSM operation metrics
+
+Latency histograms and error counters per (operation, key_label, key_type),
+exported in the Prometheus text format by the /metrics endpoint.
+
+Key labels come from client requests, so a key is only recorded under its own label once an
+operation with it has succeeded. Failures for keys never seen working, like a made up label,
+are recorded under the "unknown" label and key type to keep the number of series bounded.
+"""
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Set, Tuple, Union
+
+from .config import HSM_LATENCY_BUCKETS
+
+
+class _Histogram:  # pylint: disable=too-few-public-methods
+    """Cumulative latency histogram with the HSM_LATENCY_BUCKETS upper bounds"""
+
+    def __init__(self) -> None:
+        self.buckets = [0] * len(HSM_LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Add one observation.
+
+        Parameters:
+        value (float): The observed value.
+
+        Returns:
+        None
+        """
+
+        for index, bound in enumerate(HSM_LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+# (operation, key_label, key_type) -> latency histogram
+hsm_latency: Dict[Tuple[str, str, str], _Histogram] = {}
+
+# (operation, key_label, key_type, error class name) -> count
+hsm_errors: Dict[Tuple[str, str, str, str], int] = {}
+
+# (key_label, key_type) of the keys an operation has succeeded with
+_known_keys: Set[Tuple[str, str]] = set()
+
+UNKNOWN_KEY_LABEL = "unknown"
+
+
+@contextmanager
+def hsm_timer(operation: str, key_label: str, key_type: str) -> Iterator[None]:
+    """Time the HSM operation in the with block, count it as an error if it raises.
+    A failure for a key no operation has succeeded with is recorded under UNKNOWN_KEY_LABEL.
+
+    Parameters:
+    operation (str): The operation, for example 'sign' or 'create_crl'.
+    key_label (str): Keypair label.
+    key_type (str): Key type.
+
+    Returns:
+    Iterator[None]
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as exc:
+        key = (key_label, key_type) if (key_label, key_type) in _known_keys else (UNKNOWN_KEY_LABEL, UNKNOWN_KEY_LABEL)
+        error_key = (operation, *key, type(exc).__name__)
+        hsm_errors[error_key] = hsm_errors.get(error_key, 0) + 1
+        hsm_latency.setdefault((operation, *key), _Histogram()).observe(time.perf_counter() - start)
+        raise
+
+    # The key exists, record it under its own label from now on
+    _known_keys.add((key_label, key_type))
+    hsm_latency.setdefault((operation, key_label, key_type), _Histogram()).observe(time.perf_counter() - start)
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+
+    escaped = {
+        name: value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for name, value in labels.items()
+    }
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
+
+
+def prometheus_lines(
+    name: str, metric_type: str, help_text: str, samples: List[Tuple[Dict[str, str], Union[int, float]]]
+) -> List[str]:
+    """A metric in the Prometheus text format.
+
+    Parameters:
+    name (str): Metric name.
+    metric_type (str): 'counter', 'gauge' or 'histogram'.
+    help_text (str): Description of the metric.
+    samples (List[Tuple[Dict[str, str], Union[int, float]]]): Labels and value of each sample.
+
+    Returns:
+    List[str]
+    """
+
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(labels)} {value}")
+    return lines
+
+
+def hsm_metrics_lines() -> List[str]:
+    """The HSM latency histograms and error counters in the Prometheus text format.
+
+    Returns:
+    List[str]
+    """
+
+    name = "pkcs11_ca_hsm_operation_seconds"
+    lines = prometheus_lines(name, "histogram", "HSM operation latency in seconds.", [])
+    for (operation, key_label, key_type), histogram in sorted(hsm_latency.items()):
+        labels = {"operation": operation, "key_label": key_label, "key_type": key_type}
+        for bound, count in zip(HSM_LATENCY_BUCKETS, histogram.buckets):
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': str(bound)})} {count}")
+        lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {histogram.count}")
+        lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+
+    lines += prometheus_lines(
+        "pkcs11_ca_hsm_operation_errors_total",
+        "counter",
+        "Failed HSM operations.",
+        [
+            ({"operation": operation, "key_label": key_label, "key_type": key_type, "error": error}, count)
+            for (operation, key_label, key_type, error), count in sorted(hsm_errors.items())
+        ],
+    )
+    return lines
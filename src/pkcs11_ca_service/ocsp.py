@@ -1,42 +1,71 @@
 """OCSP functions"""
 import datetime
+import hashlib
 from binascii import Error as binasciiError
-from typing import Dict, List, Tuple, Union
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Dict, List, Tuple, Union
 
+from asn1crypto import algos as asn1_algos
 from asn1crypto import core as asn1_core
 from asn1crypto import ocsp as asn1_ocsp
 from fastapi import HTTPException
 from python_x509_pkcs11.ocsp import request_nonce, response
-from python_x509_pkcs11.pkcs11_handle import PKCS11Session
 
 from .asn1 import (
     cert_is_self_signed,
-    cert_revoked,
-    cert_revoked_time,
     ocsp_decode,
     pem_cert_to_key_hash,
 )
+from .base import DataClassObject
 from .ca import CaInput
+from .config import OCSP_HTTP_MAX_AGE, OCSP_RESPONSE_STORE
+from .ocsp_cache import CacheKey, OCSPResponseCache
+from .ocsp_delegation import OCSPDelegatedResponders
+from .ocsp_issuers import OCSPIssuerCache, ResolvedIssuer
 from .pkcs11_key import Pkcs11KeyInput
 from .public_key import PublicKeyInput
+from .revoked_index import RevokedSerialIndex
 from .route_functions import (
     ca_request,
     crl_request,
     pkcs11_key_request,
     public_key_request,
 )
+from .sign_scheduler import (
+    SIGN_LANE_LIBRARY,
+    SIGN_PRIORITY_BACKGROUND,
+    SIGN_PRIORITY_OCSP,
+    SignScheduler,
+)
+
+
+class _RawResponseDataExtension(asn1_ocsp.ResponseDataExtension):  # type: ignore
+    """ResponseDataExtension with extn_value as a plain OCTET STRING.
+    Echoes the nonce in the encoding used by clients sending it without the inner OCTET STRING.
+    """
 
-# Sign the request with the key for the first single request
+    _fields = [
+        ("extn_id", asn1_ocsp.ResponseDataExtensionId),
+        ("critical", asn1_core.Boolean, {"default": False}),
+        ("extn_value", asn1_core.OctetString),
+    ]
+    _oid_pair = None
+    _oid_nums = None
+    _oid_specs: Dict[str, Any] = {}
+
+
+# The single requests are grouped by issuer and the first issuer we know signs the response,
 # single requests for certificates by another CA will get unknown status
-# PERHAPS redo this in the future
 
 
-async def _ocsp_check_valid_cert(
-    req: asn1_ocsp.Request,
-) -> Tuple[str, str, List[str], Union[Dict[str, str], bytes], asn1_ocsp.CertStatus]:
-    public_key_obj = await public_key_request(
-        PublicKeyInput(fingerprint=req["req_cert"]["issuer_key_hash"].native.hex())
-    )
+async def _resolve_issuer(issuer_key_hash: bytes) -> ResolvedIssuer:
+    resolved = OCSPIssuerCache.get(issuer_key_hash)
+    if resolved is not None:
+        return resolved
+
+    generation = OCSPIssuerCache.generation
+
+    public_key_obj = await public_key_request(PublicKeyInput(fingerprint=issuer_key_hash.hex()))
     pkcs11_key_obj = await pkcs11_key_request(Pkcs11KeyInput(public_key=public_key_obj.serial))
     issuer_obj = await ca_request(CaInput(pkcs11_key=pkcs11_key_obj.serial))
 
@@ -46,69 +75,78 @@ async def _ocsp_check_valid_cert(
     if not cert_is_self_signed(issuer_obj.pem):
         chain.append(await issuer_obj.issuer_pem())
 
-    # If cert is revoked
-    crl = await crl_request(1, issuer_obj)
-    if cert_revoked(req["req_cert"]["serial_number"].native, crl):
-        revoked_info = asn1_ocsp.RevokedInfo()
-        revoked_info["revocation_time"], revoked_info["revocation_reason"] = cert_revoked_time(
-            req["req_cert"]["serial_number"].native, crl
-        )
-        return (
-            pkcs11_key_obj.key_label,
-            pkcs11_key_obj.key_type,
-            chain,
-            pem_cert_to_key_hash(issuer_obj.pem),
-            asn1_ocsp.CertStatus({"revoked": revoked_info}),
-        )
-    return (
+    resolved = (
+        issuer_obj,
         pkcs11_key_obj.key_label,
         pkcs11_key_obj.key_type,
         chain,
         pem_cert_to_key_hash(issuer_obj.pem),
-        asn1_ocsp.CertStatus("good"),
     )
+    OCSPIssuerCache.put(issuer_key_hash, resolved, generation)
+    return resolved
 
 
-async def _ocsp_response_data(
-    ocsp_request: asn1_ocsp.OCSPRequest, nonce: Union[bytes, None]
-) -> Tuple[
-    str,
-    Union[Dict[str, str], bytes],
-    asn1_ocsp.Responses,
-    int,
-    Union[asn1_ocsp.ResponseDataExtensions, None],
-    Union[datetime.datetime, None],
-    Union[List[str], None],
-    str,
-]:
-    responses = asn1_ocsp.Responses()
-    status_code: int = 6
-    key_label: str = ""
-    key_type: str = ""
-    name_dict: Union[Dict[str, str], bytes] = {}
-    chain: Union[List[str], None] = None
+async def _ocsp_check_valid_certs(
+    issuer_key_hash: bytes, serial_numbers: List[int]
+) -> Tuple[str, str, List[str], Union[Dict[str, str], bytes], List[asn1_ocsp.CertStatus]]:
+    issuer_obj, key_label, key_type, chain, responder_key_hash = await _resolve_issuer(issuer_key_hash)
 
-    for _, req in enumerate(ocsp_request["tbs_request"]["request_list"]):
-        curr_response = asn1_ocsp.SingleResponse()
-        curr_response["cert_id"] = req["req_cert"]
+    # A delegated responder signs instead of the CA if configured
+    responder = await OCSPDelegatedResponders.get(issuer_obj, key_label, key_type)
+    if responder is not None:
+        key_label, key_type, responder_cert, responder_key_hash = responder
+        chain = [responder_cert] + chain
+
+    # One CRL fetch for all the issuer's certs
+    crl = await crl_request(1, issuer_obj)
+
+    cert_statuses: List[asn1_ocsp.CertStatus] = []
+    for serial_number in serial_numbers:
+        revoked = RevokedSerialIndex.revoked(issuer_obj.serial, crl, serial_number)
+        if revoked is None:
+            cert_statuses.append(asn1_ocsp.CertStatus("good"))
+        else:
+            revoked_info = asn1_ocsp.RevokedInfo()
+            revoked_info["revocation_time"], revoked_info["revocation_reason"] = revoked
+            cert_statuses.append(asn1_ocsp.CertStatus({"revoked": revoked_info}))
+    return key_label, key_type, chain, responder_key_hash, cert_statuses
+
+
+async def _signing_issuer(
+    request_list: asn1_ocsp.Requests,
+) -> Tuple[str, str, Union[List[str], None], Union[Dict[str, str], bytes], Dict[int, asn1_ocsp.CertStatus]]:
+    # (hash algorithm, issuer name hash, issuer key hash) -> indexes in request_list
+    issuer_groups: Dict[Tuple[str, bytes, bytes], List[int]] = {}
+    for index, req in enumerate(request_list):
+        cert_id = req["req_cert"]
+        issuer = (
+            cert_id["hash_algorithm"]["algorithm"].dotted,
+            cert_id["issuer_name_hash"].native,
+            cert_id["issuer_key_hash"].native,
+        )
+        issuer_groups.setdefault(issuer, []).append(index)
 
+    for (_, _, issuer_key_hash), indexes in issuer_groups.items():
+        serial_numbers = [request_list[index]["req_cert"]["serial_number"].native for index in indexes]
         try:
-            key_label, key_type, chain, name_dict, cert_status = await _ocsp_check_valid_cert(req)
-            status_code = 0
-            curr_response["cert_status"] = cert_status
+            key_label, key_type, chain, name_dict, cert_statuses = await _ocsp_check_valid_certs(
+                issuer_key_hash, serial_numbers
+            )
         except HTTPException:
-            curr_response["cert_status"] = asn1_ocsp.CertStatus("unknown")
+            continue
 
-        curr_response["this_update"] = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=2)
-        # WORK ON THIS
-        curr_response["next_update"] = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
-        # curr_response["single_extensions"] = NOT NEEDED NOW
-        responses.append(curr_response)
+        # index in request_list -> cert status
+        return key_label, key_type, chain, name_dict, dict(zip(indexes, cert_statuses))
 
+    # No known issuer
+    return "", "", None, {}, {}
+
+
+def _response_extensions(nonce: Union[bytes, None], raw_nonce: bool) -> asn1_ocsp.ResponseDataExtensions:
     extra_extensions = asn1_ocsp.ResponseDataExtensions()
 
     if nonce:
-        nonce_ext = asn1_ocsp.ResponseDataExtension()
+        nonce_ext = _RawResponseDataExtension() if raw_nonce else asn1_ocsp.ResponseDataExtension()
         nonce_ext["extn_id"] = asn1_ocsp.ResponseDataExtensionId("1.3.6.1.5.5.7.48.1.2")
         nonce_ext["extn_value"] = nonce
         extra_extensions.append(nonce_ext)
@@ -117,8 +155,41 @@ async def _ocsp_response_data(
     extended_revoke_ext["extn_id"] = asn1_ocsp.ResponseDataExtensionId("1.3.6.1.5.5.7.48.1.9")
     extended_revoke_ext["extn_value"] = None
     extra_extensions.append(extended_revoke_ext)
+    return extra_extensions
 
-    return key_label, name_dict, responses, status_code, extra_extensions, None, chain, key_type
+
+async def _ocsp_response_data(
+    ocsp_request: asn1_ocsp.OCSPRequest, nonce: Union[bytes, None], raw_nonce: bool
+) -> Dict[str, Any]:
+    """The keyword arguments for python_x509_pkcs11.ocsp.response and OCSPDelegatedResponders.software_response"""
+
+    responses = asn1_ocsp.Responses()
+
+    # The first known issuer signs, cert_statuses has the status of its certs by index in request_list
+    key_label, key_type, chain, name_dict, cert_statuses = await _signing_issuer(
+        ocsp_request["tbs_request"]["request_list"]
+    )
+    status_code = 0 if cert_statuses else 6
+
+    for index, req in enumerate(ocsp_request["tbs_request"]["request_list"]):
+        curr_response = asn1_ocsp.SingleResponse()
+        curr_response["cert_id"] = req["req_cert"]
+        curr_response["cert_status"] = cert_statuses.get(index, asn1_ocsp.CertStatus("unknown"))
+        curr_response["this_update"] = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=2)
+        # WORK ON THIS
+        curr_response["next_update"] = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+        # curr_response["single_extensions"] = NOT NEEDED NOW
+        responses.append(curr_response)
+
+    return {
+        "key_label": key_label,
+        "responder_id": name_dict,
+        "single_responses": responses,
+        "response_status": status_code,
+        "extra_extensions": _response_extensions(nonce, raw_nonce),
+        "extra_certs": chain,
+        "key_type": key_type,
+    }
 
 
 async def _fix_broken_ocsp_request(request: asn1_ocsp.OCSPRequest) -> asn1_ocsp.OCSPRequest:
@@ -128,43 +199,57 @@ async def _fix_broken_ocsp_request(request: asn1_ocsp.OCSPRequest) -> asn1_ocsp.
     return request
 
 
-async def _fix_broken_ocsp_response(ok_response_data: bytes, nonce: bytes) -> bytes:
-    ok_response = asn1_ocsp.OCSPResponse.load(ok_response_data)
+async def _signed_ocsp_response(
+    ocsp_request: asn1_ocsp.OCSPRequest,
+    nonce: Union[bytes, None],
+    raw_nonce: bool,
+    cache_key: Union[CacheKey, None],
+    priority: int,
+) -> bytes:
+    cache_generation = OCSPResponseCache.generation
+
+    response_data = await _ocsp_response_data(ocsp_request, nonce, raw_nonce)
+    if OCSPDelegatedResponders.is_software_key(response_data["key_label"]):
+        resp_data = OCSPDelegatedResponders.software_response(**response_data)
+    else:
+        resp_data = await SignScheduler.call(
+            priority, "ocsp_response", response, **response_data, lane=SIGN_LANE_LIBRARY
+        )
 
-    # Change the library class from ParsableOctetString to OctetString
-    asn1_ocsp.ResponseDataExtension._fields = [
-        ("extn_id", asn1_ocsp.ResponseDataExtensionId, {}),
-        ("critical", asn1_core.Boolean, {"default": False}),
-        ("extn_value", asn1_core.OctetString, {}),
-    ]
+    # Only cache successful responses
+    if cache_key is not None and response_data["response_status"] == 0:
+        expires = OCSPResponseCache.put(
+            cache_key, resp_data, response_data["single_responses"][0]["next_update"].native, cache_generation
+        )
 
-    ext = asn1_ocsp.ResponseDataExtension()
-    ext["extn_id"] = ok_response["response_bytes"]["response"].parsed["tbs_response_data"]["response_extensions"][0][
-        "extn_id"
-    ]
-    ext["extn_value"] = ok_response["response_bytes"]["response"].parsed["tbs_response_data"]["response_extensions"][0][
-        "extn_value"
-    ] = nonce
+        # Store it for the standalone OCSP responder
+        if expires is not None and OCSP_RESPONSE_STORE:
+            await DataClassObject.db.save_ocsp_response(cache_key, resp_data, expires)
 
-    parsed = asn1_ocsp.BasicOCSPResponse.load(ok_response["response_bytes"]["response"].parsed.dump())
-    parsed["tbs_response_data"]["response_extensions"][0]["extn_value"] = ext["extn_value"]
+            # Revoked while saving, the revocation's delete may have run before the save
+            if OCSPResponseCache.generation != cache_generation:
+                await DataClassObject.db.delete_ocsp_responses([cache_key[3]])
+    return resp_data
 
-    parsed["signature"] = await PKCS11Session().sign(
-        "cmc_issuer_test3", parsed["tbs_response_data"].dump(), key_type="secp256r1"
-    )
 
-    ok_response["response_bytes"]["response"] = parsed
+async def ocsp_pregenerate(cache_key: CacheKey) -> None:
+    """Sign the nonce-less OCSP response for the CertID in the cache key at background priority and cache it.
 
-    ret: bytes = ok_response.dump()
+    Parameters:
+    cache_key (CacheKey): The cache key for the CertID.
 
-    # Restore the library class
-    asn1_ocsp.ResponseDataExtension._fields = [
-        ("extn_id", asn1_ocsp.ResponseDataExtensionId, {}),
-        ("critical", asn1_core.Boolean, {"default": False}),
-        ("extn_value", asn1_core.ParsableOctetString, {}),
-    ]
+    Returns:
+    None
+    """
+
+    cert_id = asn1_ocsp.CertId()
+    cert_id["hash_algorithm"] = asn1_algos.DigestAlgorithm.load(cache_key[0])
+    cert_id["issuer_name_hash"] = cache_key[1]
+    cert_id["issuer_key_hash"] = cache_key[2]
+    cert_id["serial_number"] = cache_key[3]
 
-    return ret
+    ocsp_request = asn1_ocsp.OCSPRequest({"tbs_request": {"request_list": [{"req_cert": cert_id}]}})
+    await _signed_ocsp_response(ocsp_request, None, False, cache_key, SIGN_PRIORITY_BACKGROUND)
 
 
 async def ocsp_response(request: bytes, encoded: bool = False) -> bytes:
@@ -205,13 +290,94 @@ async def ocsp_response(request: bytes, encoded: bool = False) -> bytes:
         # Get nonce if exists
         nonce = request_nonce(ocsp_request.dump())
 
-        resp_data = await response(*await _ocsp_response_data(ocsp_request, nonce))
+        # Without a nonce the response for a single certificate is the same for everyone, use the cache
+        cache_key: Union[CacheKey, None] = None
+        if nonce is None and len(ocsp_request["tbs_request"]["request_list"]) == 1:
+            cache_key = OCSPResponseCache.key(ocsp_request["tbs_request"]["request_list"][0]["req_cert"])
+            cached_response = OCSPResponseCache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
 
-        if request_was_broken and nonce is not None:
-            resp_data = await _fix_broken_ocsp_response(resp_data, nonce)
-
-        return resp_data
+        # Echo the nonce in the same encoding as a broken request
+        return await _signed_ocsp_response(ocsp_request, nonce, request_was_broken, cache_key, SIGN_PRIORITY_OCSP)
     except ValueError:
         return b"0"
     except TypeError:
+        # Unsigned error response, no HSM work
         return await response("", {}, asn1_ocsp.Responses(), 1)
+
+
+def ocsp_response_http_headers(ocsp_response_data: bytes) -> Dict[str, str]:
+    """HTTP caching headers for an OCSP response, see RFC 5019 section 6.2.
+    Only a successful response without a nonce for a single certificate gets caching headers.
+
+    Parameters:
+    ocsp_response_data (bytes): The OCSP response.
+
+    Returns:
+    Dict[str, str]
+    """
+
+    try:
+        ocsp_resp = asn1_ocsp.OCSPResponse.load(ocsp_response_data)
+        if ocsp_resp["response_status"].native != "successful":
+            return {}
+        tbs_response_data = ocsp_resp["response_bytes"]["response"].parsed["tbs_response_data"]
+    except ValueError:
+        return {}
+
+    extensions = tbs_response_data["response_extensions"]
+    has_nonce = not isinstance(extensions, asn1_core.Void) and any(
+        ext["extn_id"].dotted == "1.3.6.1.5.5.7.48.1.2" for ext in extensions
+    )
+    if len(tbs_response_data["responses"]) != 1 or has_nonce:
+        return {}
+
+    this_update: datetime.datetime = tbs_response_data["responses"][0]["this_update"].native
+    next_update: Union[datetime.datetime, None] = tbs_response_data["responses"][0]["next_update"].native
+    if next_update is None:
+        return {}
+
+    max_age = int(min((next_update - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), OCSP_HTTP_MAX_AGE))
+    if max_age <= 0:
+        return {}
+
+    return {
+        "Cache-Control": f"max-age={max_age}, public, no-transform, must-revalidate",
+        "ETag": f'"{hashlib.sha1(ocsp_response_data).hexdigest()}"',
+        "Last-Modified": format_datetime(this_update, usegmt=True),
+        "Expires": format_datetime(next_update, usegmt=True),
+    }
+
+
+def ocsp_not_modified(
+    if_none_match: Union[str, None], if_modified_since: Union[str, None], headers: Dict[str, str]
+) -> bool:
+    """If the client's cached OCSP response is still current, then reply 304.
+    If-None-Match takes precedence over If-Modified-Since.
+
+    Parameters:
+    if_none_match (Union[str, None]): The If-None-Match request header.
+    if_modified_since (Union[str, None]): The If-Modified-Since request header.
+    headers (Dict[str, str]): The caching headers from ocsp_response_http_headers().
+
+    Returns:
+    bool
+    """
+
+    if not headers:
+        return False
+
+    if if_none_match is not None:
+        for etag in if_none_match.split(","):
+            etag = etag.strip()
+            if etag in ("*", headers["ETag"], "W/" + headers["ETag"]):
+                return True
+        return False
+
+    if if_modified_since is not None:
+        try:
+            return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(headers["Last-Modified"])
+        except (TypeError, ValueError):
+            return False
+    return False
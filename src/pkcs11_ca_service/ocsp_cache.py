@@ -0,0 +1,164 @@
+"""Module which caches signed OCSP responses
+
+Responses to requests without a nonce for a single certificate are the same for everyone
+until the certificate is revoked, so they are cached by their CertID and served
+without asking the DB or the HSM.
+
+An entry lives for OCSP_RESPONSE_CACHE_LIFETIME of the time until the response's next_update.
+Revoking a certificate or CA evicts its entries, see OCSPResponseCache.evict_serial.
+
+Exposes the class:
+- OCSPResponseCache
+"""
+import datetime
+from typing import Dict, Set, Tuple, Union
+
+from asn1crypto import ocsp as asn1_ocsp
+
+from .config import OCSP_RESPONSE_CACHE_LIFETIME, OCSP_RESPONSE_CACHE_SIZE
+
+# (DER hash algorithm, issuer name hash, issuer key hash, serial number)
+CacheKey = Tuple[bytes, bytes, bytes, int]
+
+
+class OCSPResponseCache:
+    """Cache of signed OCSP responses keyed by CertID"""
+
+    # cache key -> (DER OCSP response, expires)
+    _responses: Dict[CacheKey, Tuple[bytes, datetime.datetime]] = {}
+
+    # serial number -> cache keys, for eviction
+    _serial_keys: Dict[int, Set[CacheKey]] = {}
+
+    # Bumped on every eviction, a response built before an eviction must not be cached after it
+    generation: int = 0
+
+    # Keys evicted by a revocation, for the OCSP pre-generation worker to sign again if it runs
+    track_revoked_keys = False
+    _revoked_keys: Set[CacheKey] = set()
+
+    @classmethod
+    def key(cls, cert_id: asn1_ocsp.CertId) -> CacheKey:
+        """The cache key for the CertID in an OCSP request.
+
+        Parameters:
+        cert_id (asn1crypto.ocsp.CertId): The CertID.
+
+        Returns:
+        CacheKey
+        """
+
+        return (
+            cert_id["hash_algorithm"].dump(),
+            cert_id["issuer_name_hash"].native,
+            cert_id["issuer_key_hash"].native,
+            cert_id["serial_number"].native,
+        )
+
+    @classmethod
+    def get(cls, key: CacheKey) -> Union[bytes, None]:
+        """Get the cached OCSP response for the key if it has not expired.
+
+        Parameters:
+        key (CacheKey): The cache key.
+
+        Returns:
+        Union[bytes, None]
+        """
+
+        entry = cls._responses.get(key)
+        if entry is None:
+            return None
+
+        if entry[1] <= datetime.datetime.now(datetime.timezone.utc):
+            cls._remove(key)
+            return None
+        return entry[0]
+
+    @classmethod
+    def expires(cls, key: CacheKey) -> Union[datetime.datetime, None]:
+        """When the cached OCSP response for the key expires, None if not cached.
+
+        Parameters:
+        key (CacheKey): The cache key.
+
+        Returns:
+        Union[datetime.datetime, None]
+        """
+
+        entry = cls._responses.get(key)
+        if entry is None:
+            return None
+        return entry[1]
+
+    @classmethod
+    def take_revoked_keys(cls) -> Set[CacheKey]:
+        """Get and forget the keys evicted by revocations since the last call.
+
+        Returns:
+        Set[CacheKey]
+        """
+
+        keys = cls._revoked_keys
+        cls._revoked_keys = set()
+        return keys
+
+    @classmethod
+    def put(
+        cls, key: CacheKey, response: bytes, next_update: datetime.datetime, generation: int
+    ) -> Union[datetime.datetime, None]:
+        """Cache the OCSP response, unless something was evicted while it was built.
+        Returns when the entry expires, None if not cached.
+
+        Parameters:
+        key (CacheKey): The cache key.
+        response (bytes): The DER encoded OCSP response.
+        next_update (datetime.datetime): The response's next_update.
+        generation (int): OCSPResponseCache.generation from before the response was built.
+
+        Returns:
+        Union[datetime.datetime, None]
+        """
+
+        if generation != cls.generation:
+            return None
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        expires = now + (next_update - now) * OCSP_RESPONSE_CACHE_LIFETIME
+        if expires <= now:
+            return None
+
+        # Drop the oldest entry if full
+        if key not in cls._responses and len(cls._responses) >= OCSP_RESPONSE_CACHE_SIZE:
+            cls._remove(next(iter(cls._responses)))
+
+        cls._responses[key] = (response, expires)
+        cls._serial_keys.setdefault(key[3], set()).add(key)
+        return expires
+
+    @classmethod
+    def evict_serial(cls, serial_number: int) -> None:
+        """Evict all cached responses for certificates with this serial number.
+        Must be called when a certificate or CA is revoked.
+
+        Parameters:
+        serial_number (int): The certificate serial number.
+
+        Returns:
+        None
+        """
+
+        cls.generation += 1
+        for key in cls._serial_keys.pop(serial_number, set()):
+            cls._responses.pop(key, None)
+            if cls.track_revoked_keys:
+                cls._revoked_keys.add(key)
+
+    @classmethod
+    def _remove(cls, key: CacheKey) -> None:
+        cls._responses.pop(key, None)
+        keys = cls._serial_keys.get(key[3])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del cls._serial_keys[key[3]]
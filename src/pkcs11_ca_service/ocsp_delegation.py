@@ -0,0 +1,331 @@
+"""Module which manages delegated OCSP responders, RFC 6960 section 4.2.2.2
+
+A CA listed in OCSP_DELEGATED_RESPONDERS does not sign its OCSP responses with its own key.
+It issues a short lived responder certificate with the id-kp-OCSPSigning EKU and the
+id-pkix-ocsp-nocheck extension and the responder key signs the responses instead.
+The certificate is issued again OCSP_RESPONDER_CERT_RENEW_BEFORE seconds before it expires.
+
+The responder key is either a key in the PKCS11 device labeled after the CA key, or a software key
+only kept in memory and replaced with every new responder certificate.
+A software responder key takes the CA's OCSP signing off the HSM.
+
+Responder certificates are kept in memory, each process issues its own.
+
+Exposes the class:
+- OCSPDelegatedResponders
+"""
+import asyncio
+import datetime
+from functools import partial
+from secrets import token_hex
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Tuple, Union
+
+from asn1crypto import csr as asn1_csr
+from asn1crypto import keys as asn1_keys
+from asn1crypto import ocsp as asn1_ocsp
+from asn1crypto import pem as asn1_pem
+from asn1crypto import x509 as asn1_x509
+from cryptography.hazmat.primitives.asymmetric.ec import (
+    ECDSA,
+    SECP256R1,
+    SECP384R1,
+    SECP521R1,
+    EllipticCurvePrivateKey,
+    generate_private_key,
+)
+from cryptography.hazmat.primitives.asymmetric.ed448 import Ed448PrivateKey
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+from cryptography.hazmat.primitives.asymmetric.rsa import (
+    RSAPrivateKey,
+)
+from cryptography.hazmat.primitives.asymmetric.rsa import (
+    generate_private_key as generate_rsa_private_key,
+)
+from cryptography.hazmat.primitives.hashes import SHA256, SHA384, SHA512
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from pkcs11.exceptions import MultipleObjectsReturned
+from python_x509_pkcs11.csr import sign_csr
+from python_x509_pkcs11.lib import signed_digest_algo
+
+from .asn1 import pem_cert_to_key_hash, pem_cert_to_name_dict
+from .config import (
+    OCSP_DELEGATED_RESPONDERS,
+    OCSP_RESPONDER_CERT_RENEW_BEFORE,
+    OCSP_RESPONDER_CERT_VALIDITY,
+    OCSP_RESPONDER_KEY_TYPE,
+)
+from .pkcs11_pool import PKCS11SessionPool
+from .sign_scheduler import SIGN_LANE_LIBRARY, SIGN_PRIORITY_OCSP, SignScheduler
+
+if TYPE_CHECKING:
+    from .ca import Ca
+
+SoftwarePrivateKey = Union[Ed25519PrivateKey, Ed448PrivateKey, EllipticCurvePrivateKey, RSAPrivateKey]
+
+# (responder key label, key type, responder certificate PEM, responder key hash)
+DelegatedResponder = Tuple[str, str, str, bytes]
+
+_curves = {"secp256r1": SECP256R1(), "secp384r1": SECP384R1(), "secp521r1": SECP521R1()}
+_hashes = {
+    "secp256r1": SHA256(),
+    "secp384r1": SHA384(),
+    "secp521r1": SHA512(),
+    "rsa_2048": SHA256(),
+    "rsa_4096": SHA512(),
+}
+
+
+def _generate_software_key(key_type: str) -> SoftwarePrivateKey:
+    if key_type == "ed25519":
+        return Ed25519PrivateKey.generate()
+    if key_type == "ed448":
+        return Ed448PrivateKey.generate()
+    if key_type in _curves:
+        return generate_private_key(_curves[key_type])
+    return generate_rsa_private_key(public_exponent=65537, key_size=int(key_type.split("_")[1]))
+
+
+def _software_sign(private_key: SoftwarePrivateKey, key_type: str, data: bytes) -> bytes:
+    if isinstance(private_key, (Ed25519PrivateKey, Ed448PrivateKey)):
+        return private_key.sign(data)
+
+    if isinstance(private_key, EllipticCurvePrivateKey):
+        return private_key.sign(data, ECDSA(_hashes[key_type]))
+    return private_key.sign(data, PKCS1v15(), _hashes[key_type])
+
+
+def _responder_extensions() -> asn1_x509.Extensions:
+    key_usage_ext = asn1_x509.Extension()
+    key_usage_ext["extn_id"] = asn1_x509.ExtensionId("key_usage")
+    key_usage_ext["critical"] = True
+    key_usage_ext["extn_value"] = asn1_x509.KeyUsage({"digital_signature"})
+
+    eku_ext = asn1_x509.Extension()
+    eku_ext["extn_id"] = asn1_x509.ExtensionId("extended_key_usage")
+    eku_ext["extn_value"] = asn1_x509.ExtKeyUsageSyntax(["ocsp_signing"])
+
+    # The responder certificate is short lived and never checked for revocation
+    no_check_ext = asn1_x509.Extension()
+    no_check_ext["extn_id"] = asn1_x509.ExtensionId("ocsp_no_check")
+    no_check_ext["extn_value"] = None
+
+    return asn1_x509.Extensions([key_usage_ext, eku_ext, no_check_ext])
+
+
+async def _responder_csr(
+    subject: Dict[str, str], public_key_der: bytes, sign: Callable[[bytes], Awaitable[bytes]]
+) -> str:
+    # Signed by the responder key as proof of possession
+    csr_info = asn1_csr.CertificationRequestInfo(
+        {
+            "version": "v1",
+            "subject": asn1_x509.Name.build(subject),
+            "subject_pk_info": asn1_keys.PublicKeyInfo.load(public_key_der),
+            "attributes": [],
+        }
+    )
+    csr = asn1_csr.CertificationRequest(
+        {
+            "certification_request_info": csr_info,
+            "signature_algorithm": signed_digest_algo(OCSP_RESPONDER_KEY_TYPE),
+            "signature": await sign(csr_info.dump()),
+        }
+    )
+    ret: str = asn1_pem.armor("CERTIFICATE REQUEST", csr.dump()).decode("utf-8")
+    return ret
+
+
+class OCSPDelegatedResponders:
+    """Delegated OCSP responders per CA"""
+
+    # CA key label -> (responder, responder certificate not_after)
+    _responders: Dict[str, Tuple[DelegatedResponder, datetime.datetime]] = {}
+
+    # Software responder key label -> (private key, responder certificate not_after)
+    _software_keys: Dict[str, Tuple[SoftwarePrivateKey, datetime.datetime]] = {}
+
+    _locks: Dict[str, asyncio.Lock] = {}
+
+    @classmethod
+    async def get(cls, issuer_obj: "Ca", key_label: str, key_type: str) -> Union[DelegatedResponder, None]:
+        """Get the delegated responder signing the CA's OCSP responses, None if the CA signs them itself.
+        Issues a new responder certificate if there is none or it is about to expire.
+
+        Parameters:
+        issuer_obj (Ca): The CA.
+        key_label (str): The CA's key label.
+        key_type (str): The CA's key type.
+
+        Returns:
+        Union[DelegatedResponder, None]
+        """
+
+        key_storage = OCSP_DELEGATED_RESPONDERS.get(key_label)
+        if key_storage is None:
+            return None
+
+        current = cls._responders.get(key_label)
+        renew_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            seconds=OCSP_RESPONDER_CERT_RENEW_BEFORE
+        )
+        if current is not None and current[1] > renew_at:
+            return current[0]
+
+        # Only one new responder certificate per CA at a time
+        async with cls._locks.setdefault(key_label, asyncio.Lock()):
+            current = cls._responders.get(key_label)
+            if current is not None and current[1] > renew_at:
+                return current[0]
+
+            try:
+                cls._responders[key_label] = await cls._issue(issuer_obj, key_label, key_type, key_storage)
+            except Exception as exc:  # pylint: disable=broad-except
+                # Keep using the current responder certificate until it expires
+                if current is None or current[1] <= datetime.datetime.now(datetime.timezone.utc):
+                    raise
+                print(f"Failed to renew the OCSP responder certificate for {key_label}: {exc!r}", flush=True)
+                return current[0]
+
+            return cls._responders[key_label][0]
+
+    @classmethod
+    async def _issue(
+        cls, issuer_obj: "Ca", key_label: str, key_type: str, key_storage: str
+    ) -> Tuple[DelegatedResponder, datetime.datetime]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        not_after = now + datetime.timedelta(seconds=OCSP_RESPONDER_CERT_VALIDITY)
+        sign: Callable[[bytes], Awaitable[bytes]]
+
+        if key_storage == "software":
+            private_key = _generate_software_key(OCSP_RESPONDER_KEY_TYPE)
+            responder_key_label = f"{key_label}_ocsp_responder_{token_hex(8)}"
+            public_key_der = private_key.public_key().public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
+
+            async def sign(data: bytes) -> bytes:
+                return _software_sign(private_key, OCSP_RESPONDER_KEY_TYPE, data)
+
+        else:
+            responder_key_label = f"{key_label}_ocsp_responder"
+            try:
+                public_key_pem, _ = await PKCS11SessionPool.create_keypair(responder_key_label, OCSP_RESPONDER_KEY_TYPE)
+            except MultipleObjectsReturned:
+                public_key_pem, _ = await PKCS11SessionPool.public_key_data(
+                    responder_key_label, OCSP_RESPONDER_KEY_TYPE
+                )
+            _, _, public_key_der = asn1_pem.unarmor(public_key_pem.encode("utf-8"))
+            sign = partial(PKCS11SessionPool.sign, responder_key_label, key_type=OCSP_RESPONDER_KEY_TYPE)
+
+        subject = pem_cert_to_name_dict(issuer_obj.pem)
+        subject["common_name"] = subject.get("common_name", "") + " OCSP responder"
+        csr_pem = await _responder_csr(subject, public_key_der, sign)
+
+        cert_pem = await SignScheduler.call(
+            SIGN_PRIORITY_OCSP,
+            "sign_csr",
+            sign_csr,
+            key_label,
+            pem_cert_to_name_dict(issuer_obj.pem),
+            csr_pem,
+            not_after=not_after,
+            keep_csr_extensions=False,
+            extra_extensions=_responder_extensions(),
+            key_type=key_type,
+            lane=SIGN_LANE_LIBRARY,
+        )
+
+        if key_storage == "software":
+            # Forget software keys whose certificate has expired
+            cls._software_keys = {label: entry for label, entry in cls._software_keys.items() if entry[1] > now}
+            cls._software_keys[responder_key_label] = (private_key, not_after)
+
+        print(f"Issued OCSP responder certificate for {key_label}, valid until {not_after}", flush=True)
+        return (responder_key_label, OCSP_RESPONDER_KEY_TYPE, cert_pem, pem_cert_to_key_hash(cert_pem)), not_after
+
+    @classmethod
+    def is_software_key(cls, key_label: str) -> bool:
+        """If the key label is a software responder key, sign with software_response instead of the HSM.
+
+        Parameters:
+        key_label (str): Keypair label.
+
+        Returns:
+        bool
+        """
+
+        return key_label in cls._software_keys
+
+    @classmethod
+    def software_response(  # pylint: disable=too-many-arguments
+        cls,
+        key_label: str,
+        responder_id: Union[Dict[str, str], bytes],
+        single_responses: asn1_ocsp.Responses,
+        response_status: int,
+        *,
+        extra_extensions: Union[asn1_ocsp.ResponseDataExtensions, None] = None,
+        produced_at: Union[datetime.datetime, None] = None,
+        extra_certs: Union[List[str], None] = None,
+        key_type: Union[str, None] = None,
+    ) -> bytes:
+        """Create an OCSP response signed by a software responder key.
+        Same parameters as python_x509_pkcs11.ocsp.response.
+
+        Parameters:
+        key_label (str): Software responder key label.
+        responder_id (Union[Dict[str, str], bytes]): Dict with the responders x509 Names or its key hash.
+        single_responses (asn1crypto.ocsp.Responses): Responses for all certs in request.
+        response_status (int): Status code for the OCSP response.
+        extra_extensions (Union[asn1crypto.ocsp.ResponseDataExtensions, None] = None): Extra extensions.
+        produced_at (Union[datetime.datetime, None] = None): What time to write into produced_at.
+        extra_certs (Union[List[str], None] = None): List of PEM encoded certs for the client to verify the signature.
+        key_type (Union[str, None] = None): Key type of the software responder key.
+
+        Returns:
+        bytes
+        """
+
+        if response_status != 0:
+            ret: bytes = asn1_ocsp.OCSPResponse({"response_status": response_status}).dump()
+            return ret
+
+        private_key = cls._software_keys[key_label][0]
+        if key_type is None:
+            key_type = OCSP_RESPONDER_KEY_TYPE
+
+        response_data = asn1_ocsp.ResponseData()
+        if isinstance(responder_id, bytes):
+            response_data["responder_id"] = asn1_ocsp.ResponderId({"by_key": responder_id})
+        else:
+            response_data["responder_id"] = asn1_ocsp.ResponderId({"by_name": asn1_x509.Name.build(responder_id)})
+
+        if produced_at is None:
+            # -2 minutes to protect from the OCSP response readers time skew
+            produced_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=2)
+        response_data["produced_at"] = produced_at.replace(microsecond=0)
+
+        for single_response in single_responses:
+            single_response["this_update"] = single_response["this_update"].native.replace(microsecond=0)
+            if single_response["next_update"].native is not None:
+                single_response["next_update"] = single_response["next_update"].native.replace(microsecond=0)
+        response_data["responses"] = single_responses
+
+        if extra_extensions is not None and len(extra_extensions) > 0:
+            response_data["response_extensions"] = extra_extensions
+
+        basic_ocsp_response = asn1_ocsp.BasicOCSPResponse()
+        basic_ocsp_response["tbs_response_data"] = response_data
+        basic_ocsp_response["signature_algorithm"] = signed_digest_algo(key_type)
+        basic_ocsp_response["signature"] = _software_sign(private_key, key_type, response_data.dump())
+        if extra_certs:
+            basic_ocsp_response["certs"] = [
+                asn1_x509.Certificate.load(asn1_pem.unarmor(cert.encode("utf-8"))[2]) for cert in extra_certs
+            ]
+
+        ocsp_response = asn1_ocsp.OCSPResponse()
+        ocsp_response["response_status"] = "successful"
+        ocsp_response["response_bytes"] = asn1_ocsp.ResponseBytes(
+            {"response_type": "basic_ocsp_response", "response": basic_ocsp_response}
+        )
+        ret = ocsp_response.dump()
+        return ret
@@ -0,0 +1,64 @@
+"""Module which caches the resolved issuers for the OCSP responder
+
+Finding the signing key and chain for an OCSP request's issuer_key_hash takes several DB queries,
+so the result is cached. The cache is cleared when a CA is created or revoked.
+
+Exposes the class:
+- OCSPIssuerCache
+"""
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
+
+if TYPE_CHECKING:
+    from .ca import Ca
+
+# (issuer CA, key_label, key_type, chain, responder key hash)
+ResolvedIssuer = Tuple["Ca", str, str, List[str], bytes]
+
+
+class OCSPIssuerCache:
+    """Cache of resolved OCSP issuers keyed by issuer key hash"""
+
+    _issuers: Dict[bytes, ResolvedIssuer] = {}
+
+    # Bumped on every clear, an issuer resolved before a clear must not be cached after it
+    generation: int = 0
+
+    @classmethod
+    def get(cls, issuer_key_hash: bytes) -> Union[ResolvedIssuer, None]:
+        """Get the resolved issuer for the issuer key hash.
+
+        Parameters:
+        issuer_key_hash (bytes): The issuer_key_hash from the OCSP request.
+
+        Returns:
+        Union[ResolvedIssuer, None]
+        """
+
+        return cls._issuers.get(issuer_key_hash)
+
+    @classmethod
+    def put(cls, issuer_key_hash: bytes, resolved: ResolvedIssuer, generation: int) -> None:
+        """Cache the resolved issuer, unless the cache was cleared while it was resolved.
+
+        Parameters:
+        issuer_key_hash (bytes): The issuer_key_hash from the OCSP request.
+        resolved (ResolvedIssuer): The resolved issuer.
+        generation (int): OCSPIssuerCache.generation from before the issuer was resolved.
+
+        Returns:
+        None
+        """
+
+        if generation == cls.generation:
+            cls._issuers[issuer_key_hash] = resolved
+
+    @classmethod
+    def clear(cls) -> None:
+        """Clear the cache. Must be called when a CA is created or revoked.
+
+        Returns:
+        None
+        """
+
+        cls.generation += 1
+        cls._issuers = {}
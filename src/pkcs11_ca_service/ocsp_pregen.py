@@ -0,0 +1,162 @@
+"""Module which pre-generates OCSP responses in the background
+
+Walks all unexpired certificates and CAs by issuer every OCSP_PREGEN_INTERVAL seconds and signs
+nonce-less OCSP responses for those not in the OCSPResponseCache or about to expire from it,
+so OCSP requests are answered from the cache. Responses evicted by a revocation are signed again
+right away.
+
+Signing runs at SIGN_PRIORITY_BACKGROUND so it never holds back interactive HSM work. The walk is
+paced to finish in half of OCSP_PREGEN_REFRESH_BEFORE whatever the number of certificates, so every
+response is signed again before it expires from the cache. The walk covers at most OCSP_PREGEN_CACHE_SHARE
+of the cache, more would evict its own responses and sign them again on every walk.
+
+With OCSP_RESPONSE_STORE the signed responses are also stored in the DB for the standalone
+OCSP responder, see ocsp_responder.py.
+
+Exposes the class:
+- OCSPPregenerator
+"""
+import asyncio
+import datetime
+import time
+from typing import List, Union
+
+from asn1crypto import algos as asn1_algos
+
+from .asn1 import pem_cert_to_key_hash, pem_cert_to_name_hash
+from .base import DataClassObject
+from .config import (
+    OCSP_PREGEN_CACHE_SHARE,
+    OCSP_PREGEN_INTERVAL,
+    OCSP_PREGEN_MIN_RATE,
+    OCSP_PREGEN_REFRESH_BEFORE,
+    OCSP_RESPONSE_CACHE_SIZE,
+    OCSP_RESPONSE_STORE,
+)
+from .ocsp import ocsp_pregenerate
+from .ocsp_cache import CacheKey, OCSPResponseCache
+
+# CertIDs are pre-generated with SHA1, as in RFC 5019 and what OCSP clients send by default
+PREGEN_HASH_ALGORITHM = asn1_algos.DigestAlgorithm({"algorithm": "sha1"}).dump()
+
+
+class OCSPPregenerator:  # pylint: disable=too-few-public-methods
+    """Background worker pre-generating OCSP responses"""
+
+    _task: Union["asyncio.Task[None]", None] = None
+
+    @classmethod
+    def start(cls) -> None:
+        """Start the worker unless disabled or already running.
+
+        Returns:
+        None
+        """
+
+        if OCSP_PREGEN_INTERVAL <= 0:
+            return
+        if cls._task is not None and not cls._task.done():
+            return
+
+        OCSPResponseCache.track_revoked_keys = True
+        cls._task = asyncio.ensure_future(cls._run())
+
+    @classmethod
+    async def _sign(cls, cache_key: CacheKey) -> None:
+        try:
+            await ocsp_pregenerate(cache_key)
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"OCSP pre-generation failed for serial {cache_key[3]}: {exc!r}", flush=True)
+
+    @classmethod
+    async def _sign_revoked(cls) -> None:
+        for cache_key in OCSPResponseCache.take_revoked_keys():
+            await cls._sign(cache_key)
+            await asyncio.sleep(1 / OCSP_PREGEN_MIN_RATE)
+
+    @classmethod
+    def rate(cls, count: int) -> float:
+        """Signatures per second to sign count responses in half of OCSP_PREGEN_REFRESH_BEFORE,
+        at least OCSP_PREGEN_MIN_RATE.
+
+        Parameters:
+        count (int): Number of responses to sign.
+
+        Returns:
+        float
+        """
+
+        return max(float(OCSP_PREGEN_MIN_RATE), count / (OCSP_PREGEN_REFRESH_BEFORE / 2))
+
+    @classmethod
+    async def _cache_keys(cls) -> List[CacheKey]:
+        cache_keys: List[CacheKey] = []
+        for issuer_pem, serial_numbers in (await DataClassObject.db.unexpired_certificates()).items():
+            issuer_name_hash = pem_cert_to_name_hash(issuer_pem)
+            try:
+                issuer_key_hash = pem_cert_to_key_hash(issuer_pem)
+            except ValueError:
+                # No SKI extension, OCSP requests for its certs can not be resolved anyway
+                continue
+
+            # Same order every walk so the same certificates are pre-generated if not all fit in the cache
+            for serial_number in sorted(serial_numbers):
+                cache_keys.append((PREGEN_HASH_ALGORITHM, issuer_name_hash, issuer_key_hash, serial_number))
+
+        limit = int(OCSP_RESPONSE_CACHE_SIZE * OCSP_PREGEN_CACHE_SHARE)
+        if len(cache_keys) > limit:
+            print(
+                f"OCSP pre-generation covers {limit} of {len(cache_keys)} certificates, "
+                + "increase OCSP_RESPONSE_CACHE_SIZE to cover all",
+                flush=True,
+            )
+            cache_keys = cache_keys[:limit]
+        return cache_keys
+
+    @classmethod
+    async def _walk(cls) -> None:
+        refresh_before = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            seconds=OCSP_PREGEN_REFRESH_BEFORE
+        )
+
+        # Expired stored responses are never served, drop them
+        if OCSP_RESPONSE_STORE:
+            await DataClassObject.db.delete_ocsp_responses()
+
+        to_sign: List[CacheKey] = []
+        for cache_key in await cls._cache_keys():
+            expires = OCSPResponseCache.expires(cache_key)
+            if expires is None or expires < refresh_before:
+                to_sign.append(cache_key)
+
+        interval = 1 / cls.rate(len(to_sign))
+        next_sign = time.monotonic()
+        for cache_key in to_sign:
+            # Revocations first
+            await cls._sign_revoked()
+
+            # Signed by an OCSP request since the walk started
+            expires = OCSPResponseCache.expires(cache_key)
+            if expires is not None and expires >= refresh_before:
+                continue
+
+            await asyncio.sleep(max(0.0, next_sign - time.monotonic()))
+            next_sign = max(next_sign, time.monotonic()) + interval
+            await cls._sign(cache_key)
+
+    @classmethod
+    async def _run(cls) -> None:
+        next_walk = time.monotonic()
+        while True:
+            try:
+                await cls._sign_revoked()
+
+                if time.monotonic() >= next_walk:
+                    next_walk = time.monotonic() + OCSP_PREGEN_INTERVAL
+                    start = time.monotonic()
+                    await cls._walk()
+                    print(f"OCSP pre-generation walk done in {time.monotonic() - start:.1f}s", flush=True)
+            except Exception as exc:  # pylint: disable=broad-except
+                print(f"OCSP pre-generation walk failed: {exc!r}", flush=True)
+
+            await asyncio.sleep(1)
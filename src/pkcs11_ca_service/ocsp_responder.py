@@ -0,0 +1,110 @@
+"""Standalone OCSP responder, FastAPI runs from here
+
+Serves the pre-signed OCSP responses the CA service stores in the DB when OCSP_RESPONSE_STORE is set,
+it is off by default, without a PKCS11 session, so it can run with many workers and scale apart from the CA service.
+
+As in RFC 5019 only requests for a single certificate are answered and the nonce is ignored.
+Requests without a stored response get an unsigned unauthorized response.
+
+Run with
+uvicorn src.pkcs11_ca_service.ocsp_responder:app --workers 4
+"""
+import asyncio
+import os
+
+from asn1crypto import ocsp as asn1_ocsp
+from fastapi import FastAPI, Request, Response
+
+from .asn1 import ocsp_decode
+from .base import DataClassObject
+from .ocsp import ocsp_not_modified, ocsp_response_http_headers
+from .ocsp_cache import OCSPResponseCache
+from .startup import ocsp_responder_startup
+
+# Unsigned error responses, RFC 6960 section 2.3
+MALFORMED_REQUEST: bytes = asn1_ocsp.OCSPResponse({"response_status": "malformed_request"}).dump()
+UNAUTHORIZED: bytes = asn1_ocsp.OCSPResponse({"response_status": "unauthorized"}).dump()
+
+if "_" in os.environ and "sphinx-build" in os.environ["_"]:
+    print("Running sphinx build")
+else:
+    loop = asyncio.get_running_loop()
+    startup_task = loop.create_task(ocsp_responder_startup())
+
+# Create fastapi app
+# Disable swagger and docs endpoints for now
+app = FastAPI(docs_url=None, redoc_url=None)
+
+
+async def stored_ocsp_response(request: bytes, encoded: bool = False) -> bytes:
+    """Get the stored OCSP response for the OCSP request
+
+    Parameters:
+    request (bytes): OCSP request in bytes.
+    encoded (str): If the request is base64 + url encoded
+
+    Returns:
+    bytes
+    """
+
+    try:
+        if encoded:
+            request = ocsp_decode(request.decode("utf-8"))
+
+        ocsp_request = asn1_ocsp.OCSPRequest.load(request)
+        if not isinstance(ocsp_request, asn1_ocsp.OCSPRequest):
+            raise ValueError
+
+        request_list = ocsp_request["tbs_request"]["request_list"]
+        if len(request_list) == 0:
+            raise ValueError
+        if len(request_list) > 1:
+            return UNAUTHORIZED
+
+        cache_key = OCSPResponseCache.key(request_list[0]["req_cert"])
+    except (ValueError, TypeError):
+        # binascii.Error is a ValueError
+        return MALFORMED_REQUEST
+
+    stored_response = await DataClassObject.db.load_ocsp_response(cache_key)
+    if stored_response is None:
+        return UNAUTHORIZED
+    return stored_response
+
+
+@app.post("/ocsp/")
+async def post_ocsp(request: Request) -> Response:
+    """/ocsp, POST method.
+
+    Return the stored OCSP response.
+
+    Parameters:
+    request (fastapi.Request): The entire HTTP request.
+
+    Returns:
+    fastapi.Response
+    """
+
+    ocsp_data = await stored_ocsp_response(await request.body())
+    return Response(status_code=200, content=ocsp_data, media_type="application/ocsp-response")
+
+
+@app.get("/ocsp/{ocsp_path:path}")
+async def get_ocsp(request: Request, ocsp_path: str) -> Response:
+    """/ocsp, GET method.
+
+    Return the stored OCSP response with RFC 5019 caching headers, supports conditional requests.
+
+    Parameters:
+    request (fastapi.Request): The entire HTTP request.
+    ocsp_path (str): OCSP path.
+
+    Returns:
+    fastapi.Response
+    """
+
+    ocsp_data = await stored_ocsp_response(ocsp_path.replace("/ocsp/", "").encode("utf-8"), encoded=True)
+    headers = ocsp_response_http_headers(ocsp_data)
+    if ocsp_not_modified(request.headers.get("If-None-Match"), request.headers.get("If-Modified-Since"), headers):
+        return Response(status_code=304, headers=headers)
+    return Response(status_code=200, content=ocsp_data, media_type="application/ocsp-response", headers=headers)
@@ -0,0 +1,665 @@
+"""Module which handles a pool of logged-in PKCS11 sessions
+
+python_x509_pkcs11.pkcs11_handle.PKCS11Session keeps a single session behind a global lock
+so every signature waits for the previous one to finish.
+PKCS11SessionPool keeps several sessions open against each token and signs on them concurrently.
+With several tokens holding cloned keys, for example HA HSM partitions, the work is spread
+over the tokens weighted by their health and fails over when a token goes bad.
+
+Each pooled session caches the key handles it has found, keyed by (key_label, key_type),
+so a signature does not need to search the token for the key first. A handle the token rejects
+is searched for again. The cache is dropped when a session is reconnected, after a token reset,
+re-login or HA failover a handle may have been given to a different object.
+
+Exposes the class:
+- PKCS11SessionPool
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import sha256, sha384, sha512
+from typing import Any, Callable, Dict, List, Tuple, TypeVar, Union
+
+from asn1crypto import pem as asn1_pem
+from asn1crypto.keys import (
+    PublicKeyAlgorithm,
+    PublicKeyAlgorithmId,
+    PublicKeyInfo,
+    RSAPublicKey,
+)
+from pkcs11 import Key, Mechanism, ObjectClass, Session, Token, lib
+from pkcs11.exceptions import (
+    KeyHandleInvalid,
+    NoSuchKey,
+    ObjectHandleInvalid,
+    PKCS11Error,
+    SignatureInvalid,
+    UserAlreadyLoggedIn,
+)
+from pkcs11.util.ec import encode_ec_public_key
+from pkcs11.util.rsa import encode_rsa_public_key
+from python_x509_pkcs11.crypto import convert_rs_ec_signature, encode_eddsa_public_key
+from python_x509_pkcs11.lib import key_type_values, key_types
+from python_x509_pkcs11.pkcs11_handle import PKCS11Session
+
+from .config import (
+    PKCS11_SESSION_POOL_SIZE,
+    PKCS11_SESSION_POOL_SIZES,
+    PKCS11_SLOT_MAX_FAILURES,
+    PKCS11_SLOT_RETRY_SECONDS,
+)
+
+T = TypeVar("T")
+
+# The hash used with each EC key type, as in _mechanism_and_data, EdDSA and RSA can not sign a prehashed digest
+_key_type_digests = {
+    "secp256r1": "sha256",
+    "secp384r1": "sha384",
+    "secp521r1": "sha512",
+}
+_digest_sizes = {"sha256": 32, "sha384": 48, "sha512": 64}
+
+
+def _mechanism_and_data(key_type: str, data: bytes) -> Tuple[Mechanism, bytes]:
+    """Get the signing mechanism for the key type, EC data is hashed here as in PKCS11Session.sign
+
+    Parameters:
+    key_type (str): Key type.
+    data (bytes): Data to be signed.
+
+    Returns:
+    Tuple[pkcs11.Mechanism, bytes]
+    """
+
+    if key_type in ["ed25519", "ed448"]:
+        return Mechanism.EDDSA, data
+
+    if key_type == "secp256r1":
+        return Mechanism.ECDSA, sha256(data).digest()
+    if key_type == "secp384r1":
+        return Mechanism.ECDSA, sha384(data).digest()
+    if key_type == "secp521r1":
+        return Mechanism.ECDSA, sha512(data).digest()
+
+    if key_type == "rsa_2048":
+        return Mechanism.SHA256_RSA_PKCS, data
+    return Mechanism.SHA512_RSA_PKCS, data
+
+
+def _digest_mechanism_and_data(key_type: str, digest: bytes) -> Tuple[Mechanism, bytes]:
+    """Get the raw signing mechanism for an already hashed digest, the digest is not hashed again.
+
+    Parameters:
+    key_type (str): Key type.
+    digest (bytes): The digest to be signed.
+
+    Returns:
+    Tuple[pkcs11.Mechanism, bytes]
+    """
+
+    if key_type not in _key_type_digests:
+        raise ValueError(f"key_type {key_type} can not sign a prehashed digest")
+    return Mechanism.ECDSA, digest
+
+
+def _public_key_info(key_pub: Key, key_type: str) -> PublicKeyInfo:
+    if key_type in ["rsa_2048", "rsa_4096"]:
+        pki = PublicKeyInfo()
+        pka = PublicKeyAlgorithm()
+        pka["algorithm"] = PublicKeyAlgorithmId("rsa")
+        pki["algorithm"] = pka
+        pki["public_key"] = RSAPublicKey.load(encode_rsa_public_key(key_pub))
+        return pki
+
+    if key_type in ["ed25519", "ed448"]:
+        return PublicKeyInfo.load(encode_eddsa_public_key(key_pub))
+
+    return PublicKeyInfo.load(encode_ec_public_key(key_pub))
+
+
+class _PooledSession:
+    """A PKCS11 session and the key handles found with it"""
+
+    def __init__(self, session: Session) -> None:
+        self.session = session
+        self.keys: Dict[Tuple[str, str, ObjectClass], Key] = {}
+
+    def key(self, key_label: str, key_type: str, object_class: ObjectClass) -> Key:
+        """Get the key from the cache or search for it in the PKCS11 device.
+
+        Parameters:
+        key_label (str): Keypair label.
+        key_type (str): Key type.
+        object_class (pkcs11.ObjectClass): PRIVATE_KEY or PUBLIC_KEY.
+
+        Returns:
+        pkcs11.Key
+        """
+
+        cache_key = (key_label, key_type, object_class)
+        if cache_key not in self.keys:
+            self.keys[cache_key] = self.session.get_key(
+                key_type=key_type_values[key_type],
+                object_class=object_class,
+                label=key_label,
+            )
+        return self.keys[cache_key]
+
+    def forget(self, key_label: str, key_type: str) -> None:
+        """Drop the cached handles for this key.
+
+        Parameters:
+        key_label (str): Keypair label.
+        key_type (str): Key type.
+
+        Returns:
+        None
+        """
+
+        for object_class in [ObjectClass.PRIVATE_KEY, ObjectClass.PUBLIC_KEY]:
+            self.keys.pop((key_label, key_type, object_class), None)
+
+    def reconnect(self, session: Session) -> None:
+        """Use the new session and drop the cached key handles, they are searched for again in it.
+
+        Parameters:
+        session (pkcs11.Session): The new session on the same token.
+
+        Returns:
+        None
+        """
+
+        self.session = session
+        self.keys = {}
+
+    def _with_keys(self, key_label: str, key_type: str, func: Callable[[], T]) -> T:
+        try:
+            return func()
+        except (KeyHandleInvalid, ObjectHandleInvalid):
+            # The cached handle is stale, search for the key again, raises NoSuchKey if it is gone
+            self.forget(key_label, key_type)
+            return func()
+
+    def sign(self, key_label: str, key_type: str, data: bytes, verify_signature: bool) -> bytes:
+        """Sign the data with the key, blocking.
+
+        Parameters:
+        key_label (str): Keypair label.
+        key_type (str): Key type.
+        data (bytes): Bytes to be signed.
+        verify_signature (bool): If we should verify the signature.
+
+        Returns:
+        bytes
+        """
+
+        return self._sign(key_label, key_type, _mechanism_and_data(key_type, data), verify_signature)
+
+    def sign_digest(self, key_label: str, key_type: str, digest: bytes, verify_signature: bool) -> bytes:
+        """Sign the already hashed digest with the key, blocking.
+
+        Parameters:
+        key_label (str): Keypair label.
+        key_type (str): Key type.
+        digest (bytes): The digest to be signed.
+        verify_signature (bool): If we should verify the signature.
+
+        Returns:
+        bytes
+        """
+
+        return self._sign(key_label, key_type, _digest_mechanism_and_data(key_type, digest), verify_signature)
+
+    def _sign(
+        self, key_label: str, key_type: str, mechanism_and_data: Tuple[Mechanism, bytes], verify_signature: bool
+    ) -> bytes:
+        return self._with_keys(
+            key_label,
+            key_type,
+            partial(self._sign_with_keys, key_label, key_type, mechanism_and_data, verify_signature),
+        )
+
+    def _sign_with_keys(
+        self, key_label: str, key_type: str, mechanism_and_data: Tuple[Mechanism, bytes], verify_signature: bool
+    ) -> bytes:
+        mechanism, data = mechanism_and_data
+        signature = self.key(key_label, key_type, ObjectClass.PRIVATE_KEY).sign(data, mechanism=mechanism)
+        if not isinstance(signature, bytes):
+            raise SignatureInvalid
+
+        if verify_signature:
+            if not self.key(key_label, key_type, ObjectClass.PUBLIC_KEY).verify(data, signature, mechanism=mechanism):
+                raise SignatureInvalid
+        return signature
+
+    def public_key_data(self, key_label: str, key_type: str) -> Tuple[str, bytes]:
+        """The public key in PEM form and 'Key Identifier' for the key, blocking.
+
+        Parameters:
+        key_label (str): Keypair label.
+        key_type (str): Key type.
+
+        Returns:
+        Tuple[str, bytes]
+        """
+
+        pki = self._with_keys(
+            key_label,
+            key_type,
+            lambda: _public_key_info(self.key(key_label, key_type, ObjectClass.PUBLIC_KEY), key_type),
+        )
+        key_pub_pem: bytes = asn1_pem.armor("PUBLIC KEY", pki.dump())
+        return key_pub_pem.decode("utf-8"), pki.sha1
+
+
+class _Slot:  # pylint: disable=too-many-instance-attributes
+    """A token, its pooled sessions and its health"""
+
+    def __init__(self, token_label: str, size: int) -> None:
+        self.token_label = token_label
+        self.size = size
+        self.token: Token
+        self.all_sessions: List[_PooledSession] = []
+        self.sessions: "asyncio.Queue[_PooledSession]" = asyncio.Queue()
+
+        self.in_flight = 0
+        self.weight = 1.0
+        self.failures = 0
+        self.down_until = 0.0
+
+        # (key_label, key_type) -> until when the key is treated as missing in this token
+        self.missing_keys: Dict[Tuple[str, str], float] = {}
+
+    def open_session(self) -> Session:
+        """Open a logged-in session on the token, blocking.
+
+        Returns:
+        pkcs11.Session
+        """
+
+        try:
+            return self.token.open(rw=True, user_pin=os.environ["PKCS11_PIN"])
+        except UserAlreadyLoggedIn:
+            # Login state is shared by all sessions to the token in this process
+            return self.token.open(rw=True)
+
+    def open_sessions(self) -> List[Session]:
+        """Find the token and open the pool sessions on it, blocking.
+
+        Returns:
+        List[pkcs11.Session]
+        """
+
+        self.token = lib(os.environ["PKCS11_MODULE"]).get_token(token_label=self.token_label)
+        return [self.open_session() for _ in range(self.size)]
+
+    def reopen_session(self, pooled: _PooledSession) -> None:
+        """Replace a broken session, blocking.
+
+        Parameters:
+        pooled (_PooledSession): The pooled session to reconnect.
+
+        Returns:
+        None
+        """
+
+        # A handle from before may now point to a different object, never sign with it
+        pooled.reconnect(self.open_session())
+
+    def load(self) -> float:
+        """Current load relative to the number of sessions, an unhealthy token counts as more loaded.
+
+        Returns:
+        float
+        """
+
+        return (self.in_flight + 1) / (self.size * self.weight)
+
+    def has_key(self, key: Tuple[str, str]) -> bool:
+        """If the key has not been found missing in this token lately.
+
+        Parameters:
+        key (Tuple[str, str]): (key_label, key_type).
+
+        Returns:
+        bool
+        """
+
+        return self.missing_keys.get(key, 0.0) <= time.monotonic()
+
+    def succeeded(self) -> None:
+        """Record a successful operation, the weight recovers.
+
+        Returns:
+        None
+        """
+
+        self.failures = 0
+        self.weight = min(1.0, self.weight * 2)
+
+    def failed(self, exc: Exception) -> None:
+        """Record a failed operation, after PKCS11_SLOT_MAX_FAILURES in a row
+        the token is down for PKCS11_SLOT_RETRY_SECONDS.
+
+        Parameters:
+        exc (Exception): The error.
+
+        Returns:
+        None
+        """
+
+        self.failures += 1
+        self.weight = max(0.1, self.weight / 2)
+        print(f"PKCS11 token {self.token_label} failed: {exc!r}", flush=True)
+
+        if self.failures >= PKCS11_SLOT_MAX_FAILURES:
+            self.down_until = time.monotonic() + PKCS11_SLOT_RETRY_SECONDS
+            print(f"PKCS11 token {self.token_label} is down for {PKCS11_SLOT_RETRY_SECONDS} seconds", flush=True)
+
+
+class PKCS11SessionPool:
+    """Pool of logged-in PKCS11 sessions on the tokens in the PKCS11_TOKENS env variable,
+    a comma separated list of token labels holding the same (cloned) keys.
+    Defaults to the token in the PKCS11_TOKEN env variable.
+
+    Each operation goes to the least loaded healthy token which has the key,
+    if it fails there it fails over to the next one.
+    """
+
+    size: int = 0
+
+    _slots: List[_Slot] = []
+    _executor: ThreadPoolExecutor
+    _start_lock: asyncio.Lock
+
+    @classmethod
+    def token_labels(cls) -> List[str]:
+        """The token labels in the PKCS11_TOKENS env variable or the one in PKCS11_TOKEN.
+
+        Returns:
+        List[str]
+        """
+
+        if os.environ.get("PKCS11_TOKENS"):
+            return [label.strip() for label in os.environ["PKCS11_TOKENS"].split(",") if label.strip()]
+        return [os.environ["PKCS11_TOKEN"]]
+
+    @classmethod
+    async def start(cls) -> None:
+        """Open the pool sessions if not already open.
+        The number of sessions per token is PKCS11_SESSION_POOL_SIZES for the token or PKCS11_SESSION_POOL_SIZE.
+        A token which can not be opened is left out of the pool, unless all fail.
+
+        Returns:
+        None
+        """
+
+        if cls.size > 0:
+            return
+
+        if not hasattr(cls, "_start_lock"):
+            cls._start_lock = asyncio.Lock()
+
+        async with cls._start_lock:
+            if cls.size > 0:
+                return
+
+            # Let PKCS11Session load the PKCS11 lib and login first
+            await PKCS11Session.healthy_session()
+
+            slots = [
+                _Slot(token_label, PKCS11_SESSION_POOL_SIZES.get(token_label, PKCS11_SESSION_POOL_SIZE))
+                for token_label in cls.token_labels()
+            ]
+            cls._executor = ThreadPoolExecutor(
+                max_workers=sum(slot.size for slot in slots), thread_name_prefix="pkcs11_pool"
+            )
+            loop = asyncio.get_running_loop()
+
+            cls._slots = []
+            for slot in slots:
+                try:
+                    sessions = await loop.run_in_executor(cls._executor, slot.open_sessions)
+                except PKCS11Error as exc:
+                    print(f"Could not open PKCS11 token {slot.token_label}, leaving it out: {exc!r}", flush=True)
+                    continue
+
+                slot.all_sessions = [_PooledSession(session) for session in sessions]
+                for pooled in slot.all_sessions:
+                    slot.sessions.put_nowait(pooled)
+                cls._slots.append(slot)
+                print(f"Opened {slot.size} PKCS11 pool sessions on token {slot.token_label}", flush=True)
+
+            if not cls._slots:
+                raise PKCS11Error("Could not open any PKCS11 token for the session pool")
+            cls.size = sum(slot.size for slot in cls._slots)
+
+    @classmethod
+    def _choose_slot(cls, key: Tuple[str, str], tried: List[_Slot]) -> Union[_Slot, None]:
+        candidates = [slot for slot in cls._slots if slot not in tried]
+        if not candidates:
+            return None
+
+        # Prefer tokens known to have the key and not down, but if none then try the others anyway
+        now = time.monotonic()
+        candidates = [slot for slot in candidates if slot.has_key(key)] or candidates
+        candidates = [slot for slot in candidates if slot.down_until <= now] or candidates
+        return min(candidates, key=lambda slot: slot.load())
+
+    @classmethod
+    async def _run_on_slot(cls, slot: _Slot, func: Callable[..., T], *args: Any) -> T:
+        """Run func(pooled_session, *args) in the executor on a free session in the token.
+        If the session has gone bad then reconnect it and try once more.
+        """
+
+        loop = asyncio.get_running_loop()
+
+        slot.in_flight += 1
+        pooled = await slot.sessions.get()
+        try:
+            try:
+                return await loop.run_in_executor(cls._executor, func, pooled, *args)
+            except NoSuchKey:
+                raise
+            except PKCS11Error:
+                # The session was probably closed, for example by PKCS11Session reinitializing the lib
+                await loop.run_in_executor(cls._executor, slot.reopen_session, pooled)
+                return await loop.run_in_executor(cls._executor, func, pooled, *args)
+        finally:
+            slot.sessions.put_nowait(pooled)
+            slot.in_flight -= 1
+
+    @classmethod
+    async def _run(cls, func: Callable[..., T], key_label: str, key_type: str, *args: Any) -> T:
+        """Run func(pooled_session, key_label, key_type, *args) on the best token for the key,
+        fail over to the other tokens on error. Raises the last error if all tokens failed.
+        """
+
+        await cls.start()
+
+        key = (key_label, key_type)
+        tried: List[_Slot] = []
+        missing: Union[NoSuchKey, None] = None
+        error: Union[PKCS11Error, None] = None
+
+        slot = cls._choose_slot(key, tried)
+        while slot is not None:
+            tried.append(slot)
+            try:
+                result = await cls._run_on_slot(slot, func, key_label, key_type, *args)
+                slot.succeeded()
+                return result
+            except NoSuchKey as exc:
+                slot.missing_keys[key] = time.monotonic() + PKCS11_SLOT_RETRY_SECONDS
+                missing = exc
+            except PKCS11Error as exc:
+                slot.failed(exc)
+                error = exc
+            slot = cls._choose_slot(key, tried)
+
+        # Only report the key as missing if no token failed, callers create the key on NoSuchKey
+        raise error or missing or PKCS11Error("No PKCS11 token in the session pool")
+
+    @classmethod
+    def stats(cls) -> Dict[str, Dict[str, Union[int, float, bool]]]:
+        """Sessions, in flight operations and health per token.
+
+        Returns:
+        Dict[str, Dict[str, Union[int, float, bool]]]
+        """
+
+        now = time.monotonic()
+        return {
+            slot.token_label: {
+                "sessions": slot.size,
+                "in_flight": slot.in_flight,
+                "weight": slot.weight,
+                "failures": slot.failures,
+                "down": slot.down_until > now,
+            }
+            for slot in cls._slots
+        }
+
+    @classmethod
+    async def sign(
+        cls, key_label: str, data: bytes, key_type: str, verify_signature: Union[bool, None] = None
+    ) -> bytes:
+        """Sign the data using the private key with the label in the PKCS11 device.
+        Same signature format as PKCS11Session.sign, waits for a free session in the pool.
+
+        Parameters:
+        key_label (str): Keypair label.
+        data (bytes): Bytes to be signed.
+        key_type (str): Key type.
+        verify_signature (Union[bool, None] = None): If we should verify the signature, default None (False)
+
+        Returns:
+        bytes
+        """
+
+        if key_type not in key_types:
+            raise ValueError(f"key_type must be in {key_types}")
+
+        signature = await cls._run(_PooledSession.sign, key_label, key_type, data, bool(verify_signature))
+
+        # PKCS11 specific stuff for EC curves, sig is in R&S format, convert it to openssl format
+        if key_type in ["secp256r1", "secp384r1", "secp521r1"]:
+            signature = convert_rs_ec_signature(signature, key_type)
+
+        return signature
+
+    @classmethod
+    def digest_size(cls, key_type: str) -> int:
+        """The digest size in bytes which sign_digest expects for the key type.
+        Raises ValueError if the key type signs the full data, only EC key types sign a prehashed digest.
+
+        Parameters:
+        key_type (str): Key type.
+
+        Returns:
+        int
+        """
+
+        if key_type not in _key_type_digests:
+            raise ValueError(f"key_type {key_type} can not sign a prehashed digest")
+        return _digest_sizes[_key_type_digests[key_type]]
+
+    @classmethod
+    async def sign_digest(
+        cls, key_label: str, digest: bytes, key_type: str, verify_signature: Union[bool, None] = None
+    ) -> bytes:
+        """Sign an already hashed digest using the private key with the label in the PKCS11 device.
+        The digest must be made with the hash sign uses for the key type, see digest_size.
+        The signature is the same as sign would give for the data the digest was made from.
+
+        Parameters:
+        key_label (str): Keypair label.
+        digest (bytes): The digest to be signed.
+        key_type (str): Key type.
+        verify_signature (Union[bool, None] = None): If we should verify the signature, default None (False)
+
+        Returns:
+        bytes
+        """
+
+        if len(digest) != cls.digest_size(key_type):
+            raise ValueError(f"digest for key_type {key_type} must be {cls.digest_size(key_type)} bytes")
+
+        signature = await cls._run(_PooledSession.sign_digest, key_label, key_type, digest, bool(verify_signature))
+
+        if key_type in ["secp256r1", "secp384r1", "secp521r1"]:
+            signature = convert_rs_ec_signature(signature, key_type)
+
+        return signature
+
+    @classmethod
+    async def public_key_data(cls, key_label: str, key_type: str) -> Tuple[str, bytes]:
+        """Returns the public key in PEM form and 'Key Identifier' valid for this keypair.
+        Same as PKCS11Session.public_key_data but using the pool and its key handle cache.
+
+        Parameters:
+        key_label (str): Keypair label.
+        key_type (str): Key type.
+
+        Returns:
+        Tuple[str, bytes]
+        """
+
+        if key_type not in key_types:
+            raise ValueError(f"key_type must be in {key_types}")
+
+        return await cls._run(_PooledSession.public_key_data, key_label, key_type)
+
+    @classmethod
+    def forget_key(cls, key_label: str, key_type: str) -> None:
+        """Drop the cached key handles for this key in all pooled sessions.
+        Must be called when a key with this label is created or deleted.
+
+        Parameters:
+        key_label (str): Keypair label.
+        key_type (str): Key type.
+
+        Returns:
+        None
+        """
+
+        for slot in cls._slots:
+            slot.missing_keys.pop((key_label, key_type), None)
+            for pooled in slot.all_sessions:
+                pooled.forget(key_label, key_type)
+
+    @classmethod
+    async def create_keypair(cls, key_label: str, key_type: str) -> Tuple[str, bytes]:
+        """Create a keypair with PKCS11Session.create_keypair and drop any cached handles for its label.
+
+        Parameters:
+        key_label (str): Keypair label.
+        key_type (str): Key type.
+
+        Returns:
+        Tuple[str, bytes]
+        """
+
+        try:
+            return await PKCS11Session.create_keypair(key_label, key_type=key_type)
+        finally:
+            cls.forget_key(key_label, key_type)
+
+    @classmethod
+    async def delete_keypair(cls, key_label: str, key_type: str) -> None:
+        """Delete a keypair with PKCS11Session.delete_keypair and drop any cached handles for its label.
+
+        Parameters:
+        key_label (str): Keypair label.
+        key_type (str): Key type.
+
+        Returns:
+        None
+        """
+
+        try:
+            await PKCS11Session.delete_keypair(key_label, key_type=key_type)
+        finally:
+            cls.forget_key(key_label, key_type)
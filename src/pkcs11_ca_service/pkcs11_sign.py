@@ -1,13 +1,30 @@
 """Module to handle /pkcs11_sign endpoint"""
+import asyncio
 import base64
-from typing import Any, Dict, List
+import binascii
+import json
+from typing import Any, AsyncIterator, Dict, List, Set, Tuple
 
 import jsonschema
 from fastapi import HTTPException
-from fastapi.responses import JSONResponse
-from openapi_schema_validator import validate as openapi_validate
+from fastapi.responses import JSONResponse, StreamingResponse
+from jsonschema.exceptions import best_match
+from openapi_schema_validator import OAS31Validator
 from pkcs11.exceptions import NoSuchKey
-from python_x509_pkcs11.pkcs11_handle import PKCS11Session
+from starlette.requests import ClientDisconnect
+from starlette.types import Receive, Scope, Send
+
+from .config import (
+    PKCS11_SIGN_STREAM_MAX_LINE,
+    PKCS11_SIGN_STREAM_WINDOW,
+    PKCS11_SIGN_VALIDATE_RESPONSE,
+)
+from .metrics import hsm_timer
+from .pkcs11_pool import PKCS11SessionPool
+from .sign_scheduler import SIGN_LANE_POOL, SIGN_PRIORITY_BULK, SignScheduler
+
+# Process wide cache of (key_label, key_type) -> (signer public key PEM, signature algorithm)
+signer_cache: Dict[Tuple[str, str], Tuple[str, str]] = {}
 
 request_schema = {
     "$id": "https://localhost/request.schema.json",
@@ -22,6 +39,7 @@ request_schema = {
                 "encoding": {"type": "string"},
                 "key_label": {"type": "string"},
                 "key_type": {"type": "string"},
+                "prehashed": {"type": "boolean"},
             },
             "required": ["version", "encoding", "key_label", "key_type"],
         },
@@ -67,6 +85,59 @@ response_schema = {
     "required": ["meta", "signature_values"],
 }
 
+# The NDJSON stream, first line is {"meta": {...}} then one {"id": ..., "data": ...} document per line
+stream_meta_schema = {
+    "$id": "https://localhost/stream_meta.schema.json",
+    "$schema": "https://json-schema.org/draft/2020-12/schema",
+    "title": "StreamMeta",
+    "type": "object",
+    "properties": {
+        "meta": {
+            "type": "object",
+            "properties": {
+                "version": {"type": "integer", "minimum": 1},
+                "encoding": {"type": "string"},
+                "key_label": {"type": "string"},
+                "key_type": {"type": "string"},
+                "prehashed": {"type": "boolean"},
+            },
+            "required": ["version", "encoding", "key_label", "key_type"],
+        },
+    },
+    "required": ["meta"],
+}
+stream_document_schema = {
+    "$id": "https://localhost/stream_document.schema.json",
+    "$schema": "https://json-schema.org/draft/2020-12/schema",
+    "title": "StreamDocument",
+    "type": "object",
+    "properties": {"id": {"type": "string"}, "data": {"type": "string"}},
+    "required": ["id", "data"],
+}
+
+# Validators compiled once at import, keyed by schema title
+validators: Dict[str, OAS31Validator] = {}
+for _schema in [request_schema, response_schema, stream_meta_schema, stream_document_schema]:
+    OAS31Validator.check_schema(_schema)
+    validators[str(_schema["title"])] = OAS31Validator(_schema)
+
+
+def schema_validate(instance: Dict[str, Any], title: str) -> None:
+    """Validate the instance with the compiled validator for the schema title.
+    Raises jsonschema.exceptions.ValidationError if invalid.
+
+    Parameters:
+    instance (Dict[str, Any]): The data to validate.
+    title (str): The schema title, for example 'Request'.
+
+    Returns:
+    None
+    """
+
+    error = best_match(validators[title].iter_errors(instance))
+    if error is not None:
+        raise error
+
 
 def validate_input(request: Dict[str, Any]) -> None:
     """Validate the json input with our schema, raises HTTP error 400 if invalid
@@ -79,15 +150,110 @@ def validate_input(request: Dict[str, Any]) -> None:
     """
 
     try:
-        openapi_validate(request, request_schema)  # type: ignore
+        schema_validate(request, "Request")
     except jsonschema.exceptions.ValidationError as exc:
         raise HTTPException(status_code=400, detail=f"Invalid schema try '{request_schema}'") from exc
 
-    key_types = ["secp256r1", "secp384r1", "secp384r1", "ed25519"]
-    if request["meta"]["key_type"] not in key_types:
-        raise HTTPException(
-            status_code=400, detail=f"key_type '{request['meta']['key_type']}' must be one of {key_types}"
+    _validate_key_type(request["meta"]["key_type"], request["meta"].get("prehashed", False))
+
+    for document in request["documents"]:
+        try:
+            _document_data(document, request["meta"]["key_type"], request["meta"].get("prehashed", False))
+        except (ValueError, binascii.Error) as exc:
+            raise HTTPException(status_code=400, detail=f"Invalid document '{document['id']}': {exc}") from exc
+
+
+def _validate_key_type(key_type: str, prehashed: bool) -> None:
+    if prehashed:
+        # EdDSA signs the full document so it can not sign a prehashed digest, see PKCS11SessionPool.digest_size
+        key_types = ["secp256r1", "secp384r1", "secp521r1"]
+        if key_type not in key_types:
+            raise HTTPException(status_code=400, detail=f"prehashed key_type '{key_type}' must be one of {key_types}")
+        return
+
+    key_types = ["secp256r1", "secp384r1", "secp521r1", "ed25519"]
+    if key_type not in key_types:
+        raise HTTPException(status_code=400, detail=f"key_type '{key_type}' must be one of {key_types}")
+
+
+def _document_data(document: Dict[str, str], key_type: str, prehashed: bool) -> bytes:
+    """Decode the document data, if prehashed then the data must be strict base64 of a digest of the size
+    the key type signs. Raises ValueError or binascii.Error if invalid.
+
+    Parameters:
+    document (Dict[str, str]): The document.
+    key_type (str): Key type.
+    prehashed (bool): If the data is a digest of the document.
+
+    Returns:
+    bytes
+    """
+
+    # Normal documents are decoded as they always were, skipping characters outside the base64 alphabet
+    if not prehashed:
+        return base64.b64decode(document["data"])
+
+    data = base64.b64decode(document["data"], validate=True)
+    if len(data) != PKCS11SessionPool.digest_size(key_type):
+        raise ValueError(
+            f"prehashed data for key_type '{key_type}' must be {PKCS11SessionPool.digest_size(key_type)} bytes"
         )
+    return data
+
+
+def _signature_algorithm(key_type: str) -> str:
+    if key_type == "secp256r1":
+        return "sha256_ecdsa"
+    if key_type == "secp384r1":
+        return "sha384_ecdsa"
+    if key_type == "secp521r1":
+        return "sha512_ecdsa"
+    return "ed25519"
+
+
+async def signer_info(key_label: str, key_type: str) -> Tuple[str, str]:
+    """Get the signer public key PEM and signature algorithm for the key, create the key if it does not exist.
+    Cached in signer_cache after the first call for the key.
+
+    Parameters:
+    key_label (str): Keypair label.
+    key_type (str): Key type.
+
+    Returns:
+    Tuple[str, str]
+    """
+
+    cache_key = (key_label, key_type)
+    if cache_key in signer_cache:
+        return signer_cache[cache_key]
+
+    # Get or create pkcs11 key
+    try:
+        with hsm_timer("public_key_data", key_label, key_type):
+            signer_public_key, _ = await PKCS11SessionPool.public_key_data(key_label, key_type)
+    except NoSuchKey:
+        signer_cache.pop(cache_key, None)
+        with hsm_timer("create_keypair", key_label, key_type):
+            signer_public_key, _ = await PKCS11SessionPool.create_keypair(key_label, key_type)
+        print(f"Created pkcs11 key label:{key_label} type:{key_type}")
+
+    signer_cache[cache_key] = (signer_public_key, _signature_algorithm(key_type))
+    return signer_cache[cache_key]
+
+
+async def _sign_document(key_label: str, key_type: str, document: Dict[str, str], prehashed: bool) -> Dict[str, str]:
+    # Raw sign of the client's digest if prehashed, gives the same signature as signing the full document
+    sign = PKCS11SessionPool.sign_digest if prehashed else PKCS11SessionPool.sign
+    signature = await SignScheduler.call(
+        SIGN_PRIORITY_BULK,
+        "sign_digest" if prehashed else "sign",
+        sign,
+        key_label,
+        _document_data(document, key_type, prehashed),
+        key_type=key_type,
+        lane=SIGN_LANE_POOL,
+    )
+    return {"id": document["id"], "signature": base64.b64encode(signature).decode("utf-8")}
 
 
 async def pkcs11_sign(request: Dict[str, Any]) -> JSONResponse:
@@ -102,52 +268,218 @@ async def pkcs11_sign(request: Dict[str, Any]) -> JSONResponse:
     """
 
     result: Dict[str, Any] = {}
-    signed_data: List[Dict[str, str]] = []
 
     # Validate input
     validate_input(request)
 
-    # Get or create pkcs11 key
+    signer_public_key, signature_algorithm = await signer_info(
+        request["meta"]["key_label"], request["meta"]["key_type"]
+    )
+
+    # Sign data entries concurrently over the PKCS11 session pool, gather keeps the request order
     try:
-        signer_public_key, _ = await PKCS11Session.public_key_data(
-            request["meta"]["key_label"], request["meta"]["key_type"]
+        signed_data: List[Dict[str, str]] = await asyncio.gather(
+            *[
+                _sign_document(
+                    request["meta"]["key_label"],
+                    request["meta"]["key_type"],
+                    document,
+                    request["meta"].get("prehashed", False),
+                )
+                for document in request["documents"]
+            ]
         )
     except NoSuchKey:
-        signer_public_key, _ = await PKCS11Session.create_keypair(
-            request["meta"]["key_label"], request["meta"]["key_type"]
-        )
-        print(f"Created pkcs11 key label:{request['meta']['key_label']} type:{request['meta']['key_type']}")
-
-    # Sign data entries
-    for data in request["documents"]:
-        signature: bytes = await PKCS11Session.sign(
-            key_label=request["meta"]["key_label"],
-            data=base64.b64decode(data["data"]),
-            verify_signature=False,
-            key_type=request["meta"]["key_type"],
-        )
-        signed_data.append({"id": data["id"], "signature": base64.b64encode(signature).decode("utf-8")})
+        # The key was removed from the PKCS11 device after it was cached
+        signer_cache.pop((request["meta"]["key_label"], request["meta"]["key_type"]), None)
+        raise
 
     # Create response data
     result["meta"] = {}
     result["meta"]["version"] = 1
     result["meta"]["encoding"] = "base64"
     result["meta"]["signer_public_key"] = signer_public_key
+    result["meta"]["signature_algorithm"] = signature_algorithm
+    result["signature_values"] = signed_data
 
-    if request["meta"]["key_type"] == "secp256r1":
-        result["meta"]["signature_algorithm"] = "sha256_ecdsa"
-    elif request["meta"]["key_type"] == "secp384r1":
-        result["meta"]["signature_algorithm"] = "sha384_ecdsa"
-    elif request["meta"]["key_type"] == "secp521r1":
-        result["meta"]["signature_algorithm"] = "sha512_ecdsa"
-    else:
-        result["meta"]["signature_algorithm"] = "ed25519"
+    if PKCS11_SIGN_VALIDATE_RESPONSE:
+        try:
+            schema_validate(result, "Response")
+        except jsonschema.exceptions.ValidationError as exc:
+            raise HTTPException(
+                status_code=500, detail=f"Error creating valid with schema '{response_schema}'"
+            ) from exc
 
-    result["signature_values"] = signed_data
+    return JSONResponse(status_code=200, content=result)
+
+
+async def _ndjson_lines(body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Split the request body stream into non empty lines, only the current line is kept in memory.
+
+    Parameters:
+    body (AsyncIterator[bytes]): The request body chunks, for example fastapi.Request.stream().
+
+    Returns:
+    AsyncIterator[bytes]
+    """
+
+    buffer = b""
+    async for chunk in body:
+        buffer += chunk
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            if line.strip():
+                yield line
+        if len(buffer) > PKCS11_SIGN_STREAM_MAX_LINE:
+            raise ValueError(f"NDJSON line longer than {PKCS11_SIGN_STREAM_MAX_LINE} bytes")
+    if buffer.strip():
+        yield buffer
+
+
+class _NDJSONStreamingResponse(StreamingResponse):
+    """StreamingResponse whose body iterator is still reading the request body.
+    StreamingResponse listens for the client disconnect on receive() while streaming,
+    that would take request body chunks away from the body iterator. Here only the body iterator calls receive(),
+    a client which goes away while the request body is read ends the stream with ClientDisconnect.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.stream_response(send)
+
+        if self.background is not None:
+            await self.background()
+
+
+def _ndjson_record(record: Dict[str, Any]) -> bytes:
+    return json.dumps(record).encode("utf-8") + b"\n"
+
+
+async def _stream_signatures(
+    key_label: str, key_type: str, prehashed: bool, response_meta: Dict[str, Any], lines: AsyncIterator[bytes]
+) -> AsyncIterator[bytes]:
+    """Sign each document line and write back its signature record as soon as it is done.
+    At most PKCS11_SIGN_STREAM_WINDOW documents are signed at the same time,
+    reading the next line waits until there is room so memory stays flat for any batch size.
+
+    A document which can not be signed gives an {"id": ..., "error": ...} record, the stream continues.
+
+    Parameters:
+    key_label (str): Keypair label.
+    key_type (str): Key type.
+    prehashed (bool): If the document data is a digest of the document.
+    response_meta (Dict[str, Any]): The meta record, written first.
+    lines (AsyncIterator[bytes]): The document lines.
+
+    Returns:
+    AsyncIterator[bytes]
+    """
+
+    pending: Set["asyncio.Task[Dict[str, str]]"] = set()
+    tasks_id: Dict["asyncio.Task[Dict[str, str]]", str] = {}
+
+    def done_records(done: Set["asyncio.Task[Dict[str, str]]"]) -> bytes:
+        records = b""
+        for task in done:
+            document_id = tasks_id.pop(task)
+            exc = task.exception()
+            if exc is None:
+                records += _ndjson_record(task.result())
+            elif isinstance(exc, NoSuchKey):
+                signer_cache.pop((key_label, key_type), None)
+                records += _ndjson_record({"id": document_id, "error": "Signing key not found"})
+            else:
+                print(f"Failed to sign NDJSON document {document_id}: {exc!r}")
+                records += _ndjson_record({"id": document_id, "error": "Failed to sign document"})
+        return records
+
+    yield _ndjson_record({"meta": response_meta})
 
     try:
-        openapi_validate(result, response_schema)  # type: ignore
-    except jsonschema.exceptions.ValidationError as exc:
-        raise HTTPException(status_code=500, detail=f"Error creating valid with schema '{response_schema}'") from exc
+        line_number = 1
+        async for line in lines:
+            line_number += 1
+            document: Any = None
+            try:
+                document = json.loads(line)
+                schema_validate(document, "StreamDocument")
+                _document_data(document, key_type, prehashed)
+            except (ValueError, binascii.Error, jsonschema.exceptions.ValidationError):
+                yield _ndjson_record(
+                    {
+                        "id": document.get("id") if isinstance(document, dict) else None,
+                        "error": f"Invalid document on line {line_number}, try '{stream_document_schema}'",
+                    }
+                )
+                continue
 
-    return JSONResponse(status_code=200, content=result)
+            task = asyncio.ensure_future(_sign_document(key_label, key_type, document, prehashed))
+            pending.add(task)
+            tasks_id[task] = document["id"]
+
+            # Wait for room in the window, otherwise just write back what has finished so far
+            if len(pending) >= PKCS11_SIGN_STREAM_WINDOW:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                done = {task for task in pending if task.done()}
+                pending -= done
+            if done:
+                yield done_records(done)
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            yield done_records(done)
+
+    except ValueError as exc:
+        yield _ndjson_record({"id": None, "error": str(exc)})
+
+    except ClientDisconnect:
+        print("Client disconnected during NDJSON pkcs11_sign")
+
+    finally:
+        # Client went away or the body was broken, no need to sign the rest
+        for task in pending:
+            task.cancel()
+
+
+async def pkcs11_sign_stream(body: AsyncIterator[bytes]) -> StreamingResponse:
+    """Sign NDJSON input using a key in a pkcs11 device, streaming the signatures back as NDJSON.
+    The first input line is {"meta": {...}} as in the request schema, then one {"id": ..., "data": ...} per line.
+    The first output line is {"meta": {...}} as in the response schema, then one {"id": ..., "signature": ...}
+    per line in the order the signatures complete.
+    Raises HTTP error 400 if the meta line is invalid, errors after that are written as error records.
+
+    Parameters:
+    body (AsyncIterator[bytes]): The request body chunks.
+
+    Returns:
+    fastapi.responses.StreamingResponse
+    """
+
+    lines = _ndjson_lines(body)
+
+    try:
+        meta_line = await lines.__anext__()
+        request = json.loads(meta_line)
+        schema_validate(request, "StreamMeta")
+    except (StopAsyncIteration, ValueError, jsonschema.exceptions.ValidationError) as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid meta line try '{stream_meta_schema}'") from exc
+
+    key_label: str = request["meta"]["key_label"]
+    key_type: str = request["meta"]["key_type"]
+    prehashed: bool = request["meta"].get("prehashed", False)
+    _validate_key_type(key_type, prehashed)
+
+    signer_public_key, signature_algorithm = await signer_info(key_label, key_type)
+
+    response_meta = {
+        "version": 1,
+        "encoding": "base64",
+        "signer_public_key": signer_public_key,
+        "signature_algorithm": signature_algorithm,
+    }
+
+    return _NDJSONStreamingResponse(
+        _stream_signatures(key_label, key_type, prehashed, response_meta, lines),
+        status_code=200,
+        media_type="application/x-ndjson",
+    )
@@ -48,6 +48,7 @@ from .config import (
     ROOT_CA_NAME_DICT,
 )
 from .error import WrongDataType
+from .revoked_index import crl_revoked_entries
 
 # asyncpg is safe from sql injections when using parameterized queries
 # https://github.com/MagicStack/asyncpg/issues/822
@@ -170,6 +171,23 @@ class PostgresDB(DataBaseObject):
 
         return fields_list
 
+    @classmethod
+    async def load_any(
+        cls, table_name: str, field: str, values: List[str], fields: List[str]
+    ) -> List[Dict[str, Union[str, int]]]:
+        query = "SELECT " + ",".join(fields) + " FROM " + table_name + " WHERE "
+        async with cls.pool.acquire() as conn:
+            async with conn.transaction():
+                if field == "pem":
+                    # Use the md5(pem) unique index
+                    query += "md5(pem) = ANY($1::text[]) AND pem = ANY($2::text[])"
+                    md5_hashes = [hashlib.md5(value.encode("utf-8")).hexdigest() for value in values]
+                    rows = await conn.fetch(query, md5_hashes, values)
+                else:
+                    query += field + " = ANY($1::text[])"
+                    rows = await conn.fetch(query, values)
+        return cls._rows_to_class_objects(rows, fields)
+
     @classmethod
     async def _drop_all_tables(cls, tables: List[str]) -> None:
         async with cls.pool.acquire() as conn:
@@ -291,13 +309,38 @@ class PostgresDB(DataBaseObject):
                 return ret
 
     @classmethod
-    async def startup(
-        cls,
-        tables: List[str],
-        fields: List[Dict[str, Union[Type[str], Type[int]]]],
-        reference_fields: List[Dict[str, str]],
-        unique_fields: List[List[str]],
-    ) -> bool:
+    async def unexpired_certificates(cls) -> Dict[str, List[int]]:
+        async with cls.pool.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch("SELECT serial, pem FROM ca")
+                ca_pems: Dict[int, str] = {row[0]: row[1] for row in rows}
+
+                query = (
+                    "SELECT issuer, serial_number FROM certificate WHERE not_after::timestamptz > now() "
+                    + "UNION ALL SELECT issuer, serial_number FROM ca WHERE serial != issuer "
+                    + "AND not_after::timestamptz > now()"
+                )
+                rows = await conn.fetch(query)
+
+                ret: Dict[str, List[int]] = {}
+                for row in rows:
+                    ret.setdefault(ca_pems[row[0]], []).append(int(row[1]))
+                return ret
+
+    @classmethod
+    async def issued_pems(cls, issuer: int, serial_numbers: List[int]) -> List[str]:
+        async with cls.pool.acquire() as conn:
+            async with conn.transaction():
+                query = (
+                    "SELECT pem FROM certificate WHERE issuer = $1 AND serial_number = ANY($2::text[]) "
+                    + "UNION ALL SELECT pem FROM ca WHERE issuer = $1 AND serial != issuer "
+                    + "AND serial_number = ANY($2::text[])"
+                )
+                rows = await conn.fetch(query, issuer, [str(serial_number) for serial_number in serial_numbers])
+                return [row[0] for row in rows]
+
+    @classmethod
+    async def connect(cls) -> bool:
         for env_var in [
             "POSTGRES_HOST",
             "POSTGRES_PORT",
@@ -347,6 +390,165 @@ class PostgresDB(DataBaseObject):
                 )
         else:
             return False
+        return True
+
+    @classmethod
+    async def _init_ocsp_response_table(cls) -> None:
+        async with cls.pool.acquire() as conn:
+            async with conn.transaction():
+                query = (
+                    "CREATE TABLE IF NOT EXISTS ocsp_response (hash_algorithm BYTEA NOT NULL, "
+                    + "issuer_name_hash BYTEA NOT NULL, issuer_key_hash BYTEA NOT NULL, serial_number TEXT NOT NULL, "
+                    + "response BYTEA NOT NULL, expires TIMESTAMPTZ NOT NULL, "
+                    + "PRIMARY KEY (hash_algorithm, issuer_name_hash, issuer_key_hash, serial_number))"
+                )
+                await conn.execute(query)
+                await conn.execute(
+                    "CREATE INDEX IF NOT EXISTS ocsp_response_serial_number_idx ON ocsp_response(serial_number)"
+                )
+
+    @classmethod
+    async def _init_serial_number_indexes(cls) -> None:
+        # For revocation by serial number, see load_any
+        async with cls.pool.acquire() as conn:
+            async with conn.transaction():
+                for table in ["certificate", "ca"]:
+                    await conn.execute(
+                        "CREATE INDEX IF NOT EXISTS " + table + "_serial_number_idx ON " + table + "(serial_number)"
+                    )
+
+    @classmethod
+    async def _init_revocation_table(cls) -> None:
+        async with cls.pool.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch("SELECT to_regclass('revocation')")
+                if rows[0][0] is not None:
+                    return
+
+                query = (
+                    "CREATE TABLE revocation (issuer BIGINT NOT NULL REFERENCES ca(serial), "
+                    + "serial_number TEXT NOT NULL, revoked_at TIMESTAMPTZ NOT NULL, reason INTEGER, "
+                    + "PRIMARY KEY (issuer, serial_number))"
+                )
+                await conn.execute(query)
+
+                # Existing databases have their revocations in each CA's latest CRL
+                rows = await conn.fetch("SELECT DISTINCT ON (issuer) issuer, pem FROM crl ORDER BY issuer, serial DESC")
+                for row in rows:
+                    await conn.executemany(
+                        "INSERT INTO revocation (issuer, serial_number, revoked_at, reason) VALUES ($1, $2, $3, $4)",
+                        [
+                            (
+                                row[0],
+                                str(serial_number),
+                                revoked_at,
+                                None if reason is None else int.from_bytes(reason.contents, "big"),
+                            )
+                            for serial_number, (revoked_at, reason) in crl_revoked_entries(row[1]).items()
+                        ],
+                    )
+                    print("Copied revocations from the CRL for CA " + str(row[0]) + " into the revocation table")
+
+    @classmethod
+    async def save_revocations(
+        cls,
+        issuer: int,
+        revocations: List[Tuple[int, Union[int, None]]],
+        revoked_at: datetime.datetime,
+        crl_fields: Dict[str, Union[str, int]],
+    ) -> None:
+        async with cls.pool.acquire() as conn:
+            async with conn.transaction():
+                query = (
+                    "INSERT INTO revocation (issuer, serial_number, revoked_at, reason) VALUES ($1, $2, $3, $4) "
+                    + "ON CONFLICT (issuer, serial_number) DO UPDATE SET reason = EXCLUDED.reason"
+                )
+                await conn.executemany(
+                    query, [(issuer, str(serial_number), revoked_at, reason) for serial_number, reason in revocations]
+                )
+
+                query = (
+                    "INSERT INTO crl ("
+                    + ",".join(crl_fields)
+                    + ") VALUES ("
+                    + ",".join("$" + str(index + 1) for index in range(len(crl_fields)))
+                    + ")"
+                )
+                await conn.execute(query, *crl_fields.values())
+
+    @classmethod
+    async def revocation(
+        cls, issuer: int, serial_number: int
+    ) -> Union[Tuple[datetime.datetime, Union[int, None]], None]:
+        async with cls.pool.acquire() as conn:
+            query = "SELECT revoked_at, reason FROM revocation WHERE issuer = $1 AND serial_number = $2"
+            rows = await conn.fetch(query, issuer, str(serial_number))
+            if not rows:
+                return None
+            return rows[0][0], rows[0][1]
+
+    @classmethod
+    async def revocations(cls, issuer: int) -> Dict[int, Tuple[datetime.datetime, Union[int, None]]]:
+        ret: Dict[int, Tuple[datetime.datetime, Union[int, None]]] = {}
+        async with cls.pool.acquire() as conn:
+            async with conn.transaction():
+                query = "SELECT serial_number, revoked_at, reason FROM revocation WHERE issuer = $1"
+                async for row in conn.cursor(query, issuer, prefetch=10000):
+                    ret[int(row[0])] = (row[1], row[2])
+        return ret
+
+    @classmethod
+    async def save_ocsp_response(
+        cls, cert_id: Tuple[bytes, bytes, bytes, int], response: bytes, expires: datetime.datetime
+    ) -> None:
+        async with cls.pool.acquire() as conn:
+            async with conn.transaction():
+                query = (
+                    "INSERT INTO ocsp_response (hash_algorithm, issuer_name_hash, issuer_key_hash, serial_number, "
+                    + "response, expires) VALUES ($1, $2, $3, $4, $5, $6) "
+                    + "ON CONFLICT (hash_algorithm, issuer_name_hash, issuer_key_hash, serial_number) "
+                    + "DO UPDATE SET response = EXCLUDED.response, expires = EXCLUDED.expires"
+                )
+                await conn.execute(query, cert_id[0], cert_id[1], cert_id[2], str(cert_id[3]), response, expires)
+
+    @classmethod
+    async def load_ocsp_response(cls, cert_id: Tuple[bytes, bytes, bytes, int]) -> Union[bytes, None]:
+        async with cls.pool.acquire() as conn:
+            query = (
+                "SELECT response FROM ocsp_response WHERE hash_algorithm = $1 AND issuer_name_hash = $2 "
+                + "AND issuer_key_hash = $3 AND serial_number = $4 AND expires > now()"
+            )
+            rows = await conn.fetch(query, cert_id[0], cert_id[1], cert_id[2], str(cert_id[3]))
+            if not rows:
+                return None
+            ret: bytes = rows[0][0]
+            return ret
+
+    @classmethod
+    async def delete_ocsp_responses(cls, serial_numbers: Union[List[int], None] = None) -> None:
+        async with cls.pool.acquire() as conn:
+            async with conn.transaction():
+                if serial_numbers is None:
+                    await conn.execute("DELETE FROM ocsp_response WHERE expires <= now()")
+                else:
+                    await conn.execute(
+                        "DELETE FROM ocsp_response WHERE serial_number = ANY($1::text[])",
+                        [str(serial_number) for serial_number in serial_numbers],
+                    )
+
+    @classmethod
+    async def startup(
+        cls,
+        tables: List[str],
+        fields: List[Dict[str, Union[Type[str], Type[int]]]],
+        reference_fields: List[Dict[str, str]],
+        unique_fields: List[List[str]],
+    ) -> bool:
+        if not await cls.connect():
+            return False
+
+        # Created separately so it is added to existing databases too
+        await cls._init_ocsp_response_table()
 
         classes_info: Dict[str, List[str]] = {}
         for index, table in enumerate(tables):
@@ -441,6 +643,10 @@ class PostgresDB(DataBaseObject):
 
             await cls._insert_healthcheck_key(classes_info)
 
+        # After the ca table exists, created separately so it is added to existing databases too
+        await cls._init_revocation_table()
+        await cls._init_serial_number_indexes()
+
         # Load trusted keys
         await cls._load_trusted_keys(classes_info)
 
@@ -0,0 +1,261 @@
+"""Module which revokes certificates and renders each CA's CRL from the revocation table
+
+The revocation table is the source of truth for revocations. A revocation renders the CA's CRL once
+from all its rows and the new revocations and signs it, the previous CRL is only read for its
+extensions and CRL number. The new rows and the new CRL are then saved in one transaction so
+revocation checks, point queries see DataBaseObject.revocation, never disagree with the CRL.
+
+A certificate revoked again keeps its revocation time and gets the new reason, RFC 5280 section 5.3.1,
+except that a compromise reason is never replaced.
+
+Exposes the functions:
+- revoke_certificates
+- revoke_certificate
+- render_crl
+- sign_crl
+"""
+import asyncio
+import datetime
+from typing import Dict, List, Tuple, Union
+
+from asn1crypto import crl as asn1_crl
+from asn1crypto import pem as asn1_pem
+from asn1crypto import x509 as asn1_x509
+from python_x509_pkcs11.lib import signed_digest_algo
+
+from .base import DataBaseObject
+from .crl import Crl
+from .crl_cache import CRLCache
+from .pkcs11_pool import PKCS11SessionPool
+from .revoked_index import RevokedEntry, RevokedSerialIndex
+from .sign_scheduler import SIGN_LANE_POOL, SIGN_PRIORITY_ISSUANCE, SignScheduler
+
+# CRL reason codes, RFC 5280 section 5.3.1
+CRL_REASONS = [0, 1, 2, 3, 4, 5, 6, 8, 9, 10]
+
+# key_compromise, ca_compromise and aa_compromise, never replaced by a later revocation's reason
+COMPROMISE_REASONS = [1, 2, 10]
+
+# One CRL rendering at a time per CA, a CRL signed from older rows must not be saved after a newer one
+_locks: Dict[int, asyncio.Lock] = {}
+
+
+def _revoked_certificate(
+    serial_number: int, revocation_date: datetime.datetime, reason: Union[asn1_crl.CRLReason, None]
+) -> asn1_crl.RevokedCertificate:
+    revoked_cert = asn1_crl.RevokedCertificate()
+    revoked_cert["user_certificate"] = serial_number
+    revoked_cert["revocation_date"] = asn1_x509.Time(name="utc_time", value=revocation_date.replace(microsecond=0))
+    if reason is not None:
+        crl_entry_exts = asn1_crl.CRLEntryExtensions()
+        crl_entry_ext = asn1_crl.CRLEntryExtension()
+        crl_entry_ext["extn_id"] = asn1_crl.CRLEntryExtensionId("2.5.29.21")
+        crl_entry_ext["extn_value"] = reason
+        crl_entry_exts.append(crl_entry_ext)
+        revoked_cert["crl_entry_extensions"] = crl_entry_exts
+    return revoked_cert
+
+
+async def sign_crl(  # pylint: disable=too-many-arguments
+    key_label: str,
+    key_type: str,
+    issuer_name: asn1_x509.Name,
+    revoked: Dict[int, RevokedEntry],
+    *,
+    next_update: datetime.datetime,
+    crl_extensions: asn1_crl.TBSCertListExtensions,
+    operation: str,
+) -> bytes:
+    """Sign a CRL with the entries and extensions, this_update is now.
+
+    Parameters:
+    key_label (str): The CA's keypair label.
+    key_type (str): The CA's key type.
+    issuer_name (asn1crypto.x509.Name): The CA's subject name.
+    revoked (Dict[int, RevokedEntry]): Serial number -> revocation time and reason.
+    next_update (datetime.datetime): The CRL's next_update.
+    crl_extensions (asn1crypto.crl.TBSCertListExtensions): The CRL's extensions.
+    operation (str): Operation name for the sign scheduler metrics.
+
+    Returns:
+    bytes
+    """
+
+    revoked_certs = asn1_crl.RevokedCertificates()
+    for serial_number, (revocation_date, reason) in revoked.items():
+        revoked_certs.append(_revoked_certificate(serial_number, revocation_date, reason))
+
+    tbs = asn1_crl.TbsCertList()
+    tbs["version"] = "v2"
+    tbs["signature"] = signed_digest_algo(key_type)
+    tbs["issuer"] = issuer_name
+    # -2 minutes to protect from the certificate readers time skew, as python_x509_pkcs11 does
+    tbs["this_update"] = asn1_x509.Time(
+        name="utc_time",
+        value=(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=2)).replace(microsecond=0),
+    )
+    tbs["next_update"] = asn1_x509.Time(name="utc_time", value=next_update.replace(microsecond=0))
+    if len(revoked_certs) > 0:
+        tbs["revoked_certificates"] = revoked_certs
+    tbs["crl_extensions"] = crl_extensions
+
+    signature = await SignScheduler.call(
+        SIGN_PRIORITY_ISSUANCE,
+        operation,
+        PKCS11SessionPool.sign,
+        key_label,
+        tbs.dump(),
+        key_type=key_type,
+        lane=SIGN_LANE_POOL,
+    )
+
+    crl = asn1_crl.CertificateList()
+    crl["tbs_cert_list"] = tbs
+    crl["signature_algorithm"] = tbs["signature"]
+    crl["signature"] = signature
+    crl_der: bytes = crl.dump()
+    return crl_der
+
+
+def _next_crl_extensions(old_crl: asn1_crl.CertificateList) -> asn1_crl.TBSCertListExtensions:
+    # Keep the old CRL's extensions, the authority key identifier, and increase the CRL number
+    crl_exts = asn1_crl.TBSCertListExtensions()
+    for crl_ext in old_crl["tbs_cert_list"]["crl_extensions"]:
+        if crl_ext["extn_id"].dotted != "2.5.29.20":
+            crl_exts.append(crl_ext)
+    crl_number = asn1_crl.TBSCertListExtension()
+    crl_number["extn_id"] = asn1_crl.TBSCertListExtensionId("2.5.29.20")
+    crl_number["extn_value"] = 1 if old_crl.crl_number_value is None else old_crl.crl_number_value.native + 1
+    crl_exts.append(crl_number)
+    return crl_exts
+
+
+def _merge_revocations(
+    rows: Dict[int, Tuple[datetime.datetime, Union[int, None]]],
+    revocations: List[Tuple[int, int]],
+    revoked_at: datetime.datetime,
+) -> Dict[int, Union[int, None]]:
+    # Add the revocations to the CA's rows, return the new and changed rows to save together with the CRL
+    changed: Dict[int, Union[int, None]] = {}
+    for serial_number, reason in revocations:
+        row = rows.get(serial_number)
+        if row is None:
+            rows[serial_number] = (revoked_at, reason)
+            changed[serial_number] = reason
+        elif row[1] != reason and row[1] not in COMPROMISE_REASONS:
+            rows[serial_number] = (row[0], reason)
+            changed[serial_number] = reason
+    return changed
+
+
+async def _render_crl(
+    db: DataBaseObject,
+    issuer: int,
+    auth_by: int,
+    revocations: Union[List[Tuple[int, int]], None] = None,
+) -> str:
+    revoke_data = await db.revoke_data_for_ca(issuer)
+    _, _, data = asn1_pem.unarmor(revoke_data["crl"].encode("utf-8"))
+    old_crl = asn1_crl.CertificateList.load(data)
+
+    rows = await db.revocations(issuer)
+    revoked_at = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    changed = _merge_revocations(rows, revocations or [], revoked_at)
+
+    entries: Dict[int, RevokedEntry] = {
+        serial_number: (row_revoked_at, None if reason is None else asn1_crl.CRLReason(reason))
+        for serial_number, (row_revoked_at, reason) in rows.items()
+    }
+
+    crl_der = await sign_crl(
+        revoke_data["key_label"],
+        revoke_data["key_type"],
+        old_crl["tbs_cert_list"]["issuer"],
+        entries,
+        next_update=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1),
+        crl_extensions=_next_crl_extensions(old_crl),
+        operation="create_crl",
+    )
+    crl_pem: str = asn1_pem.armor("X509 CRL", crl_der).decode("utf-8")
+
+    crl_obj = Crl(
+        {
+            "pem": crl_pem,
+            "issuer": issuer,
+            "authorized_by": auth_by,
+        }
+    )
+    if len(changed) > 0:
+        await db.save_revocations(issuer, list(changed.items()), revoked_at, crl_obj.db_data())
+    else:
+        await crl_obj.save()
+
+    # The new CRL is saved, index and cache it
+    RevokedSerialIndex.update(issuer, crl_pem, entries)
+    CRLCache.put(issuer, crl_pem)
+    return crl_pem
+
+
+async def render_crl(db: DataBaseObject, issuer: int, auth_by: int) -> str:
+    """Render, sign and save a new CRL for the CA from its rows in the revocation table.
+
+    Parameters:
+    db (DataBaseObject): The database.
+    issuer (int): The CA's DB serial.
+    auth_by (int): Who is the author, comes from the auth.py file
+
+    Returns:
+    str
+    """
+
+    if issuer not in _locks:
+        _locks[issuer] = asyncio.Lock()
+
+    async with _locks[issuer]:
+        return await _render_crl(db, issuer, auth_by)
+
+
+async def revoke_certificates(db: DataBaseObject, issuer: int, revocations: List[Tuple[int, int]], auth_by: int) -> str:
+    """Render the CA's new CRL once with the revocations of certificates issued by the CA and save
+    the revocations in the revocation table together with the CRL in one transaction. Return the new CRL.
+
+    Certificates already revoked keep their revocation time and get the new reason unless revoked
+    for a compromise reason, the CRL is still rendered.
+
+    Parameters:
+    db (DataBaseObject): The database.
+    issuer (int): The issuer CA's DB serial.
+    revocations (List[Tuple[int, int]]): Certificate serial number and CRL reason code.
+    auth_by (int): The revoker public key DB id
+
+    Returns:
+    str
+    """
+
+    for _, reason in revocations:
+        if reason not in CRL_REASONS:
+            raise ValueError(f"ERROR: CRL reason must be in {CRL_REASONS}")
+
+    if issuer not in _locks:
+        _locks[issuer] = asyncio.Lock()
+
+    async with _locks[issuer]:
+        return await _render_crl(db, issuer, auth_by, list(revocations))
+
+
+async def revoke_certificate(db: DataBaseObject, issuer: int, serial_number: int, reason: int, auth_by: int) -> str:
+    """Save the revocation in the revocation table and render the CA's new CRL. Return the new CRL.
+    See revoke_certificates.
+
+    Parameters:
+    db (DataBaseObject): The database.
+    issuer (int): The issuer CA's DB serial.
+    serial_number (int): Certificate serial number.
+    reason (int): CRL reason code.
+    auth_by (int): The revoker public key DB id
+
+    Returns:
+    str
+    """
+
+    return await revoke_certificates(db, issuer, [(serial_number, reason)], auth_by)
@@ -0,0 +1,106 @@
+"""Module which indexes the revoked serial numbers in each CA's CRL
+
+Parsing a CRL with 100k+ entries for every OCSP request is slow, so each CA's CRL is
+indexed once into a dict of serial number -> (revocation time, reason).
+The index is replaced when the CA gets a new CRL, see RevokedSerialIndex.update.
+
+Exposes the class:
+- RevokedSerialIndex
+"""
+import datetime
+from typing import Dict, Tuple, Union
+
+from asn1crypto import crl as asn1_crl
+from cryptography.x509 import CRLReason, ExtensionNotFound, load_pem_x509_crl
+
+# (revocation time, revocation reason)
+RevokedEntry = Tuple[datetime.datetime, Union[asn1_crl.CRLReason, None]]
+
+
+def crl_revoked_entries(crl_pem: str) -> Dict[int, RevokedEntry]:
+    """The revoked entries in the CRL, serial number -> revocation time and reason.
+
+    Parameters:
+    crl_pem (str): CRL in PEM form.
+
+    Returns:
+    Dict[int, RevokedEntry]
+    """
+
+    # cryptography parses the revoked entries many times faster than asn1crypto
+    crl = load_pem_x509_crl(crl_pem.encode("utf-8"))
+
+    entries: Dict[int, RevokedEntry] = {}
+    for revoked in crl:
+        try:
+            reason = asn1_crl.CRLReason(revoked.extensions.get_extension_for_class(CRLReason).value.reason.name)
+        except ExtensionNotFound:
+            reason = None
+        entries[revoked.serial_number] = (revoked.revocation_date.replace(tzinfo=datetime.timezone.utc), reason)
+    return entries
+
+
+class RevokedSerialIndex:
+    """Revoked serial numbers per CA"""
+
+    # CA DB serial -> (the CRL PEM the index was built from, serial number -> revoked entry)
+    _indexes: Dict[int, Tuple[str, Dict[int, RevokedEntry]]] = {}
+
+    @classmethod
+    def update(cls, ca_serial: int, crl_pem: str, entries: Union[Dict[int, RevokedEntry], None] = None) -> None:
+        """Index the CA's new CRL and replace the old index.
+
+        Parameters:
+        ca_serial (int): The CA's DB serial.
+        crl_pem (str): The CA's current CRL in PEM form.
+        entries (Union[Dict[int, RevokedEntry], None] = None): The CRL's entries if known, else parsed from the CRL.
+
+        Returns:
+        None
+        """
+
+        if entries is None:
+            entries = crl_revoked_entries(crl_pem)
+
+        # Build first, then swap, lookups never see a partial index
+        cls._indexes[ca_serial] = (crl_pem, entries)
+
+    @classmethod
+    def revoked(cls, ca_serial: int, crl_pem: str, serial_number: int) -> Union[RevokedEntry, None]:
+        """The revocation time and reason if the serial number is revoked in the CA's CRL, else None.
+        The index is rebuilt if crl_pem is not the CRL it was built from.
+
+        Parameters:
+        ca_serial (int): The CA's DB serial.
+        crl_pem (str): The CA's current CRL in PEM form.
+        serial_number (int): Certificate serial number.
+
+        Returns:
+        Union[RevokedEntry, None]
+        """
+
+        current = cls._indexes.get(ca_serial)
+        if current is None or current[0] != crl_pem:
+            cls.update(ca_serial, crl_pem)
+            current = cls._indexes[ca_serial]
+        return current[1].get(serial_number)
+
+    @classmethod
+    def revoked_since(cls, ca_serial: int, crl_pem: str, since: datetime.datetime) -> Dict[int, RevokedEntry]:
+        """The entries in the CA's CRL revoked at or after since, for delta CRLs.
+        The index is rebuilt if crl_pem is not the CRL it was built from.
+
+        Parameters:
+        ca_serial (int): The CA's DB serial.
+        crl_pem (str): The CA's current CRL in PEM form.
+        since (datetime.datetime): Earliest revocation time.
+
+        Returns:
+        Dict[int, RevokedEntry]
+        """
+
+        current = cls._indexes.get(ca_serial)
+        if current is None or current[0] != crl_pem:
+            cls.update(ca_serial, crl_pem)
+            current = cls._indexes[ca_serial]
+        return {serial_number: entry for serial_number, entry in current[1].items() if entry[0] >= since}
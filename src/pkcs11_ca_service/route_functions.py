@@ -1,10 +1,10 @@
 """Route functions"""
 
+from typing import Dict, List, Tuple, Union
+
 from fastapi import HTTPException
-from fastapi.responses import JSONResponse
-from python_x509_pkcs11.crl import create as create_crl
+from fastapi.responses import JSONResponse, PlainTextResponse
 from python_x509_pkcs11.csr import sign_csr as pkcs11_sign_csr
-from python_x509_pkcs11.pkcs11_handle import PKCS11Session
 
 from .asn1 import (
     aia_and_cdp_exts,
@@ -13,14 +13,25 @@ from .asn1 import (
     crl_expired,
     pem_cert_to_name_dict,
 )
-from .base import db_load_data_class
+from .base import DataClassObject, db_load_data_class
 from .ca import Ca, CaInput
 from .certificate import Certificate
 from .config import HEALTHCHECK_KEY_LABEL, HEALTHCHECK_KEY_TYPE
-from .crl import Crl
+from .crl_cache import CRLCache
 from .csr import Csr
+from .metrics import hsm_metrics_lines, prometheus_lines
+from .ocsp_cache import OCSPResponseCache
+from .ocsp_issuers import OCSPIssuerCache
 from .pkcs11_key import Pkcs11Key, Pkcs11KeyInput
+from .pkcs11_pool import PKCS11SessionPool
 from .public_key import PublicKey, PublicKeyInput
+from .revocation import CRL_REASONS, render_crl, revoke_certificates
+from .sign_scheduler import (
+    SIGN_LANE_LIBRARY,
+    SIGN_LANE_POOL,
+    SIGN_PRIORITY_ISSUANCE,
+    SignScheduler,
+)
 
 
 async def healthcheck() -> JSONResponse:
@@ -37,8 +48,15 @@ async def healthcheck() -> JSONResponse:
 
         # Sign some data
         data_to_be_signed = b"healthcheck"
-        signature = await PKCS11Session.sign(
-            HEALTHCHECK_KEY_LABEL, data_to_be_signed, verify_signature=True, key_type=HEALTHCHECK_KEY_TYPE
+        signature = await SignScheduler.call(
+            SIGN_PRIORITY_ISSUANCE,
+            "sign",
+            PKCS11SessionPool.sign,
+            HEALTHCHECK_KEY_LABEL,
+            data_to_be_signed,
+            verify_signature=True,
+            key_type=HEALTHCHECK_KEY_TYPE,
+            lane=SIGN_LANE_POOL,
         )
         if len(signature) < 5:
             raise HTTPException(status_code=503, detail="Failed healthcheck")
@@ -49,6 +67,49 @@ async def healthcheck() -> JSONResponse:
         raise HTTPException(status_code=503, detail="Failed healthcheck") from exception
 
 
+async def metrics() -> PlainTextResponse:
+    """HSM operation latency and errors, signing queues and PKCS11 token health in the Prometheus text format.
+
+    Returns:
+    PlainTextResponse
+    """
+
+    lines = hsm_metrics_lines()
+
+    scheduler_stats = SignScheduler.stats()
+    for stat, metric_type, help_text in [
+        ("queue_depth", "gauge", "Signing jobs waiting in the scheduler."),
+        ("jobs_total", "counter", "Signing jobs dispatched by the scheduler."),
+        ("wait_seconds_total", "counter", "Total seconds signing jobs waited in the scheduler."),
+        ("wait_seconds_max", "gauge", "Longest seconds a signing job waited in the scheduler."),
+    ]:
+        lines += prometheus_lines(
+            f"pkcs11_ca_sign_scheduler_{stat}",
+            metric_type,
+            help_text,
+            [({"priority": priority}, stats[stat]) for priority, stats in scheduler_stats.items()],
+        )
+
+    pool_stats = PKCS11SessionPool.stats()
+    for stat, help_text in [
+        ("sessions", "Pooled PKCS11 sessions on the token."),
+        ("in_flight", "PKCS11 operations in flight on the token."),
+        ("weight", "Health weight of the token, 1 is healthy."),
+        ("down", "1 if the token is taken out of use after failures."),
+    ]:
+        lines += prometheus_lines(
+            f"pkcs11_ca_token_{stat}",
+            "gauge",
+            help_text,
+            [
+                ({"token": token}, int(stats[stat]) if stat == "down" else stats[stat])
+                for token, stats in pool_stats.items()
+            ],
+        )
+
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
 async def public_key_request(public_key_input: PublicKeyInput) -> PublicKey:
     """Get public key object.
 
@@ -117,31 +178,65 @@ async def crl_request(auth_by: int, issuer_obj: Ca) -> str:
     str
     """
 
+    # The cached CRL is current until its next_update
+    cached = CRLCache.get(issuer_obj.serial)
+    if cached is not None:
+        return cached[0]
+
     revoke_data = await issuer_obj.db.revoke_data_for_ca(issuer_obj.serial)
 
     # If CRL has not expired
     curr_crl: str = revoke_data["crl"]
 
     if not crl_expired(curr_crl):
+        CRLCache.put(issuer_obj.serial, curr_crl)
         return curr_crl
 
-    # Create a new CRL
-    issuer_pkcs11_key_obj = await pkcs11_key_request(Pkcs11KeyInput(serial=issuer_obj.pkcs11_key))
-    crl_pem = await create_crl(
-        issuer_pkcs11_key_obj.key_label,
-        pem_cert_to_name_dict(issuer_obj.pem),
-        old_crl_pem=curr_crl,
-        key_type=issuer_pkcs11_key_obj.key_type,
-    )
-    crl_obj = Crl(
-        {
-            "pem": crl_pem,
-            "authorized_by": auth_by,
-            "issuer": issuer_obj.serial,
-        }
-    )
-    await crl_obj.save()
-    return crl_pem
+    # Render a new CRL from the revocation table
+    return await render_crl(issuer_obj.db, issuer_obj.serial, auth_by)
+
+
+async def revoke_bulk(auth_by: int, targets: List[Tuple[Union[Certificate, Ca], Union[int, None]]]) -> None:
+    """Revoke the certificates and CAs, signing each issuer's new CRL once.
+
+    All targets are validated before any is revoked so an invalid target revokes nothing.
+    Revoking one certificate or CA through its revoke() saves and signs a new CRL each time,
+    here each issuer's revocations are saved in one transaction and its CRL is rendered once.
+
+    Parameters:
+    auth_by (int): The revoker public key DB id
+    targets (List[Tuple[Union[Certificate, Ca], Union[int, None]]]): Certificate or CA and CRL reason code, None for 0
+
+    Returns:
+    None
+    """
+
+    # Issuer CA DB serial -> (serial number, reason)
+    revocations: Dict[int, List[Tuple[int, int]]] = {}
+    for obj, reason in targets:
+        if reason is None:
+            reason = 0
+        if reason not in CRL_REASONS:
+            raise ValueError(f"ERROR: CRL reason must be in {CRL_REASONS}")
+
+        if obj.issuer < 1:
+            raise HTTPException(status_code=400, detail="Cannot revoke a non existing cert or ca.")
+        revocations.setdefault(obj.issuer, []).append((cert_pem_serial_number(obj.pem), reason))
+
+    for issuer, issuer_revocations in revocations.items():
+        await revoke_certificates(DataClassObject.db, issuer, issuer_revocations, auth_by)
+
+    # The new CRLs are saved, drop any cached or stored OCSP response saying a target is good
+    serial_numbers = [cert_pem_serial_number(obj.pem) for obj, _ in targets]
+    for serial_number in serial_numbers:
+        OCSPResponseCache.evict_serial(serial_number)
+    await DataClassObject.db.delete_ocsp_responses(serial_numbers)
+
+    # and the resolved OCSP issuers if a CA was revoked
+    if any(isinstance(obj, Ca) for obj, _ in targets):
+        OCSPIssuerCache.clear()
+
+    print("Revoked " + str(len(targets)) + " certs and CAs from " + str(len(revocations)) + " issuers")
 
 
 async def sign_csr(auth_by: int, issuer_obj: Ca, csr_obj: Csr, public_key_obj: PublicKey) -> str:
@@ -159,12 +254,16 @@ async def sign_csr(auth_by: int, issuer_obj: Ca, csr_obj: Csr, public_key_obj: P
     extra_extensions = aia_and_cdp_exts(issuer_obj.path)
 
     # Sign csr
-    cert_pem = await pkcs11_sign_csr(
+    cert_pem = await SignScheduler.call(
+        SIGN_PRIORITY_ISSUANCE,
+        "sign_csr",
+        pkcs11_sign_csr,
         issuer_pkcs11_key_obj.key_label,
         pem_cert_to_name_dict(issuer_obj.pem),
         csr_obj.pem,
         extra_extensions=extra_extensions,
         key_type=issuer_pkcs11_key_obj.key_type,
+        lane=SIGN_LANE_LIBRARY,
     )
 
     # Save cert
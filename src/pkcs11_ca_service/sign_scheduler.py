@@ -0,0 +1,249 @@
+"""Module which schedules all HSM signing work
+
+Every signature, from the PKCS11SessionPool or from the python_x509_pkcs11 library functions
+like crl.create, csr.sign_csr and ocsp.response, is submitted here as a job with a priority class.
+Jobs wait in per key queues and are dispatched highest priority first, round robin over the keys
+within a priority, so an OCSP response never waits behind a /pkcs11_sign batch.
+
+Jobs run in one of two lanes. Pool jobs get one slot per pooled session. Library jobs all wait
+for the python_x509_pkcs11 PKCS11Session global lock so they get a single slot of their own,
+a burst of library jobs can not take the slots the pool jobs would run concurrently in.
+
+When idle the dispatcher waits SIGN_SCHEDULER_COALESCE_WINDOW after the first job so that
+concurrent requests are dispatched together across the pooled sessions.
+
+Exposes the class:
+- SignScheduler
+"""
+import asyncio
+import time
+from collections import deque
+from functools import partial
+from typing import Any, Awaitable, Callable, Deque, Dict, Set, Tuple, TypeVar, Union
+
+from .config import PKCS11_SESSION_POOL_SIZE, SIGN_SCHEDULER_COALESCE_WINDOW
+from .metrics import hsm_timer
+from .pkcs11_pool import PKCS11SessionPool
+
+T = TypeVar("T")
+
+# Priority classes, lower is dispatched first
+SIGN_PRIORITY_OCSP = 0
+SIGN_PRIORITY_ISSUANCE = 1  # Certificates, CRLs, CMC responses, CAs and the healthcheck
+SIGN_PRIORITY_BULK = 2  # /pkcs11_sign
+SIGN_PRIORITY_BACKGROUND = 3  # OCSP response pre-generation
+
+SIGN_PRIORITIES = {
+    SIGN_PRIORITY_OCSP: "ocsp",
+    SIGN_PRIORITY_ISSUANCE: "issuance",
+    SIGN_PRIORITY_BULK: "bulk",
+    SIGN_PRIORITY_BACKGROUND: "background",
+}
+
+# Lanes, pool jobs run on the PKCS11SessionPool, library jobs on the python_x509_pkcs11 PKCS11Session
+SIGN_LANE_POOL = "pool"
+SIGN_LANE_LIBRARY = "library"
+
+
+class _SignJob:  # pylint: disable=too-few-public-methods
+    """A signing job waiting in the scheduler"""
+
+    def __init__(self, operation: str, key: Tuple[str, str], func: Callable[[], Awaitable[Any]], lane: str) -> None:
+        self.operation = operation
+        self.key = key
+        self.func = func
+        self.lane = lane
+        self.future: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+        self.enqueued = time.monotonic()
+
+
+class SignScheduler:
+    """Priority scheduler for all HSM signing jobs"""
+
+    # lane -> priority -> (key_label, key_type) -> jobs, the key order is the round robin order
+    _queues: Dict[str, Dict[int, Dict[Tuple[str, str], Deque[_SignJob]]]] = {
+        lane: {priority: {} for priority in SIGN_PRIORITIES} for lane in [SIGN_LANE_POOL, SIGN_LANE_LIBRARY]
+    }
+
+    # lane -> free slots
+    _free: Dict[str, int] = {}
+    _wakeup: asyncio.Event
+    _dispatcher: Union["asyncio.Task[None]", None] = None
+    _running: Set["asyncio.Task[None]"] = set()
+
+    # Per priority class counters, see stats()
+    _jobs_total: Dict[int, int] = {priority: 0 for priority in SIGN_PRIORITIES}
+    _wait_seconds_total: Dict[int, float] = {priority: 0.0 for priority in SIGN_PRIORITIES}
+    _wait_seconds_max: Dict[int, float] = {priority: 0.0 for priority in SIGN_PRIORITIES}
+
+    @classmethod
+    def _start(cls) -> None:
+        if cls._dispatcher is not None and not cls._dispatcher.done():
+            return
+
+        # One slot per pooled session and one for the library PKCS11Session
+        cls._free = {SIGN_LANE_POOL: PKCS11SessionPool.size or PKCS11_SESSION_POOL_SIZE, SIGN_LANE_LIBRARY: 1}
+        cls._wakeup = asyncio.Event()
+        cls._dispatcher = asyncio.ensure_future(cls._dispatch())
+
+    @classmethod
+    def _next_job(cls, lane: str) -> Union[_SignJob, None]:
+        for priority in sorted(cls._queues[lane]):
+            queues = cls._queues[lane][priority]
+            while queues:
+                key = next(iter(queues))
+                jobs = queues.pop(key)
+                job = jobs.popleft()
+
+                # Move the key last for round robin, drop it if there is no more work for it
+                if jobs:
+                    queues[key] = jobs
+
+                # Skip jobs where the caller has given up
+                if job.future.done():
+                    continue
+
+                wait = time.monotonic() - job.enqueued
+                cls._jobs_total[priority] += 1
+                cls._wait_seconds_total[priority] += wait
+                cls._wait_seconds_max[priority] = max(cls._wait_seconds_max[priority], wait)
+                return job
+        return None
+
+    @classmethod
+    def _fill(cls) -> None:
+        """Start the highest priority waiting jobs in each lane while the lane has free slots"""
+
+        for lane, queues in cls._queues.items():
+            while cls._free[lane] > 0 and any(queues.values()):
+                job = cls._next_job(lane)
+                if job is None:
+                    break
+                cls._free[lane] -= 1
+                task = asyncio.ensure_future(cls._run_job(job))
+                cls._running.add(task)
+                task.add_done_callback(cls._running.discard)
+
+    @classmethod
+    async def _run_job(cls, job: _SignJob) -> None:
+        try:
+            with hsm_timer(job.operation, *job.key):
+                result = await job.func()
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as exc:  # pylint: disable=broad-except
+            if not job.future.done():
+                job.future.set_exception(exc)
+        finally:
+            # The slot goes to the next waiting job in the lane right away
+            cls._free[job.lane] += 1
+            cls._fill()
+
+    @classmethod
+    async def _dispatch(cls) -> None:
+        while True:
+            await cls._wakeup.wait()
+            cls._wakeup.clear()
+
+            # Coalesce concurrent requests unless OCSP is waiting
+            if SIGN_SCHEDULER_COALESCE_WINDOW > 0 and not any(
+                queues[SIGN_PRIORITY_OCSP] for queues in cls._queues.values()
+            ):
+                await asyncio.sleep(SIGN_SCHEDULER_COALESCE_WINDOW)
+
+            cls._fill()
+
+    @classmethod
+    async def run(  # pylint: disable=too-many-arguments
+        cls,
+        priority: int,
+        operation: str,
+        key_label: str,
+        key_type: str,
+        func: Callable[[], Awaitable[T]],
+        *,
+        lane: str = SIGN_LANE_POOL,
+    ) -> T:
+        """Queue the signing job and wait for its result.
+        The time the job runs is recorded in the HSM metrics for (operation, key_label, key_type).
+
+        Parameters:
+        priority (int): SIGN_PRIORITY_OCSP, SIGN_PRIORITY_ISSUANCE, SIGN_PRIORITY_BULK or SIGN_PRIORITY_BACKGROUND.
+        operation (str): The operation for the metrics, for example 'sign' or 'create_crl'.
+        key_label (str): Keypair label of the signing key.
+        key_type (str): Key type of the signing key.
+        func (Callable[[], Awaitable[T]]): Runs the job, for example functools.partial(PKCS11SessionPool.sign, ...).
+        lane (str = SIGN_LANE_POOL): SIGN_LANE_POOL or SIGN_LANE_LIBRARY for python_x509_pkcs11 functions.
+
+        Returns:
+        T
+        """
+
+        if priority not in SIGN_PRIORITIES:
+            raise ValueError(f"priority must be in {list(SIGN_PRIORITIES)}")
+        if lane not in cls._queues:
+            raise ValueError(f"lane must be in {list(cls._queues)}")
+
+        cls._start()
+
+        job = _SignJob(operation, (key_label, key_type), func, lane)
+        cls._queues[lane][priority].setdefault(job.key, deque()).append(job)
+        cls._wakeup.set()
+
+        result: T = await job.future
+        return result
+
+    @classmethod
+    async def call(  # pylint: disable=too-many-arguments
+        cls,
+        priority: int,
+        operation: str,
+        func: Callable[..., Awaitable[T]],
+        key_label: str,
+        *args: Any,
+        key_type: str,
+        lane: str,
+        **kwargs: Any,
+    ) -> T:
+        """Run func(key_label, *args, key_type=key_type, **kwargs) as a signing job, see run.
+
+        Parameters:
+        priority (int): The priority class.
+        operation (str): The operation for the metrics.
+        func (Callable[..., Awaitable[T]]): The signing function, takes the key label first and key_type as keyword.
+        key_label (str): Keypair label of the signing key.
+        args (Any): More positional arguments for func.
+        key_type (str): Key type of the signing key.
+        lane (str): SIGN_LANE_POOL for PKCS11SessionPool functions, SIGN_LANE_LIBRARY for python_x509_pkcs11 functions.
+        kwargs (Any): More keyword arguments for func.
+
+        Returns:
+        T
+        """
+
+        return await cls.run(
+            priority,
+            operation,
+            key_label,
+            key_type,
+            partial(func, key_label, *args, key_type=key_type, **kwargs),
+            lane=lane,
+        )
+
+    @classmethod
+    def stats(cls) -> Dict[str, Dict[str, Union[int, float]]]:
+        """Queue depth and wait time per priority class.
+
+        Returns:
+        Dict[str, Dict[str, Union[int, float]]]
+        """
+
+        ret: Dict[str, Dict[str, Union[int, float]]] = {}
+        for priority, name in SIGN_PRIORITIES.items():
+            ret[name] = {
+                "queue_depth": sum(len(jobs) for queues in cls._queues.values() for jobs in queues[priority].values()),
+                "jobs_total": cls._jobs_total[priority],
+                "wait_seconds_total": cls._wait_seconds_total[priority],
+                "wait_seconds_max": cls._wait_seconds_max[priority],
+            }
+        return ret
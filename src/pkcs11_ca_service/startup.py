@@ -16,6 +16,8 @@ from .config import (
     ROOT_CA_KEY_LABEL,
     ROOT_CA_KEY_TYPE,
 )
+from .ocsp_pregen import OCSPPregenerator
+from .pkcs11_pool import PKCS11SessionPool
 
 
 def _load_db_data_classes() -> List[DataClassObject]:
@@ -35,7 +37,7 @@ def _load_db_data_classes() -> List[DataClassObject]:
     return db_data_classes
 
 
-def _load_db_module() -> DataBaseObject:
+def _load_db_module(pkcs11_session: bool = True) -> DataBaseObject:
     try:
         module = import_module("." + DB_MODULE, "src.pkcs11_ca_service")
     except ModuleNotFoundError:
@@ -49,7 +51,8 @@ def _load_db_module() -> DataBaseObject:
         sys.exit(1)
 
     # Set pkcs11 session
-    db_obj.pkcs11_session = PKCS11Session()
+    if pkcs11_session:
+        db_obj.pkcs11_session = PKCS11Session()
 
     # Set db object
     DataClassObject.db = db_obj
@@ -108,6 +111,9 @@ async def _pkcs11_startup(db_obj: DataBaseObject) -> bool:
         print("You should probably empty and reset the DB since we lost the root ca key", flush=True)
         return False
 
+    # Open the signing session pool
+    await PKCS11SessionPool.start()
+
     print("PKCS11 startup OK", flush=True)
     return True
 
@@ -133,3 +139,18 @@ async def startup() -> None:
     # Check pkcs11 with database
     if not await _pkcs11_startup(db_obj):
         sys.exit(1)
+
+    # Pre-generate OCSP responses in the background
+    OCSPPregenerator.start()
+
+
+async def ocsp_responder_startup() -> None:
+    """Startup for the standalone OCSP responder, only connects to the DB
+
+    Returns:
+    None
+    """
+
+    db_obj = _load_db_module(pkcs11_session=False)
+    if not await db_obj.connect():
+        sys.exit(1)
@@ -0,0 +1,248 @@
+"""
+Signing throughput benchmark
+
+Drives pkcs11_sign, sign_csr, crl_request and ocsp_response in-process against the PKCS11 token
+and the DB, for every key type in KEY_TYPES and at several concurrency levels.
+Prints ops/sec and p50/p95/p99 latency and writes the results as JSON.
+
+Not a unittest, run it from the repo root with the same env variables as the service, for example:
+python3 -m tests.benchmark_signing --concurrency 1,8,32 --requests 200 --output benchmark_results.json
+"""
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import os
+import time
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, Tuple, Union
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from fastapi import HTTPException
+from python_x509_pkcs11.ca import create as create_ca
+from python_x509_pkcs11.crl import create as create_crl
+from python_x509_pkcs11.ocsp import certificate_ocsp_data, request
+
+from src.pkcs11_ca_service.asn1 import (
+    cert_pem_serial_number,
+    pem_cert_to_name_dict,
+    public_key_pem_from_csr,
+)
+from src.pkcs11_ca_service.ca import Ca, CaInput
+from src.pkcs11_ca_service.config import KEY_TYPES
+from src.pkcs11_ca_service.crl import Crl
+from src.pkcs11_ca_service.csr import Csr
+from src.pkcs11_ca_service.ocsp import ocsp_response
+from src.pkcs11_ca_service.pkcs11_key import Pkcs11Key, Pkcs11KeyInput
+from src.pkcs11_ca_service.pkcs11_pool import PKCS11SessionPool
+from src.pkcs11_ca_service.pkcs11_sign import pkcs11_sign
+from src.pkcs11_ca_service.public_key import PublicKey
+from src.pkcs11_ca_service.route_functions import (
+    ca_request,
+    crl_request,
+    pkcs11_key_request,
+    sign_csr,
+)
+from src.pkcs11_ca_service.startup import startup
+
+# Key types the /pkcs11_sign endpoint accepts
+PKCS11_SIGN_KEY_TYPES = ["secp256r1", "secp384r1", "ed25519"]
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def _measure(operation: Callable[[], Awaitable[Any]], concurrency: int, requests: int) -> Dict[str, float]:
+    """Run the operation requests times with concurrency workers, return throughput and latency percentiles"""
+
+    latencies: List[float] = []
+    errors = 0
+    todo = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors
+        for _ in todo:
+            start = time.perf_counter()
+            try:
+                await operation()
+            except Exception as exc:  # pylint: disable=broad-except
+                errors += 1
+                print(f"Benchmark operation failed: {exc!r}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "ops_per_sec": requests / elapsed,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p95_ms": _percentile(latencies, 95) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "errors": errors,
+    }
+
+
+async def _benchmark_ca(key_type: str) -> Ca:
+    """Get or create a root CA with a key of this type for the benchmark"""
+
+    key_label = f"benchmark_ca_{key_type}"
+    try:
+        pkcs11_key_obj = await pkcs11_key_request(Pkcs11KeyInput(key_label=key_label))
+        return await ca_request(CaInput(pkcs11_key=pkcs11_key_obj.serial))
+    except HTTPException:
+        pass
+
+    name_dict = {"country_name": "SE", "organization_name": "SUNET", "common_name": f"benchmark-{key_type}.sunet.se"}
+    csr_pem, ca_pem = await create_ca(key_label, name_dict, key_type=key_type)
+    PKCS11SessionPool.forget_key(key_label, key_type)
+
+    public_key_obj = PublicKey(
+        {"pem": (await PKCS11SessionPool.public_key_data(key_label, key_type))[0], "authorized_by": 1}
+    )
+    await public_key_obj.save()
+    pkcs11_key_obj = Pkcs11Key(
+        {"public_key": public_key_obj.serial, "key_label": key_label, "key_type": key_type, "authorized_by": 1}
+    )
+    await pkcs11_key_obj.save()
+    csr_obj = Csr({"pem": csr_pem, "authorized_by": 1, "public_key": public_key_obj.serial})
+    await csr_obj.save()
+
+    ca_obj = Ca(
+        {
+            "pem": ca_pem,
+            "pkcs11_key": pkcs11_key_obj.serial,
+            "authorized_by": 1,
+            "csr": csr_obj.serial,
+            "serial_number": str(cert_pem_serial_number(ca_pem)),
+        }
+    )
+    await ca_obj.save(field_set_to_serial="issuer")
+
+    crl_pem = await create_crl(key_label, pem_cert_to_name_dict(ca_pem), key_type=key_type)
+    await Crl({"pem": crl_pem, "authorized_by": 1, "issuer": ca_obj.serial}).save()
+    return ca_obj
+
+
+async def _benchmark_csr() -> Tuple[Csr, PublicKey]:
+    """Save a new CSR and its public key for the benchmark"""
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    csr = (
+        x509.CertificateSigningRequestBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "benchmark.sunet.se")]))
+        .sign(key, hashes.SHA256())
+    )
+    csr_pem = csr.public_bytes(serialization.Encoding.PEM).decode("utf-8")
+
+    public_key_obj = PublicKey({"pem": public_key_pem_from_csr(csr_pem), "authorized_by": 1})
+    await public_key_obj.save()
+    csr_obj = Csr({"pem": csr_pem, "authorized_by": 1, "public_key": public_key_obj.serial})
+    await csr_obj.save()
+    return csr_obj, public_key_obj
+
+
+async def _operations(key_type: str) -> Dict[str, Union[Callable[[], Awaitable[Any]], None]]:
+    """The benchmarked operations for the key type, None if the operation does not support it"""
+
+    issuer_obj = await _benchmark_ca(key_type)
+    csr_obj, public_key_obj = await _benchmark_csr()
+
+    cert_pem = await sign_csr(1, issuer_obj, csr_obj, public_key_obj)
+    i_n_h, i_n_k, serial, _ = certificate_ocsp_data(cert_pem)
+    ocsp_request_bytes = await request([(i_n_h, i_n_k, serial)])
+
+    sign_request = {
+        "meta": {"version": 1, "encoding": "base64", "key_label": f"benchmark_sign_{key_type}", "key_type": key_type},
+        "documents": [{"id": "doc1", "data": base64.b64encode(os.urandom(64)).decode("utf-8")}],
+    }
+
+    return {
+        "pkcs11_sign": partial(pkcs11_sign, sign_request) if key_type in PKCS11_SIGN_KEY_TYPES else None,
+        "sign_csr": partial(sign_csr, 1, issuer_obj, csr_obj, public_key_obj),
+        "crl_request": partial(crl_request, 1, issuer_obj),
+        "ocsp_response": partial(ocsp_response, ocsp_request_bytes),
+    }
+
+
+async def benchmark(concurrency_levels: List[int], requests: int, key_types: List[str]) -> List[Dict[str, Any]]:
+    """Run all operations for all key types at all concurrency levels.
+
+    Parameters:
+    concurrency_levels (List[int]): Number of concurrent callers.
+    requests (int): Number of calls per operation, key type and concurrency level.
+    key_types (List[str]): The key types.
+
+    Returns:
+    List[Dict[str, Any]]
+    """
+
+    await startup()
+
+    results: List[Dict[str, Any]] = []
+    for key_type in key_types:
+        operations = await _operations(key_type)
+
+        for name, operation in operations.items():
+            if operation is None:
+                print(f"{name:<14} {key_type:<10} not supported, skipped")
+                continue
+
+            # Warm up caches and key handles
+            await operation()
+
+            for concurrency in concurrency_levels:
+                result: Dict[str, Any] = {
+                    "operation": name,
+                    "key_type": key_type,
+                    "concurrency": concurrency,
+                    "requests": requests,
+                }
+                result.update(await _measure(operation, concurrency, requests))
+                results.append(result)
+                print(
+                    f"{name:<14} {key_type:<10} concurrency {concurrency:>4}: {result['ops_per_sec']:>9.1f} ops/sec"
+                    f"  p50 {result['p50_ms']:.2f} ms  p95 {result['p95_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms"
+                    f"  errors {result['errors']}",
+                    flush=True,
+                )
+    return results
+
+
+def main() -> None:
+    """Parse the arguments, run the benchmark and write the results"""
+
+    parser = argparse.ArgumentParser(description="PKCS11 CA signing throughput benchmark")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="Calls per operation and concurrency level")
+    parser.add_argument("--key-types", default=",".join(KEY_TYPES), help="Comma separated key types")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results file")
+    args = parser.parse_args()
+
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    key_types = args.key_types.split(",")
+
+    results = asyncio.run(benchmark(concurrency_levels, args.requests, key_types))
+
+    with open(args.output, "w", encoding="utf-8") as file_data:
+        json.dump(
+            {
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "pkcs11_tokens": PKCS11SessionPool.token_labels(),
+                "results": results,
+            },
+            file_data,
+            indent=2,
+        )
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -104,6 +104,26 @@ def cdp_url(pem: str) -> str:
     raise ValueError
 
 
+def freshest_crl_url(pem: str) -> str:
+    """GET Freshest CRL URL, the delta CRL"""
+
+    data = pem.encode("utf-8")
+    if asn1_pem.detect(data):
+        _, _, data = asn1_pem.unarmor(data)
+    cert = asn1_x509.Certificate().load(data)
+    tbs = cert["tbs_certificate"]
+
+    for _, extension in enumerate(tbs["extensions"]):
+        if extension["extn_id"].dotted == "2.5.29.46":
+            for _, point in enumerate(extension["extn_value"].native):
+                for _, name in enumerate(point["distribution_point"]):
+                    if "/delta_crl/" in name:
+                        ret: str = name
+                        return ret
+
+    raise ValueError
+
+
 def ca_url_from_cert(cert: asn1_x509.Certificate) -> Union[str, None]:
     """CA URL from AIA extension CA Issuers field"""
 
@@ -0,0 +1,327 @@
+"""
+OCSP load test
+
+Issues a pool of certificates from a new intermediate CA on a running PKCS11 CA, revokes a share of them
+and then sends mixed OCSP traffic at a fixed rate: GET and POST, with and without a nonce,
+for a single certificate and for several certificates in one request.
+Every response is checked for the expected good or revoked status.
+Prints throughput, p50/p95/p99 latency and error rate per request kind and writes the results as JSON.
+
+Not a unittest, start the PKCS11 CA with SoftHSM and Postgres, for example with deploy.sh,
+and run it from the repo root with the same env variables as the tests, for example:
+python3 -m tests.loadtest_ocsp --certs 500 --revoked 0.1 --rate 200 --duration 60 --output ocsp_loadtest.json
+
+--ocsp-url sends the OCSP traffic somewhere else than the certificates' OCSP URL,
+for example to the standalone OCSP responder.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from secrets import token_bytes
+from typing import Any, Dict, List, Tuple, Union
+
+import requests
+from asn1crypto import ocsp as asn1_ocsp
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from python_x509_pkcs11.ocsp import certificate_ocsp_data
+
+from src.pkcs11_ca_service.asn1 import create_jwt_header_str, ocsp_encode
+from src.pkcs11_ca_service.config import ROOT_URL
+
+from .lib import create_i_ca, verify_pkcs11_ca_tls_cert
+
+with open("data/trusted_keys/privkey1.key", "rb") as file_data:
+    priv_key = file_data.read()
+with open("data/trusted_keys/pubkey1.pem", "rb") as file_data:
+    pub_key = file_data.read()
+
+name_dict = {
+    "country_name": "SE",
+    "state_or_province_name": "Stockholm",
+    "locality_name": "Stockholm_test",
+    "organization_name": "SUNET_ocsp_loadtest",
+    "organizational_unit_name": "SUNET Infrastructure",
+    "common_name": "ca-test-ocsp-loadtest.sunet.se",
+}
+
+# (issuer name hash, issuer key hash, serial number, expected cert status)
+PoolCert = Tuple[bytes, bytes, int, str]
+
+_thread_data = threading.local()
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def _session() -> requests.Session:
+    """One HTTP session with keep-alive per worker thread"""
+
+    if not hasattr(_thread_data, "session"):
+        _thread_data.session = requests.Session()
+        _thread_data.session.verify = verify_pkcs11_ca_tls_cert()
+    session: requests.Session = _thread_data.session
+    return session
+
+
+def _issue_cert(ca_url: str, ca_pem: str, index: int) -> str:
+    key = ec.generate_private_key(ec.SECP256R1())
+    csr = (
+        x509.CertificateSigningRequestBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, f"ocsp-loadtest-{index}.sunet.se")]))
+        .sign(key, hashes.SHA256())
+    )
+    csr_pem = csr.public_bytes(serialization.Encoding.PEM).decode("utf-8")
+
+    request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, ca_url + "/sign_csr")}
+    req = _session().post(
+        ca_url + "/sign_csr", headers=request_headers, json={"pem": csr_pem, "ca_pem": ca_pem}, timeout=30
+    )
+    if req.status_code != 200:
+        raise ValueError(f"Could not issue certificate, status {req.status_code}")
+    cert_pem: str = json.loads(req.text)["certificate"]
+    return cert_pem
+
+
+def _revoke_cert(ca_url: str, cert_pem: str) -> None:
+    request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, ca_url + "/revoke")}
+    req = _session().post(ca_url + "/revoke", headers=request_headers, json={"pem": cert_pem, "reason": 1}, timeout=30)
+    if req.status_code != 200:
+        raise ValueError(f"Could not revoke certificate, status {req.status_code}")
+
+
+def create_pool(ca_url: str, certs: int, revoked: float, workers: int) -> Tuple[List[PoolCert], str]:
+    """Issue the certificates and revoke a share of them.
+
+    Parameters:
+    ca_url (str): The PKCS11 CA URL.
+    certs (int): Number of certificates.
+    revoked (float): Share of the certificates to revoke.
+    workers (int): Concurrent issue and revoke requests.
+
+    Returns:
+    Tuple[List[PoolCert], str]
+    """
+
+    ca_pem = create_i_ca(ca_url, pub_key, priv_key, name_dict)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        cert_pems = list(executor.map(lambda index: _issue_cert(ca_url, ca_pem, index), range(certs)))
+    print(f"Issued {certs} certificates in {time.perf_counter() - start:.1f}s", flush=True)
+
+    revoked_pems = set(random.sample(cert_pems, int(certs * revoked)))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda cert_pem: _revoke_cert(ca_url, cert_pem), revoked_pems))
+    print(f"Revoked {len(revoked_pems)} certificates in {time.perf_counter() - start:.1f}s", flush=True)
+
+    pool: List[PoolCert] = []
+    ocsp_url = ""
+    for cert_pem in cert_pems:
+        i_n_h, i_n_k, serial, ocsp_url = certificate_ocsp_data(cert_pem)
+        pool.append((i_n_h, i_n_k, serial, "revoked" if cert_pem in revoked_pems else "good"))
+    return pool, ocsp_url
+
+
+def _ocsp_request(certs: List[PoolCert], nonce: bool) -> bytes:
+    request_list = []
+    for i_n_h, i_n_k, serial, _ in certs:
+        cert_id = asn1_ocsp.CertId(
+            {
+                "hash_algorithm": {"algorithm": "sha1"},
+                "issuer_name_hash": i_n_h,
+                "issuer_key_hash": i_n_k,
+                "serial_number": serial,
+            }
+        )
+        request_list.append({"req_cert": cert_id})
+
+    tbs_request: Dict[str, Any] = {"request_list": request_list}
+    if nonce:
+        tbs_request["request_extensions"] = [{"extn_id": "nonce", "extn_value": token_bytes(16)}]
+
+    ret: bytes = asn1_ocsp.OCSPRequest({"tbs_request": tbs_request}).dump()
+    return ret
+
+
+def _check_response(data: bytes, certs: List[PoolCert]) -> Union[str, None]:
+    """The error in the OCSP response, None if it is as expected"""
+
+    ocsp_response = asn1_ocsp.OCSPResponse.load(data)
+    if ocsp_response["response_status"].native != "successful":
+        return f"response status {ocsp_response['response_status'].native}"
+
+    responses = ocsp_response["response_bytes"]["response"].parsed["tbs_response_data"]["responses"]
+    if len(responses) != len(certs):
+        return f"{len(responses)} responses for {len(certs)} certificates"
+
+    for single_response, cert in zip(responses, certs):
+        if single_response["cert_status"].name != cert[3]:
+            return f"cert status {single_response['cert_status'].name} expected {cert[3]}"
+    return None
+
+
+def _send(ocsp_url: str, certs: List[PoolCert], nonce: bool, post: bool) -> Union[str, None]:
+    """Send one OCSP request, return the error or None"""
+
+    ocsp_request_bytes = _ocsp_request(certs, nonce)
+    try:
+        if post:
+            req = _session().post(
+                ocsp_url,
+                data=ocsp_request_bytes,
+                headers={"Content-Type": "application/ocsp-request"},
+                timeout=30,
+            )
+        else:
+            req = _session().get(ocsp_url + ocsp_encode(ocsp_request_bytes), timeout=30)
+    except requests.RequestException as exc:
+        return exc.__class__.__name__
+
+    if req.status_code != 200:
+        return f"HTTP {req.status_code}"
+    try:
+        return _check_response(req.content, certs)
+    except ValueError as exc:
+        return f"invalid response {exc!r}"
+
+
+def run_load(  # pylint: disable=too-many-arguments,too-many-locals
+    pool: List[PoolCert],
+    ocsp_url: str,
+    rate: float,
+    duration: float,
+    workers: int,
+    mix: Dict[str, float],
+) -> Dict[str, Dict[str, Any]]:
+    """Send OCSP requests at the rate for the duration and collect the latency per request kind.
+
+    Parameters:
+    pool (List[PoolCert]): The certificates.
+    ocsp_url (str): The OCSP URL.
+    rate (float): Requests per second.
+    duration (float): Seconds to send requests.
+    workers (int): Max concurrent requests.
+    mix (Dict[str, float]): Share of nonce, multi and post requests and the multi request size.
+
+    Returns:
+    Dict[str, Dict[str, Any]]
+    """
+
+    # request kind -> (latencies, errors)
+    results: Dict[str, Tuple[List[float], Dict[str, int]]] = {}
+    lock = threading.Lock()
+
+    def request_job(scheduled: float, kind: str, certs: List[PoolCert], nonce: bool, post: bool) -> None:
+        error = _send(ocsp_url, certs, nonce, post)
+        # Measured from when the request should have been sent, a backlog shows up as latency
+        latency = time.perf_counter() - scheduled
+        with lock:
+            latencies, errors = results.setdefault(kind, ([], {}))
+            latencies.append(latency)
+            if error is not None:
+                errors[error] = errors.get(error, 0) + 1
+
+    total = int(rate * duration)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        start = time.perf_counter()
+        for index in range(total):
+            scheduled = start + index / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            nonce = random.random() < mix["nonce"]
+            multi = random.random() < mix["multi"]
+            post = random.random() < mix["post"]
+            certs = random.sample(pool, min(len(pool), int(mix["multi_size"]))) if multi else [random.choice(pool)]
+            kind = f"{'POST' if post else 'GET'} {'nonce' if nonce else 'no_nonce'} {'multi' if multi else 'single'}"
+            executor.submit(request_job, scheduled, kind, certs, nonce, post)
+    elapsed = time.perf_counter() - start
+
+    report: Dict[str, Dict[str, Any]] = {}
+    all_latencies: List[float] = []
+    all_errors: Dict[str, int] = {}
+    for kind, (latencies, errors) in sorted(results.items()):
+        all_latencies.extend(latencies)
+        for error, count in errors.items():
+            all_errors[error] = all_errors.get(error, 0) + count
+        report[kind] = _summary(latencies, errors, elapsed)
+    report["all"] = _summary(all_latencies, all_errors, elapsed)
+    return report
+
+
+def _summary(latencies: List[float], errors: Dict[str, int], elapsed: float) -> Dict[str, Any]:
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "requests_per_sec": len(latencies) / elapsed,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p95_ms": _percentile(latencies, 95) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "error_rate": sum(errors.values()) / len(latencies),
+        "errors": errors,
+    }
+
+
+def main() -> None:
+    """Parse the arguments, create the certificates, run the load and write the results"""
+
+    parser = argparse.ArgumentParser(description="PKCS11 CA OCSP load test")
+    parser.add_argument("--ca-url", default=os.environ.get("CA_URL", ROOT_URL), help="PKCS11 CA URL")
+    parser.add_argument("--ocsp-url", default=None, help="OCSP URL, default the certificates' OCSP URL")
+    parser.add_argument("--certs", type=int, default=500, help="Number of certificates to issue")
+    parser.add_argument("--revoked", type=float, default=0.1, help="Share of the certificates to revoke")
+    parser.add_argument("--rate", type=float, default=100, help="OCSP requests per second")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to send OCSP requests")
+    parser.add_argument("--workers", type=int, default=64, help="Max concurrent requests")
+    parser.add_argument("--nonce", type=float, default=0.3, help="Share of requests with a nonce")
+    parser.add_argument("--multi", type=float, default=0.1, help="Share of requests for several certificates")
+    parser.add_argument("--multi-size", type=int, default=5, help="Certificates in a multi certificate request")
+    parser.add_argument("--post", type=float, default=0.5, help="Share of POST requests")
+    parser.add_argument("--output", default="ocsp_loadtest_results.json", help="JSON results file")
+    args = parser.parse_args()
+
+    pool, ocsp_url = create_pool(args.ca_url, args.certs, args.revoked, min(args.workers, 8))
+    if args.ocsp_url is not None:
+        ocsp_url = args.ocsp_url
+
+    mix = {"nonce": args.nonce, "multi": args.multi, "multi_size": args.multi_size, "post": args.post}
+    report = run_load(pool, ocsp_url, args.rate, args.duration, args.workers, mix)
+
+    for kind, result in report.items():
+        print(
+            f"{kind:<24} {result['requests']:>7} requests {result['requests_per_sec']:>8.1f} req/sec"
+            f"  p50 {result['p50_ms']:.2f} ms  p95 {result['p95_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms"
+            f"  error rate {result['error_rate']:.2%}",
+            flush=True,
+        )
+        for error, count in result["errors"].items():
+            print(f"    {count} x {error}")
+
+    with open(args.output, "w", encoding="utf-8") as output_file:
+        json.dump(
+            {
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "ocsp_url": ocsp_url,
+                "settings": vars(args),
+                "results": report,
+            },
+            output_file,
+            indent=2,
+        )
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
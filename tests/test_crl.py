@@ -9,10 +9,14 @@ import requests
 from asn1crypto import crl as asn1_crl
 from asn1crypto import pem as asn1_pem
 
-from src.pkcs11_ca_service.asn1 import create_jwt_header_str, crl_expired
+from src.pkcs11_ca_service.asn1 import (
+    cert_pem_serial_number,
+    create_jwt_header_str,
+    crl_expired,
+)
 from src.pkcs11_ca_service.config import ROOT_URL
 
-from .lib import create_i_ca, verify_pkcs11_ca_tls_cert
+from .lib import cdp_url, create_i_ca, freshest_crl_url, verify_pkcs11_ca_tls_cert
 
 
 class TestCrl(unittest.TestCase):
@@ -84,3 +88,144 @@ class TestCrl(unittest.TestCase):
 
         # Check if expired
         self.assertFalse(crl_expired(json.loads(req.text)["crls"][0]))
+
+    def test_crl_cached(self) -> None:
+        """
+        Test the cached CRL is replaced when a certificate is revoked
+        """
+
+        with open("data/trusted_keys/pubkey1.pem", "rb") as f_data:
+            pub_key = f_data.read()
+        with open("data/trusted_keys/privkey1.key", "rb") as f_data:
+            priv_key = f_data.read()
+
+        new_ca = create_i_ca(self.ca_url, pub_key, priv_key, self.name_dict)
+        url = cdp_url(new_ca)
+
+        req1 = requests.get(url, timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req1.status_code == 200)
+        self.assertTrue(req1.headers["content-type"] == "application/pkix-crl")
+        req2 = requests.get(url, timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req2.status_code == 200)
+        self.assertTrue(req1.content == req2.content)
+
+        # Revoke the CA, its issuer's CRL must list it at once
+        request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + "/revoke")}
+        req = requests.post(
+            self.ca_url + "/revoke",
+            headers=request_headers,
+            json={"pem": new_ca, "reason": 5},
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+
+        req3 = requests.get(url, timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req3.status_code == 200)
+        self.assertTrue(req3.content != req1.content)
+        revoked_serials = [
+            revoked["user_certificate"].native
+            for revoked in asn1_crl.CertificateList.load(req3.content)["tbs_cert_list"]["revoked_certificates"]
+        ]
+        self.assertTrue(cert_pem_serial_number(new_ca) in revoked_serials)
+
+    def test_delta_crl(self) -> None:
+        """
+        Test the delta CRL lists a new revocation
+        """
+
+        with open("data/trusted_keys/pubkey1.pem", "rb") as f_data:
+            pub_key = f_data.read()
+        with open("data/trusted_keys/privkey1.key", "rb") as f_data:
+            priv_key = f_data.read()
+
+        new_ca = create_i_ca(self.ca_url, pub_key, priv_key, self.name_dict)
+        url = freshest_crl_url(new_ca)
+
+        req = requests.get(url, timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req.status_code == 200)
+        self.assertTrue(req.headers["content-type"] == "application/pkix-crl")
+
+        request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + "/revoke")}
+        req = requests.post(
+            self.ca_url + "/revoke",
+            headers=request_headers,
+            json={"pem": new_ca, "reason": 5},
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+
+        req = requests.get(url, timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req.status_code == 200)
+        delta_crl = asn1_crl.CertificateList.load(req.content)
+        self.assertTrue(delta_crl.delta_crl_indicator_value is not None)
+        revoked_serials = [
+            revoked["user_certificate"].native for revoked in delta_crl["tbs_cert_list"]["revoked_certificates"]
+        ]
+        self.assertTrue(cert_pem_serial_number(new_ca) in revoked_serials)
+
+        # Same CRL number as the complete CRL
+        req = requests.get(cdp_url(new_ca), timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req.status_code == 200)
+        complete_crl = asn1_crl.CertificateList.load(req.content)
+        self.assertTrue(delta_crl.crl_number_value.native == complete_crl.crl_number_value.native)
+        self.assertTrue(delta_crl.delta_crl_indicator_value.native <= complete_crl.crl_number_value.native)
+
+    def test_crl_partition(self) -> None:
+        """
+        Test the CDP points to a partition CRL with an Issuing Distribution Point
+        """
+
+        with open("data/trusted_keys/pubkey1.pem", "rb") as f_data:
+            pub_key = f_data.read()
+        with open("data/trusted_keys/privkey1.key", "rb") as f_data:
+            priv_key = f_data.read()
+
+        new_ca = create_i_ca(self.ca_url, pub_key, priv_key, self.name_dict)
+        url = cdp_url(new_ca)
+        complete_crl_url, partition = url.rsplit("/", 1)
+        self.assertTrue(partition.isdigit())
+
+        request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + "/revoke")}
+        req = requests.post(
+            self.ca_url + "/revoke",
+            headers=request_headers,
+            json={"pem": new_ca, "reason": 5},
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+
+        req = requests.get(url, timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req.status_code == 200)
+        partition_crl = asn1_crl.CertificateList.load(req.content)
+        self.assertTrue(partition_crl.issuing_distribution_point_value["distribution_point"].native == [url])
+        revoked_serials = [
+            revoked["user_certificate"].native for revoked in partition_crl["tbs_cert_list"]["revoked_certificates"]
+        ]
+        self.assertTrue(cert_pem_serial_number(new_ca) in revoked_serials)
+
+        # The complete CRL lists every partition's revocations
+        req = requests.get(complete_crl_url, timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req.status_code == 200)
+        complete_crl = asn1_crl.CertificateList.load(req.content)
+        self.assertTrue(complete_crl.issuing_distribution_point_value is None)
+        revoked_serials = [
+            revoked["user_certificate"].native for revoked in complete_crl["tbs_cert_list"]["revoked_certificates"]
+        ]
+        self.assertTrue(cert_pem_serial_number(new_ca) in revoked_serials)
+
+        # No partitions from the future
+        req = requests.get(
+            complete_crl_url + "/" + str(int(partition) + 10), timeout=10, verify=verify_pkcs11_ca_tls_cert()
+        )
+        self.assertTrue(req.status_code == 404)
+
+        # No partitions from before the CA, nor their delta CRLs
+        req = requests.get(complete_crl_url + "/0", timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req.status_code == 404)
+        req = requests.get(
+            complete_crl_url.replace("/crl/", "/delta_crl/") + "/0", timeout=10, verify=verify_pkcs11_ca_tls_cert()
+        )
+        self.assertTrue(req.status_code == 404)
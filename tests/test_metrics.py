@@ -0,0 +1,65 @@
+"""
+Test our metrics
+"""
+import base64
+import os
+import unittest
+
+import requests
+
+from src.pkcs11_ca_service.config import PKCS11_SIGN_API_TOKEN, ROOT_URL
+
+from .lib import verify_pkcs11_ca_tls_cert
+
+METRICS_ENDPOINT = "/metrics"
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Test our metrics
+    """
+
+    if "CA_URL" in os.environ:
+        ca_url = os.environ["CA_URL"]
+    else:
+        ca_url = ROOT_URL
+
+    def test_metrics(self) -> None:
+        """
+        Test metrics
+        """
+
+        # Test no auth
+        req = requests.get(self.ca_url + METRICS_ENDPOINT, timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req.status_code == 401)
+
+        request_headers = {
+            "Authorization": f"Bearer {base64.b64encode(PKCS11_SIGN_API_TOKEN.encode('UTF-8')).decode('UTF-8')}"
+        }
+
+        # Sign something so there are HSM metrics
+        req = requests.post(
+            self.ca_url + "/pkcs11_sign",
+            headers=request_headers,
+            json={
+                "meta": {
+                    "version": 1,
+                    "encoding": "base64",
+                    "key_label": "pkcs11_sign_test15",
+                    "key_type": "secp256r1",
+                },
+                "documents": [{"id": "doc1", "data": base64.b64encode(b"metrics").decode("utf-8")}],
+            },
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+
+        req = requests.get(
+            self.ca_url + METRICS_ENDPOINT, headers=request_headers, timeout=10, verify=verify_pkcs11_ca_tls_cert()
+        )
+        self.assertTrue(req.status_code == 200)
+        self.assertTrue("text/plain" in req.headers["Content-Type"])
+        labels = 'operation="sign",key_label="pkcs11_sign_test15",key_type="secp256r1"'
+        self.assertTrue(f"pkcs11_ca_hsm_operation_seconds_count{{{labels}}}" in req.text)
+        self.assertTrue('pkcs11_ca_sign_scheduler_queue_depth{priority="ocsp"}' in req.text)
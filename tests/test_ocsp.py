@@ -5,6 +5,7 @@ import asyncio
 import datetime
 import json
 import os
+import time
 import unittest
 from secrets import token_bytes
 from typing import Tuple, Union
@@ -28,6 +29,25 @@ with open("data/trusted_keys/privkey1.key", "rb") as file_data:
 with open("data/trusted_keys/pubkey1.pem", "rb") as file_data:
     pub_key = file_data.read()
 
+CSR_PEM = """-----BEGIN CERTIFICATE REQUEST-----
+MIICsDCCAZgCAQAwazELMAkGA1UEBhMCU0UxEzARBgNVBAgMClNvbWUtU3RhdGUx
+ITAfBgNVBAoMGEludGVybmV0IFdpZGdpdHMgUHR5IEx0ZDEkMCIGA1UEAwwbY2hl
+Y2stb2NzcC50ZXN0LTU3LnN1bmV0LnNlMIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8A
+MIIBCgKCAQEAqZ7KLyarB001jU2E8tPY+jbs2FNBfQg5gebvWMxtap2UG2HQla+2
+r3mKWAfmd5rn09Kb5PTvVvmFAuf7mALlsOw1Ppjo0nQeQG34FTQ2fmyO5Yr4q4sI
+v7nZE1MtAFuwQBC0xxJ/aunf7T0I4VTKzik5UqmlztzPhdrhCASOAgcqOSYqdl8j
+DQtKTk7F1VF21zOwivZ2375aBc6ztEvgLqSdsh4txFKYRwUm/slBgGEptsRO/ZnY
+4lrfXuSDxAy7jRxWHyrLfur3I5tkVqYxBnFMCdjwDV3LPalKcNDim6n+52LhIWE+
+39y4ynfPBYDpT/4NXWc71Pbrmr4GwuGp7wIDAQABoAAwDQYJKoZIhvcNAQELBQAD
+ggEBAF3yXwXMKnc1ZKAtuuhyfXDE7s97qRy/iVoTEldrWmUcDhlfWdfZYBxpWp2e
+R7rOJDrL2LbHMYEN+vIQsaow6z4kYcSmyEasNCD/4gms/VesCTOoWz0QP+59NtFe
+w0+S7OGYDzBS+Wyo3W00R4nKMug1lhSCtOa9p3ibtPzx6U48Ch5whoedfzXY5z92
+q2BvFe+gBHospMivm2m/laeMMu99EarJE8JgTnUDtQmZ/xxLBsPp9Xk78Bc1gU7u
+1d2+gEBSgJ/cc3cagBWPPbdRaT4OmuOkIudq/zP6GqQKQ+8d7rLsFszdamTPv2v7
+zu/HPacJI420g3IC4vMVHeZznEM=
+-----END CERTIFICATE REQUEST-----
+"""
+
 
 def load_ocsp_request(ocsp_request_bytes: bytes) -> asn1_ocsp.OCSPRequest:
     """Load and check ocsp request"""
@@ -174,6 +194,131 @@ class TestOCSP(unittest.TestCase):
 
         self.test_revoked_get(True)
 
+    def test_ocsp_cached(self) -> None:
+        """
+        Test cached OCSP responses for requests without a nonce
+        """
+
+        new_ca = create_i_ca(self.ca_url, pub_key, priv_key, self.name_dict)
+        i_n_h, i_n_k, serial, ocsp_url = certificate_ocsp_data(new_ca)
+        ocsp_request_bytes = asyncio.run(request([(i_n_h, i_n_k, serial)]))
+
+        # Same response without a nonce
+        data1, _ = self._ocsp_request(False, f"{ocsp_url}", ocsp_request_bytes)
+        data2, _ = self._ocsp_request(True, f"{ocsp_url}", ocsp_request_bytes)
+        self.assertTrue(data1 == data2)
+
+        # Revoke cert
+        request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + REVOKE_ENDPOINT)}
+        req = requests.post(
+            self.ca_url + REVOKE_ENDPOINT,
+            headers=request_headers,
+            json={"pem": new_ca, "reason": 5},
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+
+        # The cached good response must be gone
+        data3, ocsp_response_rev = self._ocsp_request(False, f"{ocsp_url}", ocsp_request_bytes)
+        self.assertTrue(data3 != data1)
+        self.assertTrue(
+            ocsp_response_rev["response_bytes"]["response"].native["tbs_response_data"]["responses"][0]["cert_status"][
+                "revocation_reason"
+            ]
+            == "cessation_of_operation"
+        )
+
+    def test_ocsp_pregenerated(self) -> None:
+        """
+        Test that the pre-generation worker signs the response again after a revocation
+        and the request is answered from the cache
+        """
+
+        new_ca = create_i_ca(self.ca_url, pub_key, priv_key, self.name_dict)
+        i_n_h, i_n_k, serial, ocsp_url = certificate_ocsp_data(new_ca)
+        ocsp_request_bytes = asyncio.run(request([(i_n_h, i_n_k, serial)]))
+
+        # Cache the good response
+        start = time.monotonic()
+        _, ocsp_response_good = self._ocsp_request(False, f"{ocsp_url}", ocsp_request_bytes)
+
+        # Revoke cert, evicts the cached response and the worker signs it again
+        request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + REVOKE_ENDPOINT)}
+        req = requests.post(
+            self.ca_url + REVOKE_ENDPOINT,
+            headers=request_headers,
+            json={"pem": new_ca, "reason": 5},
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+        time.sleep(5)
+
+        elapsed = time.monotonic() - start
+        _, ocsp_response_rev = self._ocsp_request(False, f"{ocsp_url}", ocsp_request_bytes)
+        tbs_response_data_rev = ocsp_response_rev["response_bytes"]["response"].native["tbs_response_data"]
+        self.assertTrue(
+            tbs_response_data_rev["responses"][0]["cert_status"]["revocation_reason"] == "cessation_of_operation"
+        )
+
+        # Signed right after the revocation, not when requested
+        produced_between = (
+            tbs_response_data_rev["produced_at"]
+            - ocsp_response_good["response_bytes"]["response"].native["tbs_response_data"]["produced_at"]
+        )
+        self.assertTrue(produced_between.total_seconds() < elapsed - 2)
+
+    def test_ocsp_http_caching(self) -> None:
+        """
+        Test RFC 5019 caching headers and conditional GET
+        """
+
+        new_ca = create_i_ca(self.ca_url, pub_key, priv_key, self.name_dict)
+        i_n_h, i_n_k, serial, ocsp_url = certificate_ocsp_data(new_ca)
+        ocsp_request_bytes = asyncio.run(request([(i_n_h, i_n_k, serial)]))
+        url = f"{ocsp_url}{ocsp_encode(ocsp_request_bytes)}"
+
+        req = requests.get(url, timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req.status_code == 200)
+        for header in ["Cache-Control", "ETag", "Last-Modified", "Expires"]:
+            self.assertTrue(header in req.headers)
+        self.assertTrue("max-age=" in req.headers["Cache-Control"])
+
+        req_etag = requests.get(
+            url, headers={"If-None-Match": req.headers["ETag"]}, timeout=10, verify=verify_pkcs11_ca_tls_cert()
+        )
+        self.assertTrue(req_etag.status_code == 304)
+        self.assertTrue(len(req_etag.content) == 0)
+
+        req_modified = requests.get(
+            url,
+            headers={"If-Modified-Since": req.headers["Last-Modified"]},
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req_modified.status_code == 304)
+
+        req_other = requests.get(
+            url, headers={"If-None-Match": '"not-the-etag"'}, timeout=10, verify=verify_pkcs11_ca_tls_cert()
+        )
+        self.assertTrue(req_other.status_code == 200)
+        self.assertTrue(req_other.content == req.content)
+
+        # No caching headers for responses with a nonce
+        nonce_ext = asn1_ocsp.TBSRequestExtension()
+        nonce_ext["extn_id"] = asn1_ocsp.TBSRequestExtensionId("1.3.6.1.5.5.7.48.1.2")
+        nonce_ext["extn_value"] = token_bytes(32)
+        extra_extensions = asn1_ocsp.TBSRequestExtensions()
+        extra_extensions.append(nonce_ext)
+        ocsp_request_bytes = asyncio.run(request([(i_n_h, i_n_k, serial)], extra_extensions=extra_extensions))
+
+        req = requests.get(
+            f"{ocsp_url}{ocsp_encode(ocsp_request_bytes)}", timeout=10, verify=verify_pkcs11_ca_tls_cert()
+        )
+        self.assertTrue(req.status_code == 200)
+        self.assertTrue("ETag" not in req.headers)
+
     def test_ocsp_fail(self) -> None:
         """
         Test OCSP fails
@@ -313,26 +458,11 @@ class TestOCSP(unittest.TestCase):
         Test OCSP extensions
         """
 
-        csr_pem = """-----BEGIN CERTIFICATE REQUEST-----
-MIICsDCCAZgCAQAwazELMAkGA1UEBhMCU0UxEzARBgNVBAgMClNvbWUtU3RhdGUx
-ITAfBgNVBAoMGEludGVybmV0IFdpZGdpdHMgUHR5IEx0ZDEkMCIGA1UEAwwbY2hl
-Y2stb2NzcC50ZXN0LTU3LnN1bmV0LnNlMIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8A
-MIIBCgKCAQEAqZ7KLyarB001jU2E8tPY+jbs2FNBfQg5gebvWMxtap2UG2HQla+2
-r3mKWAfmd5rn09Kb5PTvVvmFAuf7mALlsOw1Ppjo0nQeQG34FTQ2fmyO5Yr4q4sI
-v7nZE1MtAFuwQBC0xxJ/aunf7T0I4VTKzik5UqmlztzPhdrhCASOAgcqOSYqdl8j
-DQtKTk7F1VF21zOwivZ2375aBc6ztEvgLqSdsh4txFKYRwUm/slBgGEptsRO/ZnY
-4lrfXuSDxAy7jRxWHyrLfur3I5tkVqYxBnFMCdjwDV3LPalKcNDim6n+52LhIWE+
-39y4ynfPBYDpT/4NXWc71Pbrmr4GwuGp7wIDAQABoAAwDQYJKoZIhvcNAQELBQAD
-ggEBAF3yXwXMKnc1ZKAtuuhyfXDE7s97qRy/iVoTEldrWmUcDhlfWdfZYBxpWp2e
-R7rOJDrL2LbHMYEN+vIQsaow6z4kYcSmyEasNCD/4gms/VesCTOoWz0QP+59NtFe
-w0+S7OGYDzBS+Wyo3W00R4nKMug1lhSCtOa9p3ibtPzx6U48Ch5whoedfzXY5z92
-q2BvFe+gBHospMivm2m/laeMMu99EarJE8JgTnUDtQmZ/xxLBsPp9Xk78Bc1gU7u
-1d2+gEBSgJ/cc3cagBWPPbdRaT4OmuOkIudq/zP6GqQKQ+8d7rLsFszdamTPv2v7
-zu/HPacJI420g3IC4vMVHeZznEM=
------END CERTIFICATE REQUEST-----
-"""
+        new_cert = self._sign_csr(create_i_ca(self.ca_url, pub_key, priv_key, self.name_dict))
+        self._check_ok_cert(new_cert)
 
-        data = {"pem": csr_pem, "ca_pem": create_i_ca(self.ca_url, pub_key, priv_key, self.name_dict)}
+    def _sign_csr(self, ca_pem: str) -> str:
+        data = {"pem": CSR_PEM, "ca_pem": ca_pem}
 
         # Sign a csr
         request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + "/sign_csr")}
@@ -345,5 +475,37 @@ zu/HPacJI420g3IC4vMVHeZznEM=
             verify=verify_pkcs11_ca_tls_cert(),
         )
         self.assertTrue(req.status_code == 200)
-        new_cert = json.loads(req.text)["certificate"]
-        self._check_ok_cert(new_cert)
+        new_cert: str = json.loads(req.text)["certificate"]
+        return new_cert
+
+    def test_ocsp_multiple_issuers(self, post: bool = False) -> None:
+        """
+        Test OCSP request with certs from two issuers, the first issuer in the request answers
+        and the certs from the other issuer get status unknown
+        """
+
+        new_ca = create_i_ca(self.ca_url, pub_key, priv_key, self.name_dict)
+        new_cert = self._sign_csr(new_ca)
+
+        # The CA is issued by the root, the cert by the CA
+        ca_data = certificate_ocsp_data(new_ca)[:3]
+        cert_data = certificate_ocsp_data(new_cert)[:3]
+
+        for request_certs_data, statuses in [
+            ([ca_data, cert_data, ca_data], ["good", "unknown", "good"]),
+            ([cert_data, ca_data], ["good", "unknown"]),
+        ]:
+            ocsp_request_bytes = asyncio.run(request(request_certs_data))
+            ocsp_request = load_ocsp_request(ocsp_request_bytes)
+
+            _, ocsp_response = self._ocsp_request(post, f"{self.ca_url}{OCSP_ENDPOINT}", ocsp_request_bytes)
+            self._check_certs_in_req_and_resp(ocsp_request, ocsp_response)
+            responses = ocsp_response["response_bytes"]["response"].native["tbs_response_data"]["responses"]
+            self.assertTrue([response["cert_status"] for response in responses] == statuses)
+
+    def test_ocsp_multiple_issuers_post(self) -> None:
+        """
+        Test OCSP request with certs from two issuers
+        """
+
+        self.test_ocsp_multiple_issuers(True)
@@ -0,0 +1,157 @@
+"""
+Test our delegated OCSP responders
+"""
+import asyncio
+import datetime
+import json
+import os
+import unittest
+from typing import Any, Dict
+
+import requests
+from asn1crypto import ocsp as asn1_ocsp
+from asn1crypto import pem as asn1_pem
+from asn1crypto import x509 as asn1_x509
+from cryptography.hazmat.primitives.asymmetric.ec import ECDSA, EllipticCurvePublicKey
+from cryptography.x509 import (
+    ExtendedKeyUsage,
+    ExtendedKeyUsageOID,
+    load_der_x509_certificate,
+    load_pem_x509_certificate,
+)
+from cryptography.x509.ocsp import load_der_ocsp_response
+from python_x509_pkcs11.ocsp import certificate_ocsp_data, request
+
+from src.pkcs11_ca_service.asn1 import (
+    create_jwt_header_str,
+    ocsp_encode,
+    pem_cert_to_key_hash,
+)
+from src.pkcs11_ca_service.config import (
+    OCSP_DELEGATED_RESPONDERS,
+    OCSP_RESPONDER_CERT_RENEW_BEFORE,
+    OCSP_RESPONDER_CERT_VALIDITY,
+    ROOT_URL,
+)
+
+from .lib import create_root_ca, verify_pkcs11_ca_tls_cert
+
+CSR_PEM = """-----BEGIN CERTIFICATE REQUEST-----
+MIICsDCCAZgCAQAwazELMAkGA1UEBhMCU0UxEzARBgNVBAgMClNvbWUtU3RhdGUx
+ITAfBgNVBAoMGEludGVybmV0IFdpZGdpdHMgUHR5IEx0ZDEkMCIGA1UEAwwbY2hl
+Y2stb2NzcC50ZXN0LTU3LnN1bmV0LnNlMIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8A
+MIIBCgKCAQEAqZ7KLyarB001jU2E8tPY+jbs2FNBfQg5gebvWMxtap2UG2HQla+2
+r3mKWAfmd5rn09Kb5PTvVvmFAuf7mALlsOw1Ppjo0nQeQG34FTQ2fmyO5Yr4q4sI
+v7nZE1MtAFuwQBC0xxJ/aunf7T0I4VTKzik5UqmlztzPhdrhCASOAgcqOSYqdl8j
+DQtKTk7F1VF21zOwivZ2375aBc6ztEvgLqSdsh4txFKYRwUm/slBgGEptsRO/ZnY
+4lrfXuSDxAy7jRxWHyrLfur3I5tkVqYxBnFMCdjwDV3LPalKcNDim6n+52LhIWE+
+39y4ynfPBYDpT/4NXWc71Pbrmr4GwuGp7wIDAQABoAAwDQYJKoZIhvcNAQELBQAD
+ggEBAF3yXwXMKnc1ZKAtuuhyfXDE7s97qRy/iVoTEldrWmUcDhlfWdfZYBxpWp2e
+R7rOJDrL2LbHMYEN+vIQsaow6z4kYcSmyEasNCD/4gms/VesCTOoWz0QP+59NtFe
+w0+S7OGYDzBS+Wyo3W00R4nKMug1lhSCtOa9p3ibtPzx6U48Ch5whoedfzXY5z92
+q2BvFe+gBHospMivm2m/laeMMu99EarJE8JgTnUDtQmZ/xxLBsPp9Xk78Bc1gU7u
+1d2+gEBSgJ/cc3cagBWPPbdRaT4OmuOkIudq/zP6GqQKQ+8d7rLsFszdamTPv2v7
+zu/HPacJI420g3IC4vMVHeZznEM=
+-----END CERTIFICATE REQUEST-----
+"""
+
+with open("data/trusted_keys/privkey1.key", "rb") as file_data:
+    priv_key = file_data.read()
+with open("data/trusted_keys/pubkey1.pem", "rb") as file_data:
+    pub_key = file_data.read()
+
+
+class TestOCSPDelegation(unittest.TestCase):
+    """
+    Test our delegated OCSP responders
+    """
+
+    if "CA_URL" in os.environ:
+        ca_url = os.environ["CA_URL"]
+    else:
+        ca_url = ROOT_URL
+
+    def _post(self, endpoint: str, data: Dict[str, Any]) -> requests.Response:
+        request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + endpoint)}
+        return requests.post(
+            self.ca_url + endpoint, headers=request_headers, json=data, timeout=10, verify=verify_pkcs11_ca_tls_cert()
+        )
+
+    def _delegating_ca(self, key_label: str) -> str:
+        name_dict = {
+            "country_name": "SE",
+            "state_or_province_name": "Stockholm",
+            "locality_name": "Stockholm_test",
+            "organization_name": "SUNET_ocsp",
+            "organizational_unit_name": "SUNET Infrastructure",
+            "common_name": f"ca-test-{key_label}.sunet.se",
+        }
+
+        root_ca_pem = create_root_ca(self.ca_url, pub_key, priv_key)
+        req = self._post("/ca", {"key_label": key_label, "name_dict": name_dict, "issuer_pem": root_ca_pem})
+        if req.status_code == 200:
+            new_ca: str = json.loads(req.text)["certificate"]
+            return new_ca
+
+        # Created by an earlier test run, key labels are unique
+        self.assertTrue(req.status_code == 400)
+        request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + "/search/ca")}
+        req = requests.get(
+            self.ca_url + "/search/ca", headers=request_headers, timeout=10, verify=verify_pkcs11_ca_tls_cert()
+        )
+        self.assertTrue(req.status_code == 200)
+        for ca_pem in json.loads(req.text)["cas"]:
+            subject = load_pem_x509_certificate(ca_pem.encode("utf-8")).subject.rfc4514_string()
+            if f"CN={name_dict['common_name']}" in subject:
+                return str(ca_pem)
+        raise ValueError(f"Could not find the CA for {key_label}")
+
+    def _check_responder_cert(self, responder_cert: asn1_x509.Certificate, ca_pem: str) -> None:
+        # Issued by the CA with the id-kp-OCSPSigning EKU and the id-pkix-ocsp-nocheck extension
+        cert = load_der_x509_certificate(responder_cert.dump())
+        cert.verify_directly_issued_by(load_pem_x509_certificate(ca_pem.encode("utf-8")))
+        self.assertTrue(
+            list(cert.extensions.get_extension_for_class(ExtendedKeyUsage).value) == [ExtendedKeyUsageOID.OCSP_SIGNING]
+        )
+        self.assertTrue(responder_cert.ocsp_no_check_value is not None)
+
+        # Renewed OCSP_RESPONDER_CERT_RENEW_BEFORE seconds before it expires
+        now = datetime.datetime.now(datetime.timezone.utc)
+        not_after = responder_cert["tbs_certificate"]["validity"]["not_after"].native
+        self.assertTrue(not_after > now + datetime.timedelta(seconds=OCSP_RESPONDER_CERT_RENEW_BEFORE))
+        self.assertTrue(not_after <= now + datetime.timedelta(seconds=OCSP_RESPONDER_CERT_VALIDITY + 60))
+
+    def test_ocsp_delegated_responders(self) -> None:
+        """
+        Test that the delegated responder signs the OCSP responses, for both software and HSM responder keys
+        """
+
+        for key_label in OCSP_DELEGATED_RESPONDERS:
+            ca_pem = self._delegating_ca(key_label)
+            req = self._post("/sign_csr", {"pem": CSR_PEM, "ca_pem": ca_pem})
+            self.assertTrue(req.status_code == 200)
+            i_n_h, i_n_k, serial, ocsp_url = certificate_ocsp_data(json.loads(req.text)["certificate"])
+
+            ocsp_request_bytes = asyncio.run(request([(i_n_h, i_n_k, serial)]))
+            req = requests.get(
+                f"{ocsp_url}{ocsp_encode(ocsp_request_bytes)}", timeout=10, verify=verify_pkcs11_ca_tls_cert()
+            )
+            self.assertTrue(req.status_code == 200)
+
+            basic_response = asn1_ocsp.OCSPResponse.load(req.content)["response_bytes"]["response"].parsed
+            tbs_response_data = basic_response["tbs_response_data"].native
+            self.assertTrue(tbs_response_data["responses"][0]["cert_status"] == "good")
+
+            # The responder certificate and then the CA's chain
+            responder_cert = basic_response["certs"][0]
+            _, _, ca_der = asn1_pem.unarmor(ca_pem.encode("utf-8"))
+            self.assertTrue(basic_response["certs"][1].dump() == ca_der)
+            self.assertTrue(tbs_response_data["responder_id"] == responder_cert.public_key.sha1)
+            self.assertTrue(tbs_response_data["responder_id"] != pem_cert_to_key_hash(ca_pem))
+            self._check_responder_cert(responder_cert, ca_pem)
+
+            # Signed by the responder key
+            response = load_der_ocsp_response(req.content)
+            public_key = response.certificates[0].public_key()
+            self.assertTrue(isinstance(public_key, EllipticCurvePublicKey))
+            public_key.verify(response.signature, response.tbs_response_bytes, ECDSA(response.signature_hash_algorithm))
@@ -0,0 +1,89 @@
+"""
+Test the standalone OCSP responder, needs OCSP_RESPONSE_STORE set to True in the CA
+and the responder from ocsp_responder.py running at OCSP_RESPONDER_URL
+"""
+import asyncio
+import os
+import unittest
+
+import requests
+from asn1crypto import ocsp as asn1_ocsp
+from python_x509_pkcs11.ocsp import certificate_ocsp_data, request
+
+from src.pkcs11_ca_service.asn1 import create_jwt_header_str, ocsp_encode
+from src.pkcs11_ca_service.config import ROOT_URL
+
+from .lib import create_i_ca, verify_pkcs11_ca_tls_cert
+
+OCSP_ENDPOINT = "/ocsp/"
+REVOKE_ENDPOINT = "/revoke"
+
+with open("data/trusted_keys/privkey1.key", "rb") as file_data:
+    priv_key = file_data.read()
+with open("data/trusted_keys/pubkey1.pem", "rb") as file_data:
+    pub_key = file_data.read()
+
+
+@unittest.skipUnless("OCSP_RESPONDER_URL" in os.environ, "standalone OCSP responder not deployed")
+class TestOCSPResponder(unittest.TestCase):
+    """
+    Test our standalone OCSP responder
+    """
+
+    if "CA_URL" in os.environ:
+        ca_url = os.environ["CA_URL"]
+    else:
+        ca_url = ROOT_URL
+
+    name_dict = {
+        "country_name": "SE",
+        "state_or_province_name": "Stockholm",
+        "locality_name": "Stockholm_test",
+        "organization_name": "SUNET_ocsp",
+        "organizational_unit_name": "SUNET Infrastructure",
+        "common_name": "ca-test-ocsp-responder-47.sunet.se",
+    }
+
+    def _responder_request(self, ocsp_request_bytes: bytes) -> bytes:
+        req = requests.post(
+            os.environ["OCSP_RESPONDER_URL"] + OCSP_ENDPOINT,
+            data=ocsp_request_bytes,
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+        self.assertTrue("content-type" in req.headers and req.headers["content-type"] == "application/ocsp-response")
+        return req.content
+
+    def test_ocsp_responder_stored_response(self) -> None:
+        """
+        Test that the responder serves the response the CA stored and not after revocation
+        """
+
+        new_ca = create_i_ca(self.ca_url, pub_key, priv_key, self.name_dict)
+        i_n_h, i_n_k, serial, ocsp_url = certificate_ocsp_data(new_ca)
+        ocsp_request_bytes = asyncio.run(request([(i_n_h, i_n_k, serial)]))
+
+        # The CA signs and stores the response, or the pre-generation worker already did
+        req = requests.get(
+            f"{ocsp_url}{ocsp_encode(ocsp_request_bytes)}", timeout=10, verify=verify_pkcs11_ca_tls_cert()
+        )
+        self.assertTrue(req.status_code == 200)
+        self.assertTrue(self._responder_request(ocsp_request_bytes) == req.content)
+
+        # Revoke cert, deletes the stored good response
+        request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + REVOKE_ENDPOINT)}
+        req = requests.post(
+            self.ca_url + REVOKE_ENDPOINT,
+            headers=request_headers,
+            json={"pem": new_ca, "reason": 5},
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+
+        # Unauthorized or the revoked response the pre-generation worker may have stored since
+        ocsp_response = asn1_ocsp.OCSPResponse.load(self._responder_request(ocsp_request_bytes))
+        if ocsp_response["response_status"].native != "unauthorized":
+            responses = ocsp_response["response_bytes"]["response"].native["tbs_response_data"]["responses"]
+            self.assertTrue(responses[0]["cert_status"]["revocation_reason"] == "cessation_of_operation")
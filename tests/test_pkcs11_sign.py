@@ -4,11 +4,15 @@ Test our pkcs11_sign
 import base64
 import json
 import os
+import time
 import unittest
+from hashlib import sha256
+from typing import Iterator
 
 import requests
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.ec import ECDSA, EllipticCurvePublicKey
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
 from cryptography.hazmat.primitives.hashes import SHA256
 
 from src.pkcs11_ca_service.config import PKCS11_SIGN_API_TOKEN, ROOT_URL
@@ -76,3 +80,206 @@ class TestPKCS11Sign(unittest.TestCase):
                 base64.b64decode(self.request_data["documents"][index]["data"].encode("utf-8")),  # type: ignore
                 ECDSA(SHA256()),
             )
+
+    def test_pkcs11_sign_wrapped_base64(self) -> None:
+        """
+        Test pkcs11_sign with base64 data wrapped over several lines
+        """
+
+        request_headers = {
+            "Authorization": f"Bearer {base64.b64encode(PKCS11_SIGN_API_TOKEN.encode('UTF-8')).decode('UTF-8')}"
+        }
+
+        document = os.urandom(1024)
+        request_data = {
+            "meta": self.request_data["meta"],
+            "documents": [{"id": "doc1", "data": base64.encodebytes(document).decode("utf-8")}],
+        }
+
+        req = requests.post(
+            self.ca_url + "/pkcs11_sign",
+            headers=request_headers,
+            json=request_data,
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+        response_data = json.loads(req.text)
+
+        signer_public_key = serialization.load_pem_public_key(
+            response_data["meta"]["signer_public_key"].encode("utf-8")
+        )
+        if not isinstance(signer_public_key, EllipticCurvePublicKey):
+            raise TypeError
+
+        signer_public_key.verify(
+            base64.b64decode(response_data["signature_values"][0]["signature"].encode("utf-8")),
+            document,
+            ECDSA(SHA256()),
+        )
+
+    def test_pkcs11_sign_prehashed(self) -> None:
+        """
+        Test pkcs11_sign with prehashed documents
+        """
+
+        request_headers = {
+            "Authorization": f"Bearer {base64.b64encode(PKCS11_SIGN_API_TOKEN.encode('UTF-8')).decode('UTF-8')}"
+        }
+
+        documents = [os.urandom(1024 * 1024), os.urandom(1024 * 1024)]
+        request_data = {
+            "meta": {**self.request_data["meta"], "prehashed": True},  # type: ignore
+            "documents": [
+                {"id": f"doc{index}", "data": base64.b64encode(sha256(document).digest()).decode("utf-8")}
+                for index, document in enumerate(documents)
+            ],
+        }
+
+        req = requests.post(
+            self.ca_url + "/pkcs11_sign",
+            headers=request_headers,
+            json=request_data,
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+        response_data = json.loads(req.text)
+        self.assertTrue(response_data["meta"]["signature_algorithm"] == "sha256_ecdsa")
+
+        signer_public_key = serialization.load_pem_public_key(
+            response_data["meta"]["signer_public_key"].encode("utf-8")
+        )
+        if not isinstance(signer_public_key, EllipticCurvePublicKey):
+            raise TypeError
+
+        # The signature is valid both over the digest and over the full document
+        for index, document in enumerate(documents):
+            signature = base64.b64decode(response_data["signature_values"][index]["signature"].encode("utf-8"))
+            signer_public_key.verify(signature, sha256(document).digest(), ECDSA(Prehashed(SHA256())))
+            signer_public_key.verify(signature, document, ECDSA(SHA256()))
+
+        # Wrong digest size
+        request_data["documents"] = [{"id": "doc1", "data": base64.b64encode(b"0" * 48).decode("utf-8")}]
+        req = requests.post(
+            self.ca_url + "/pkcs11_sign",
+            headers=request_headers,
+            json=request_data,
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 400)
+
+        # EdDSA can not sign a digest
+        request_data["meta"] = {**request_data["meta"], "key_type": "ed25519"}  # type: ignore
+        request_data["documents"] = [{"id": "doc1", "data": base64.b64encode(b"0" * 32).decode("utf-8")}]
+        req = requests.post(
+            self.ca_url + "/pkcs11_sign",
+            headers=request_headers,
+            json=request_data,
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 400)
+
+    def test_pkcs11_sign_ndjson(self) -> None:
+        """
+        Test streaming pkcs11_sign with NDJSON
+        """
+
+        request_headers = {
+            "Authorization": f"Bearer {base64.b64encode(PKCS11_SIGN_API_TOKEN.encode('UTF-8')).decode('UTF-8')}",
+            "Content-Type": "application/x-ndjson",
+        }
+
+        documents = {f"doc{index}": base64.b64encode(os.urandom(32)).decode("utf-8") for index in range(200)}
+        request_lines = [json.dumps({"meta": self.request_data["meta"]})]
+        request_lines += [json.dumps({"id": doc_id, "data": data}) for doc_id, data in documents.items()]
+        request_lines.append("not a json document")
+
+        req = requests.post(
+            self.ca_url + "/pkcs11_sign",
+            headers=request_headers,
+            data="\n".join(request_lines).encode("utf-8"),
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+        self.assertTrue("application/x-ndjson" in req.headers["Content-Type"])
+        response_lines = [json.loads(line) for line in req.text.splitlines()]
+
+        # Load the signers public key
+        signer_public_key = serialization.load_pem_public_key(
+            response_lines[0]["meta"]["signer_public_key"].encode("utf-8")
+        )
+        if not isinstance(signer_public_key, EllipticCurvePublicKey):
+            raise TypeError
+
+        # Signatures come back in completion order, verify them by id
+        signature_values = [line for line in response_lines[1:] if "signature" in line]
+        self.assertTrue(len(signature_values) == len(documents))
+        for signature_value in signature_values:
+            signer_public_key.verify(
+                base64.b64decode(signature_value["signature"].encode("utf-8")),
+                base64.b64decode(documents[signature_value["id"]].encode("utf-8")),
+                ECDSA(SHA256()),
+            )
+
+        # The broken line gives an error record
+        errors = [line for line in response_lines[1:] if "error" in line]
+        self.assertTrue(len(errors) == 1)
+
+        # Invalid meta line
+        req = requests.post(
+            self.ca_url + "/pkcs11_sign",
+            headers=request_headers,
+            data="\n".join(request_lines[1:]).encode("utf-8"),
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 400)
+
+    def test_pkcs11_sign_ndjson_chunked(self) -> None:
+        """
+        Test streaming pkcs11_sign with NDJSON sent in many chunks
+        """
+
+        request_headers = {
+            "Authorization": f"Bearer {base64.b64encode(PKCS11_SIGN_API_TOKEN.encode('UTF-8')).decode('UTF-8')}",
+            "Content-Type": "application/x-ndjson",
+        }
+
+        documents = {f"doc{index}": base64.b64encode(os.urandom(32)).decode("utf-8") for index in range(50)}
+
+        def request_chunks() -> Iterator[bytes]:
+            # One chunk per line, sent with chunked transfer encoding
+            yield json.dumps({"meta": self.request_data["meta"]}).encode("utf-8") + b"\n"
+            for doc_id, data in documents.items():
+                time.sleep(0.01)
+                yield json.dumps({"id": doc_id, "data": data}).encode("utf-8") + b"\n"
+
+        req = requests.post(
+            self.ca_url + "/pkcs11_sign",
+            headers=request_headers,
+            data=request_chunks(),
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+        response_lines = [json.loads(line) for line in req.text.splitlines()]
+
+        signer_public_key = serialization.load_pem_public_key(
+            response_lines[0]["meta"]["signer_public_key"].encode("utf-8")
+        )
+        if not isinstance(signer_public_key, EllipticCurvePublicKey):
+            raise TypeError
+
+        # Every line got its signature
+        signature_values = {line["id"]: line["signature"] for line in response_lines[1:] if "signature" in line}
+        self.assertTrue(sorted(signature_values) == sorted(documents))
+        for doc_id, signature in signature_values.items():
+            signer_public_key.verify(
+                base64.b64decode(signature.encode("utf-8")),
+                base64.b64decode(documents[doc_id].encode("utf-8")),
+                ECDSA(SHA256()),
+            )
@@ -22,6 +22,7 @@ from .lib import cdp_url, create_i_ca, verify_pkcs11_ca_tls_cert
 ORGANIZATIONAL_UNIT_NAME = "SUNET Infrastructure"
 REVOKE_ENDPOINT = "/revoke"
 IS_REVOKED_ENDPOINT = "/is_revoked"
+BULK_REVOKE_ENDPOINT = "/bulk_revoke"
 
 
 TEST_CSR1 = """-----BEGIN CERTIFICATE REQUEST-----
@@ -210,3 +211,160 @@ class TestRevoke(unittest.TestCase):
         self.assertTrue(req.status_code == 200)
         revoked = json.loads(req.text)["is_revoked"]
         self.assertTrue(revoked is True)
+
+    def test_revoke_twice(self) -> None:
+        """
+        Test revoking a certificate again lists it once on the CRL, with its first revocation time and the new reason
+        """
+
+        with open("data/trusted_keys/pubkey1.pem", "rb") as f_data:
+            pub_key = f_data.read()
+        with open("data/trusted_keys/privkey1.key", "rb") as f_data:
+            priv_key = f_data.read()
+
+        new_ca = create_i_ca(self.ca_url, pub_key, priv_key, self.name_dict)
+
+        # Superseded, then key compromise which replaces the reason, then a reason which can not replace it
+        revocation_dates = []
+        for reason in [4, 1, 5]:
+            request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + REVOKE_ENDPOINT)}
+            req = requests.post(
+                self.ca_url + REVOKE_ENDPOINT,
+                headers=request_headers,
+                json={"pem": new_ca, "reason": reason},
+                timeout=10,
+                verify=verify_pkcs11_ca_tls_cert(),
+            )
+            self.assertTrue(req.status_code == 200)
+
+            req = requests.get(cdp_url(new_ca), timeout=10, verify=verify_pkcs11_ca_tls_cert())
+            self.assertTrue(req.status_code == 200)
+            revoked_certs = [
+                revoked
+                for revoked in asn1_crl.CertificateList.load(req.content)["tbs_cert_list"]["revoked_certificates"]
+                if revoked["user_certificate"].native == cert_pem_serial_number(new_ca)
+            ]
+            self.assertTrue(len(revoked_certs) == 1)
+            revocation_dates.append(revoked_certs[0]["revocation_date"].native)
+
+        # The first revocation's time is kept and key compromise is the reason
+        self.assertTrue(revocation_dates[0] == revocation_dates[1] == revocation_dates[2])
+        self.assertTrue(revoked_certs[0]["crl_entry_extensions"][0]["extn_value"].native == "key_compromise")
+
+        request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + IS_REVOKED_ENDPOINT)}
+        req = requests.post(
+            self.ca_url + IS_REVOKED_ENDPOINT,
+            headers=request_headers,
+            json={"pem": new_ca},
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+        self.assertTrue(json.loads(req.text)["is_revoked"])
+
+    def test_bulk_revoke(self) -> None:
+        """
+        Test revoking many CAs in one request, nothing is revoked if one is invalid
+        """
+
+        with open("data/trusted_keys/pubkey1.pem", "rb") as f_data:
+            pub_key = f_data.read()
+        with open("data/trusted_keys/privkey1.key", "rb") as f_data:
+            priv_key = f_data.read()
+
+        new_cas = [create_i_ca(self.ca_url, pub_key, priv_key, self.name_dict) for _ in range(3)]
+
+        # Two certs issued by the first CA, revoked with it
+        new_certs = []
+        for _ in range(2):
+            request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + "/sign_csr")}
+            req = requests.post(
+                self.ca_url + "/sign_csr",
+                headers=request_headers,
+                json={"pem": TEST_CSR1, "ca_pem": new_cas[0]},
+                timeout=10,
+                verify=verify_pkcs11_ca_tls_cert(),
+            )
+            self.assertTrue(req.status_code == 200)
+            new_certs.append(json.loads(req.text)["certificate"])
+
+        req = requests.get(cdp_url(new_certs[0]), timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req.status_code == 200)
+        crl_number = asn1_crl.CertificateList.load(req.content).crl_number_value.native
+
+        # One unknown PEM, nothing is revoked
+        request_headers = {
+            "Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + BULK_REVOKE_ENDPOINT)
+        }
+        req = requests.post(
+            self.ca_url + BULK_REVOKE_ENDPOINT,
+            headers=request_headers,
+            json={"revocations": [{"pem": new_cas[0], "reason": 1}, {"pem": TEST_CSR1, "reason": 1}]},
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 400)
+
+        # One invalid reason, nothing is revoked
+        request_headers = {
+            "Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + BULK_REVOKE_ENDPOINT)
+        }
+        req = requests.post(
+            self.ca_url + BULK_REVOKE_ENDPOINT,
+            headers=request_headers,
+            json={"revocations": [{"pem": new_cas[0], "reason": 1}, {"pem": new_cas[1], "reason": 7}]},
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 400)
+
+        request_headers = {"Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + IS_REVOKED_ENDPOINT)}
+        req = requests.post(
+            self.ca_url + IS_REVOKED_ENDPOINT,
+            headers=request_headers,
+            json={"pem": new_cas[0]},
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+        self.assertFalse(json.loads(req.text)["is_revoked"])
+
+        request_headers = {
+            "Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + BULK_REVOKE_ENDPOINT)
+        }
+        req = requests.post(
+            self.ca_url + BULK_REVOKE_ENDPOINT,
+            headers=request_headers,
+            json={"revocations": [{"pem": pem, "reason": 1} for pem in new_cas + new_certs]},
+            timeout=10,
+            verify=verify_pkcs11_ca_tls_cert(),
+        )
+        self.assertTrue(req.status_code == 200)
+        self.assertTrue(len(json.loads(req.text)["revoked"]) == 5)
+
+        # The first CA's CRL is signed once for both its certs
+        req = requests.get(cdp_url(new_certs[0]), timeout=10, verify=verify_pkcs11_ca_tls_cert())
+        self.assertTrue(req.status_code == 200)
+        self.assertTrue(asn1_crl.CertificateList.load(req.content).crl_number_value.native == crl_number + 1)
+
+        for pem in new_cas + new_certs:
+            req = requests.get(cdp_url(pem), timeout=10, verify=verify_pkcs11_ca_tls_cert())
+            self.assertTrue(req.status_code == 200)
+            revoked_serials = [
+                revoked["user_certificate"].native
+                for revoked in asn1_crl.CertificateList.load(req.content)["tbs_cert_list"]["revoked_certificates"]
+            ]
+            self.assertTrue(cert_pem_serial_number(pem) in revoked_serials)
+
+            request_headers = {
+                "Authorization": create_jwt_header_str(pub_key, priv_key, self.ca_url + IS_REVOKED_ENDPOINT)
+            }
+            req = requests.post(
+                self.ca_url + IS_REVOKED_ENDPOINT,
+                headers=request_headers,
+                json={"pem": pem},
+                timeout=10,
+                verify=verify_pkcs11_ca_tls_cert(),
+            )
+            self.assertTrue(req.status_code == 200)
+            self.assertTrue(json.loads(req.text)["is_revoked"])